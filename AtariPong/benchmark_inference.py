@@ -0,0 +1,51 @@
+import os
+import time
+from copy import deepcopy
+
+import numpy as np
+import torch
+
+from bn_folding import FoldedDuelCNN
+from collect_data import DuelCNN, MODEL_PATH, LOAD_FILE_EPISODE
+from preprocessing import to_model_input
+
+
+NUM_STEPS = 2000
+NUM_WARMUP = 50
+N_ACTIONS = 6  # Pong action space
+
+
+def step_latency(model, state, n_steps=NUM_STEPS, n_warmup=NUM_WARMUP):
+    """
+    Mean time in ms of the forward of one state (batch size 1), as Agent.act on every simulation step
+    """
+    with torch.no_grad():
+        for _ in range(n_warmup):
+            model(state)
+        start = time.perf_counter()
+        for _ in range(n_steps):
+            model(state)
+    return (time.perf_counter() - start) / n_steps * 1000
+
+
+if __name__ == '__main__':
+    model = DuelCNN(h=80, w=64, output_size=N_ACTIONS)
+    if os.path.exists(MODEL_PATH + str(LOAD_FILE_EPISODE) + ".pkl"):
+        model.load_state_dict(torch.load(MODEL_PATH + str(LOAD_FILE_EPISODE) + ".pkl", map_location=torch.device('cpu')))
+    eval_model = deepcopy(model).eval()
+    folded_model = FoldedDuelCNN(model)
+
+    # uint8 stacks, as FrameStack gives them
+    states = to_model_input(np.random.randint(0, 256, size=(64, 4, 64, 80), dtype=np.uint8), 'cpu')
+    with torch.no_grad():
+        q_eval, x_eval = eval_model(states)
+        q_folded, x_folded = folded_model(states)
+    print(f"max |q eval - q folded|: {(q_eval - q_folded).abs().max().item():.2e}, "
+          f"max |x eval - x folded|: {(x_eval - x_folded).abs().max().item():.2e}")
+
+    state = states[:1]
+    ms_train = step_latency(model.train(), state)
+    ms_eval = step_latency(eval_model, state)
+    ms_folded = step_latency(folded_model, state)
+    print(f"step latency: train mode {ms_train:.3f} ms, eval mode {ms_eval:.3f} ms, folded {ms_folded:.3f} ms "
+          f"({ms_eval / ms_folded:.2f}x eval mode)")
@@ -0,0 +1,41 @@
+from copy import deepcopy
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+
+class FoldedDuelCNN(nn.Module):
+    """
+    Inference copy of a trained DuelCNN in eval mode, with every BatchNorm2d folded into the conv before it
+    (BN with the running statistics is an affine map per channel, so it becomes part of the conv weights and bias).
+    Same (q, x) outputs of DuelCNN.forward in eval mode, with three layers less per step.
+    """
+
+    def __init__(self, model):
+        super(FoldedDuelCNN, self).__init__()
+        model = deepcopy(model).eval()
+        self.conv1 = fuse_conv_bn_eval(model.conv1, model.bn1)
+        self.conv2 = fuse_conv_bn_eval(model.conv2, model.bn2)
+        self.conv3 = fuse_conv_bn_eval(model.conv3, model.bn3)
+
+        self.Alinear1, self.Alrelu, self.Alinear2 = model.Alinear1, model.Alrelu, model.Alinear2
+        self.Vlinear1, self.Vlrelu, self.Vlinear2 = model.Vlinear1, model.Vlrelu, model.Vlinear2
+        self.eval()
+
+    def forward(self, x):
+        with torch.inference_mode():
+            x = F.relu(self.conv1(x))
+            x = F.relu(self.conv2(x))
+            x = F.relu(self.conv3(x))
+
+            x = x.view(x.size(0), -1)  # Flatten every batch
+
+            Ax = self.Alinear2(self.Alrelu(self.Alinear1(x)))
+            Vx = self.Vlinear2(self.Vlrelu(self.Vlinear1(x)))
+
+            q = Vx + (Ax - Ax.mean())
+
+        # normal tensors out of inference mode: the latent goes through the wrappers, which can record autograd
+        return q.clone(), x.clone()
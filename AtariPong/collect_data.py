@@ -1,5 +1,4 @@
 import gym
-import cv2
 import time
 import json
 import random
@@ -12,6 +11,9 @@ import torch.nn.functional as F
 import os
 
 from collections import deque
+from replay_memory import FrameReplayMemory
+from preprocessing import FrameStack, to_model_input
+from bn_folding import FoldedDuelCNN
 
 
 ENVIRONMENT = "PongDeterministic-v4"
@@ -20,6 +22,7 @@ SAVE_MODELS = False  # Save models to file so you can test later
 MODEL_PATH = "./models/pong-cnn-"  # Models path for saving or loading
 SAVE_MODEL_INTERVAL = 10  # Save models at every X epoch
 TRAIN_MODEL = False  # Train model while playing (Make it False when testing a model)
+FOLDED_INFERENCE = False  # Act with the eval-mode BatchNorm-folded copy of the loaded model (bn_folding.py) instead of the train-mode one
 LOAD_MODEL_FROM_FILE = True  # Load model from file
 LOAD_FILE_EPISODE = 900  # Load Xth episode from file
 BATCH_SIZE = 64  # Minibatch size that select randomly from mem for train nets
@@ -28,6 +31,7 @@ MAX_EPISODE = 100000  # Max episode
 
 MAX_STEP = 100000  # Max step size for one episode
 NUM_EPISODES = 30
+HELD_OUT = False  # record held-out trajectories for offline_evaluation.py instead of the training data
 MAX_MEMORY_LEN = 50000  # Max memory len
 MIN_MEMORY_LEN = 40000  # Min memory len before start train
 
@@ -99,9 +103,10 @@ class DuelCNN(nn.Module):
 
 
 class Agent:
-    def __init__(self, environment):
+    def __init__(self, environment, replay_memory=TRAIN_MODEL):
         """
         Hyperparameters definition for Agent
+        replay_memory=False skips the replay memory entirely, when the agent only plays
         """
 
         # State size for breakout env. SS images (210, 160, 3). Used as input size in network
@@ -117,6 +122,8 @@ class Agent:
         self.target_w = 64  # Widht after process
 
         self.crop_dim = [20, self.state_size_h, 0, self.state_size_w]  # Cut 20 px from top to get rid of the score table
+        # frames cropped, grayscaled and resized, stacked by 4 as uint8 in a ring buffer
+        self.frames = FrameStack(self.target_h, self.target_w, self.crop_dim[0])
 
         # Trust rate to our experiences
         self.gamma = GAMMA  # Discount coef for future predictions
@@ -128,28 +135,27 @@ class Agent:
         self.epsilon_decay = EPSILON_DECAY  # Adaptive Epsilon Decay Rate
         self.epsilon_minimum = 0.05  # Minimum for Explore
 
-        # Deque holds replay mem.
-        self.memory = deque(maxlen=MAX_MEMORY_LEN)
+        # Replay mem. of uint8 frames, stacks rebuilt when sampled
+        self.memory = FrameReplayMemory(MAX_MEMORY_LEN, (self.target_w, self.target_h), device=DEVICE) if replay_memory else None
 
         # Create two model for DDQN algorithm
         self.online_model = DuelCNN(h=self.target_h, w=self.target_w, output_size=self.action_size).to(DEVICE)
         self.target_model = DuelCNN(h=self.target_h, w=self.target_w, output_size=self.action_size).to(DEVICE)
         self.target_model.load_state_dict(self.online_model.state_dict())
         self.target_model.eval()
+        self.inference_model = None  # FoldedDuelCNN of the online model, after fold_online_model
 
         # Adam used as optimizer
         self.optimizer = optim.Adam(self.online_model.parameters(), lr=self.alpha)
 
-    def preProcess(self, image):
+    def fold_online_model(self):
         """
-        Process image crop resize, grayscale and normalize the images
+        Act with the BatchNorm-folded eval-mode copy of the online model (fold again after changing its weights)
         """
-        frame = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)  # To grayscale
-        frame = frame[self.crop_dim[0]:self.crop_dim[1], self.crop_dim[2]:self.crop_dim[3]]  # Cut 20 px from top
-        frame = cv2.resize(frame, (self.target_w, self.target_h))  # Resize
-        frame = frame.reshape(self.target_w, self.target_h) / 255  # Normalize
+        self.inference_model = FoldedDuelCNN(self.online_model)
 
-        return frame
+    def acting_model(self):
+        return self.online_model if self.inference_model is None else self.inference_model
 
     def act(self, state):
         """
@@ -162,12 +168,12 @@ class Agent:
 
         if act_protocol == 'Explore':
             action = random.randrange(self.action_size)
-            state = torch.tensor(state, dtype=torch.float, device=DEVICE).unsqueeze(0)
-            q_values, x = self.online_model.forward(state)  # (1, action_size)
+            state = to_model_input(state, DEVICE).unsqueeze(0)
+            q_values, x = self.acting_model()(state)  # (1, action_size)
         else:
             with torch.no_grad():
-                state = torch.tensor(state, dtype=torch.float, device=DEVICE).unsqueeze(0)
-                q_values, x = self.online_model.forward(state)  # (1, action_size)
+                state = to_model_input(state, DEVICE).unsqueeze(0)
+                q_values, x = self.acting_model()(state)  # (1, action_size)
                 action = torch.argmax(q_values).item()  # Returns the indices of the maximum value of all elements
 
         return action, x
@@ -177,28 +183,16 @@ class Agent:
         Train neural nets with replay memory
         returns loss and max_q val predicted from online_net
         """
-        if len(agent.memory) < MIN_MEMORY_LEN:
+        if len(self.memory) < MIN_MEMORY_LEN:
             loss, max_q = [0, 0]
             return loss, max_q
-        # We get out minibatch and turn it to numpy array
-        state, action, reward, next_state, done = zip(*random.sample(self.memory, BATCH_SIZE))
-
-        # Concat batches in one array
-        # (np.arr, np.arr) ==> np.BIGarr
-        state = np.concatenate(state)
-        next_state = np.concatenate(next_state)
-
-        # Convert them to tensors
-        state = torch.tensor(state, dtype=torch.float, device=DEVICE)
-        next_state = torch.tensor(next_state, dtype=torch.float, device=DEVICE)
-        action = torch.tensor(action, dtype=torch.long, device=DEVICE)
-        reward = torch.tensor(reward, dtype=torch.float, device=DEVICE)
-        done = torch.tensor(done, dtype=torch.float, device=DEVICE)
+        # We get out minibatch as tensors on DEVICE
+        state, action, reward, next_state, done = self.memory.sample(BATCH_SIZE)
 
         # Make predictions
-        state_q_values = self.online_model(state)
-        next_states_q_values = self.online_model(next_state)
-        next_states_target_q_values = self.target_model(next_state)
+        state_q_values, _ = self.online_model(state)
+        next_states_q_values, _ = self.online_model(next_state)
+        next_states_target_q_values, _ = self.target_model(next_state)
 
         # Find selected action's q_value
         selected_q_value = state_q_values.gather(1, action.unsqueeze(1)).squeeze(1)
@@ -222,7 +216,8 @@ class Agent:
         """
         Store every result to memory
         """
-        self.memory.append([state[None, :], action, reward, nextState[None, :], done])
+        if self.memory is not None:
+            self.memory.push(state, action, reward, nextState, done)
 
     def adaptiveEpsilon(self):
         """
@@ -246,6 +241,8 @@ if __name__ == "__main__":
         startEpisode = LOAD_FILE_EPISODE + 1
     else:
         startEpisode = 1
+    if FOLDED_INFERENCE:
+        agent.fold_online_model()
 
     last_100_ep_reward = deque(maxlen=100)  # Last 100 episode rewards
     total_step = 1  # Cumulkative sum of all steps in episodes
@@ -255,6 +252,7 @@ if __name__ == "__main__":
     all_states = list()
     all_x = list()
     all_actions = list()
+    all_episodes = list()
     #added
     states = list()
 
@@ -262,13 +260,11 @@ if __name__ == "__main__":
         startTime = time.time()  # Keep time
         state = environment.reset()  # Reset env
         all_states.append(state[0].tolist())
-        state = agent.preProcess(state)  # Process image
-        # Stack state . Every state contains 4 time contionusly frames
-        # We stack frames like 4 channel image
-        state = np.stack((state, state, state, state))
+        state = agent.frames.reset(state)  # Process image, stacked 4 times
         
-        img_array = environment.render(mode='rgb_array')
-        images = [img_array, img_array, img_array, img_array]
+        if not HELD_OUT:  # the held-out set keeps no observations
+            img_array = environment.render(mode='rgb_array')
+            images = [img_array, img_array, img_array, img_array]
         #states.append(images)
         
         total_max_q_val = 0  # Total max q vals
@@ -282,6 +278,7 @@ if __name__ == "__main__":
             #### Save x and actions for training wrapper model 
             all_x.append(latent_x.tolist()[0])
             all_actions.append(action)
+            all_episodes.append(episode)
             next_state, reward, done, info = environment.step(action)  # Observe
 
             # #### Save State for human-defined concepts -- uncomment if you want to manually save the observations to select prototypes later
@@ -289,16 +286,13 @@ if __name__ == "__main__":
             # temp = torch.nn.functional.interpolate(temp, scale_factor=0.1, mode='nearest')[0].permute(1, 2, 0)
             # temp = temp.tolist()            
             # all_states.append(temp)
-            img_array = environment.render(mode='rgb_array')
-            images = [img_array]+images[:-1] 
-            states.append(images)
+            if not HELD_OUT:
+                img_array = environment.render(mode='rgb_array')
+                images = [img_array]+images[:-1] 
+                states.append(images)
 
       
-            next_state = agent.preProcess(next_state)  # Process image
-
-            # Stack state . Every state contains 4 time contionusly frames
-            # We stack frames like 4 channel image
-            next_state = np.stack((next_state, state[0], state[1], state[2]))
+            next_state = agent.frames.push(next_state)  # Process image, on top of the last 3 of state
 
             # Store the transition in memory
             agent.storeResults(state, action, reward, next_state, done)  # Store to mem
@@ -356,15 +350,20 @@ if __name__ == "__main__":
 
     print("Average Reward:", sum(all_rewards) / NUM_EPISODES)
 
-    # We're not saving the observations in the interest of saving memory, but you can uncomment if you like.
-    with open('data/X_train.pkl', 'wb') as f:
-      pickle.dump(all_x, f)
-    with open('data/a_train.pkl', 'wb') as f:
-      pickle.dump(all_actions, f)
-    
-    # to save images of possible prototypes  
-    with open('data/obs_train.pkl', 'wb') as f:
-       pickle.dump(states, f)
+    if HELD_OUT:
+        np.save('data/X_held_out.npy', np.array(all_x))
+        np.save('data/a_held_out.npy', np.array(all_actions))
+        np.save('data/ep_held_out.npy', np.array(all_episodes))
+    else:
+        # We're not saving the observations in the interest of saving memory, but you can uncomment if you like.
+        with open('data/X_train.pkl', 'wb') as f:
+          pickle.dump(all_x, f)
+        with open('data/a_train.pkl', 'wb') as f:
+          pickle.dump(all_actions, f)
+        
+        # to save images of possible prototypes  
+        with open('data/obs_train.pkl', 'wb') as f:
+           pickle.dump(states, f)
 
 
 
@@ -0,0 +1,58 @@
+import math
+import statistics
+
+
+REWARD_SCALE = 21.  # maximum score of a Pong episode (the reward spans -21 to 21)
+TARGET_SE = 0.02 * REWARD_SCALE  # standard error of the reward mean that is precise enough: 2% of the reward scale of the env
+REFERENCE_REWARD = None  # e.g. the reward of the black-box agent, to stop once the wrapper is clearly above or below it
+Z = 2.576  # two-sided 99%: the test looks at the data after every episode, so a 95% level would be too optimistic
+MIN_EPISODES = 5  # the standard error of fewer episodes is not reliable
+
+
+class SequentialStop:
+    """
+    Sequential test on the episode rewards of the simulation: it stops as soon as the standard error of
+    the reward mean is below target_se, or the mean is significantly different from reference
+    (|mean - reference| > z * se), and in any case after max_episodes.
+    """
+
+    def __init__(self, max_episodes, target_se=TARGET_SE, reference=REFERENCE_REWARD, z=Z, min_episodes=MIN_EPISODES):
+        self.max_episodes = max_episodes
+        self.target_se = target_se
+        self.reference = reference
+        self.z = z
+        self.min_episodes = min_episodes
+        self.rewards = list()
+        self.reason = None
+
+    def mean(self):
+        return statistics.mean(self.rewards)
+
+    def standard_error(self):
+        return statistics.stdev(self.rewards) / math.sqrt(len(self.rewards))
+
+    def update(self, reward):
+        """
+        Adds the reward of the episode just played, returns True when the simulation can stop
+        """
+        self.rewards.append(float(reward))
+        n = len(self.rewards)
+        if n >= self.max_episodes:
+            self.reason = 'max_episodes'
+        elif n >= self.min_episodes:
+            se = self.standard_error()
+            if self.target_se is not None and se <= self.target_se:
+                self.reason = 'standard_error'
+            elif self.reference is not None and abs(self.mean() - self.reference) > self.z * se:
+                self.reason = 'above_reference' if self.mean() > self.reference else 'below_reference'
+        return self.reason is not None
+
+    def summary(self):
+        n = len(self.rewards)
+        return {
+            'episodes': n,
+            'saved_episodes': self.max_episodes - n,
+            'reward_mean': self.mean() if n else None,
+            'reward_se': self.standard_error() if n > 1 else None,
+            'reason': self.reason,
+        }
@@ -0,0 +1,64 @@
+import cv2
+import numpy as np
+import torch
+
+
+class FrameStack:
+    """
+    Pong frames cropped, grayscaled and resized to (target_w, target_h) as uint8, and stacked by stack_size, the most recent first.
+    Each frame is cropped before the colour conversion and resized straight into a ring buffer, so no array
+    is allocated per step. Every frame is written twice (at i and i + ring size), so the stack is always the
+    contiguous view frames[head:head + stack_size], and the view of a stack is still valid after the next
+    push (it becomes the previous state of the transition). The float32 input of the model is made
+    by to_model_input, at inference time.
+    """
+
+    def __init__(self, target_h=80, target_w=64, crop_top=20, stack_size=4):
+        self.target_h = target_h
+        self.target_w = target_w
+        self.crop_top = crop_top
+        self.stack_size = stack_size
+        self.ring_size = stack_size + 1  # one more slot keeps the previous stack intact
+
+        self.frames = np.zeros((2 * self.ring_size, target_w, target_h), dtype=np.uint8)
+        self.head = 0
+        self.gray = None
+
+    def process(self, image, out=None):
+        cropped = image[self.crop_top:]  # Cut 20 px from top (a view), before the grayscale conversion
+        if self.gray is None:
+            self.gray = np.empty(cropped.shape[:2], dtype=np.uint8)
+        cv2.cvtColor(cropped, cv2.COLOR_BGR2GRAY, self.gray)  # To grayscale
+        if out is None:
+            out = np.empty((self.target_w, self.target_h), dtype=np.uint8)
+        # Resize, written into out seen as (target_h, target_w): the frame is its (target_w, target_h) reshape
+        cv2.resize(self.gray, (self.target_w, self.target_h), dst=out.reshape(self.target_h, self.target_w))
+        return out
+
+    def stack(self):
+        return self.frames[self.head:self.head + self.stack_size]
+
+    def push(self, image):
+        """
+        Adds the frame of a new step and returns the stack, (stack_size, target_w, target_h) uint8
+        """
+        self.head = (self.head - 1) % self.ring_size
+        self.process(image, out=self.frames[self.head])
+        self.frames[self.head + self.ring_size] = self.frames[self.head]
+        return self.stack()
+
+    def reset(self, image):
+        """
+        First frame of an episode, repeated in the whole stack
+        """
+        self.push(image)
+        self.frames[:] = self.frames[self.head]
+        return self.stack()
+
+
+def to_model_input(stacks, device):
+    """
+    float32 input of DuelCNN from uint8 stacks (stack_size, w, h) or (batch, stack_size, w, h):
+    moved to the device as uint8 and scaled to [0, 1] there
+    """
+    return torch.from_numpy(np.ascontiguousarray(stacks)).to(device).float().div_(255)
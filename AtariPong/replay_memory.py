@@ -0,0 +1,92 @@
+import numpy as np
+import torch
+
+
+class FrameReplayMemory:
+    """
+    Replay memory of the DQN Agent that keeps every preprocessed frame once, as uint8, in a ring array.
+    Consecutive transitions share stack_size - 1 frames: the stacks (newest frame first, the first frame
+    of the episode repeated before it, as in the run loops) are rebuilt by index when a batch is sampled.
+    """
+
+    def __init__(self, capacity, frame_shape, stack_size=4, device='cpu'):
+        self.capacity = capacity
+        self.stack_size = stack_size
+        self.device = device
+
+        self.frames = np.zeros((capacity, *frame_shape), dtype=np.uint8)
+        self.episode_start = np.zeros(capacity, dtype=np.int64)  # position of the first frame of the episode
+        self.has_transition = np.zeros(capacity, dtype=bool)  # False for the first frame of an episode
+        self.actions = np.zeros(capacity, dtype=np.int64)
+        self.rewards = np.zeros(capacity, dtype=np.float32)
+        self.dones = np.zeros(capacity, dtype=np.float32)
+
+        self.position = 0  # frames pushed so far, the slot of position p is p % capacity
+        self.n_transitions = 0
+        self.rng = np.random.default_rng()
+
+    def _oldest(self):
+        # first position whose transition has all its frames still in the ring (the oldest ones can be partly
+        # overwritten)
+        return max(0, self.position - self.capacity + self.stack_size)
+
+    def __len__(self):
+        """
+        Number of transitions that sample can return
+        """
+        overwritten = np.arange(max(0, self.position - self.capacity), self._oldest())
+        return self.n_transitions - int(self.has_transition[overwritten % self.capacity].sum())
+
+    def _push_frame(self, frame, episode_start, transition=None):
+        slot = self.position % self.capacity
+        self.n_transitions -= int(self.has_transition[slot])
+        self.frames[slot] = frame
+        self.episode_start[slot] = episode_start
+        self.has_transition[slot] = transition is not None
+        if transition is not None:
+            self.actions[slot], self.rewards[slot], self.dones[slot] = transition
+            self.n_transitions += 1
+        self.position += 1
+
+    def _continues_episode(self, state):
+        if self.position == 0:
+            return False
+        last = (self.position - 1) % self.capacity
+        return not self.dones[last] and np.array_equal(self.frames[last], state[0])
+
+    def push(self, state, action, reward, next_state, done):
+        """
+        Stores a transition between two stacks of frames (newest first): only the newest frame of next_state,
+        plus the first frame of state when a new episode starts
+        """
+        if not self._continues_episode(state):
+            self._push_frame(state[0], self.position)
+        last = (self.position - 1) % self.capacity
+        self._push_frame(next_state[0], self.episode_start[last], (action, reward, done))
+
+    def _stacks(self, positions):
+        # (batch, stack_size) positions of the stacked frames, newest first, clipped to the episode start
+        starts = self.episode_start[positions % self.capacity]
+        stacked = positions[:, None] - np.arange(self.stack_size)
+        stacked = np.maximum(stacked, starts[:, None])
+        return self.frames[stacked % self.capacity]
+
+    def _to_tensor(self, frames):
+        # uint8 to the device, scaled there to [0, 1] as by to_model_input
+        return torch.from_numpy(frames).to(self.device).float().div_(255)
+
+    def sample(self, batch_size):
+        """
+        Returns state, action, reward, next_state, done tensors of batch_size transitions sampled without replacement
+        """
+        positions = np.arange(self._oldest(), self.position)
+        positions = positions[self.has_transition[positions % self.capacity]]
+        positions = self.rng.choice(positions, batch_size, replace=False)
+        slots = positions % self.capacity
+
+        state = self._to_tensor(self._stacks(positions - 1))
+        next_state = self._to_tensor(self._stacks(positions))
+        action = torch.from_numpy(self.actions[slots]).to(self.device)
+        reward = torch.from_numpy(self.rewards[slots]).to(self.device)
+        done = torch.from_numpy(self.dones[slots]).to(self.device)
+        return state, action, reward, next_state, done
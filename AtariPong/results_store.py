@@ -0,0 +1,130 @@
+import datetime
+import json
+import math
+import os
+import sqlite3
+from argparse import ArgumentParser
+
+
+RESULTS_DB = 'results/results.db'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    env TEXT NOT NULL,
+    model TEXT NOT NULL,
+    config TEXT NOT NULL,
+    started TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS metrics (
+    run INTEGER NOT NULL REFERENCES runs (id),
+    iteration INTEGER NOT NULL,
+    epoch INTEGER,
+    name TEXT NOT NULL,
+    value REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS metrics_name ON metrics (name, epoch, run);
+"""
+
+
+def _connect(path):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    connection = sqlite3.connect(path)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def _config_key(config):
+    # canonical JSON: the same config is the same string, whatever the order of the keys
+    return json.dumps(config, sort_keys=True, default=str)
+
+
+class ResultsStore:
+    """
+    Metrics of a run_*.py in an SQLite database, in place of parsing the results/*.txt: one row per metric
+    value, keyed by the run (environment, model type, config) and by iteration and epoch (NULL for the
+    metrics of a whole iteration, as the reward of the simulation and the phase timings).
+    With enabled=False every call is a no-op.
+    """
+
+    def __init__(self, env, model, config, path=RESULTS_DB, enabled=True):
+        self.enabled = enabled
+        if not enabled:
+            return
+        self.connection = _connect(path)
+        with self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO runs (env, model, config, started) VALUES (?, ?, ?, ?)",
+                (env, model, _config_key(config), datetime.datetime.now().isoformat(timespec='seconds')))
+        self.run = cursor.lastrowid
+
+    def _insert(self, iteration, epoch, metrics):
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO metrics (run, iteration, epoch, name, value) VALUES (?, ?, ?, ?, ?)",
+                [(self.run, iteration, epoch, name, float(value)) for name, value in metrics.items()])
+
+    def log_epoch(self, iteration, epoch, **metrics):
+        if self.enabled:
+            self._insert(iteration, epoch, metrics)
+
+    def log_iteration(self, iteration, timing=None, **metrics):
+        """
+        Metrics of the iteration, plus the phases of instrumentation.PhaseTimer.last_iteration() as
+        time/<phase> (seconds), samples_per_s/<phase> and steps_per_s/<phase>
+        """
+        if not self.enabled:
+            return
+        for phase, record in (timing or dict()).items():
+            metrics[f"time/{phase}"] = record['seconds']
+            for rate in ('samples_per_s', 'steps_per_s'):
+                if rate in record:
+                    metrics[f"{rate}/{phase}"] = record[rate]
+        self._insert(iteration, None, metrics)
+
+
+def aggregate(metric, path=RESULTS_DB, env=None, model=None, config=None, epoch=None):
+    """
+    Mean and standard error of metric across the iterations of every (env, model, config), as in the final
+    summary of the run_*.py (std / sqrt(n)). env, model and config (a subset of the config keys) filter
+    the runs; epoch selects a per-epoch metric, otherwise the metrics of whole iterations are used.
+    """
+    query = ("SELECT runs.env, runs.model, runs.config, COUNT(*), AVG(metrics.value), AVG(metrics.value * metrics.value) "
+             "FROM metrics JOIN runs ON metrics.run = runs.id WHERE metrics.name = ? AND metrics.epoch IS ?")
+    params = [metric, epoch]
+    if env is not None:
+        query += " AND runs.env = ?"
+        params.append(env)
+    if model is not None:
+        query += " AND runs.model = ?"
+        params.append(model)
+    query += " GROUP BY runs.env, runs.model, runs.config ORDER BY runs.env, runs.model, runs.config"
+
+    connection = _connect(path)
+    rows = connection.execute(query, params).fetchall()
+    connection.close()
+
+    results = list()
+    for run_env, run_model, run_config, n, mean, mean_square in rows:
+        run_config = json.loads(run_config)
+        if config is not None and any(run_config.get(k) != v for k, v in config.items()):
+            continue
+        variance = max(mean_square - mean * mean, 0.)
+        results.append({'env': run_env, 'model': run_model, 'config': run_config,
+                        'n': n, 'mean': mean, 'se': math.sqrt(variance) / math.sqrt(n)})
+    return results
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Mean and standard error of a metric across the iterations of the stored runs")
+    parser.add_argument("metric", help="e.g. reward, accuracy, mse, running_loss, time/simulation")
+    parser.add_argument("--db", default=RESULTS_DB)
+    parser.add_argument("--env")
+    parser.add_argument("--model")
+    parser.add_argument("--epoch", type=int)
+    parser.add_argument("--config", default='{}', help='JSON subset of the config, e.g. \'{"NUM_PROTOTYPES": 6}\'')
+    args = parser.parse_args()
+
+    for row in aggregate(args.metric, args.db, args.env, args.model, json.loads(args.config), args.epoch):
+        print(f"{row['env']} {row['model']} {_config_key(row['config'])}: {row['mean']:.4f} +- {row['se']:.4f} (n={row['n']})")
@@ -4,7 +4,6 @@ import torch.nn as nn
 import numpy as np      
 import pickle
 import toml
-import cv2
 import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
@@ -30,9 +29,19 @@ from sklearn.cluster import KMeans, DBSCAN, OPTICS
 
 from random import sample
 from tqdm import tqdm
+from quantization import quantization_report
+from prototype_ops import l2_similarity
+from vector_simulation import simulate
+from offline_evaluation import held_out_loader, offline_fidelity
+from early_stop import SequentialStop
+from instrumentation import PhaseTimer
+from results_store import ResultsStore
 from time import sleep
 
 from collections import deque
+from replay_memory import FrameReplayMemory
+from preprocessing import FrameStack, to_model_input
+from bn_folding import FoldedDuelCNN
 
 NUM_ITERATIONS = 15
 NUM_EPOCHS = 100
@@ -45,6 +54,18 @@ DEVICE = 'cpu'
 delay_ms = 0
 NUM_PROTOTYPES = 6
 SIMULATION_EPOCHS = 30
+QUANTIZATION_REPORT = False  # compare the trained wrapper with its int8 copy before the simulation
+VECTOR_SIMULATION = False  # play the simulation episodes together on worker processes, batching the agent and the wrapper forward
+OFFLINE_EVALUATION = False  # fidelity on the held-out trajectories recorded by collect_data.py with HELD_OUT = True
+EARLY_STOP = False  # stop the simulation once the reward mean is known well enough (early_stop.SequentialStop)
+TIMING = False  # per-phase wall time and throughput to the SummaryWriter and a JSON summary in results/ (instrumentation.PhaseTimer), synchronizes CUDA at each phase boundary
+RESULTS_STORE = True  # epoch and iteration metrics (and the phase timings) in the SQLite results/results.db, see results_store.aggregate
+
+if VECTOR_SIMULATION and EARLY_STOP:
+    # the sequential test needs the episodes in the order they are played, the vector simulation ends the short ones first
+    raise ValueError("EARLY_STOP only applies to the sequential simulation, set VECTOR_SIMULATION = False")
+
+timer = PhaseTimer(enabled=TIMING)
 
 
 ENVIRONMENT = "PongDeterministic-v4"
@@ -53,6 +74,7 @@ SAVE_MODELS = False  # Save models to file so you can test later
 MODEL_PATH = "./models/pong-cnn-"  # Models path for saving or loading
 SAVE_MODEL_INTERVAL = 10  # Save models at every X epoch
 TRAIN_MODEL = False  # Train model while playing (Make it False when testing a model)
+FOLDED_INFERENCE = False  # Act with the eval-mode BatchNorm-folded copy of the loaded model (bn_folding.py) instead of the train-mode one
 LOAD_MODEL_FROM_FILE = True  # Load model from file
 LOAD_FILE_EPISODE = 900  # Load Xth episode from file
 BATCH_SIZE = 64  # Minibatch size that select randomly from mem for train nets
@@ -122,9 +144,10 @@ class DuelCNN(nn.Module):
 
 
 class Agent:
-    def __init__(self, environment):
+    def __init__(self, environment, replay_memory=TRAIN_MODEL):
         """
         Hyperparameters definition for Agent
+        replay_memory=False skips the replay memory entirely, when the agent only plays
         """
 
         # State size for breakout env. SS images (210, 160, 3). Used as input size in network
@@ -140,6 +163,8 @@ class Agent:
         self.target_w = 64  # Widht after process
 
         self.crop_dim = [20, self.state_size_h, 0, self.state_size_w]  # Cut 20 px from top to get rid of the score table
+        # frames cropped, grayscaled and resized, stacked by 4 as uint8 in a ring buffer
+        self.frames = FrameStack(self.target_h, self.target_w, self.crop_dim[0])
 
         # Trust rate to our experiences
         self.gamma = GAMMA  # Discount coef for future predictions
@@ -151,28 +176,27 @@ class Agent:
         self.epsilon_decay = EPSILON_DECAY  # Adaptive Epsilon Decay Rate
         self.epsilon_minimum = 0.05  # Minimum for Explore
 
-        # Deque holds replay mem.
-        self.memory = deque(maxlen=MAX_MEMORY_LEN)
+        # Replay mem. of uint8 frames, stacks rebuilt when sampled
+        self.memory = FrameReplayMemory(MAX_MEMORY_LEN, (self.target_w, self.target_h), device=DEVICE) if replay_memory else None
 
         # Create two model for DDQN algorithm
         self.online_model = DuelCNN(h=self.target_h, w=self.target_w, output_size=self.action_size).to(DEVICE)
         self.target_model = DuelCNN(h=self.target_h, w=self.target_w, output_size=self.action_size).to(DEVICE)
         self.target_model.load_state_dict(self.online_model.state_dict())
         self.target_model.eval()
+        self.inference_model = None  # FoldedDuelCNN of the online model, after fold_online_model
 
         # Adam used as optimizer
         self.optimizer = optim.Adam(self.online_model.parameters(), lr=self.alpha)
 
-    def preProcess(self, image):
+    def fold_online_model(self):
         """
-        Process image crop resize, grayscale and normalize the images
+        Act with the BatchNorm-folded eval-mode copy of the online model (fold again after changing its weights)
         """
-        frame = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)  # To grayscale
-        frame = frame[self.crop_dim[0]:self.crop_dim[1], self.crop_dim[2]:self.crop_dim[3]]  # Cut 20 px from top
-        frame = cv2.resize(frame, (self.target_w, self.target_h))  # Resize
-        frame = frame.reshape(self.target_w, self.target_h) / 255  # Normalize
+        self.inference_model = FoldedDuelCNN(self.online_model)
 
-        return frame
+    def acting_model(self):
+        return self.online_model if self.inference_model is None else self.inference_model
 
     def act(self, state):
         """
@@ -185,12 +209,12 @@ class Agent:
 
         if act_protocol == 'Explore':
             action = random.randrange(self.action_size)
-            state = torch.tensor(state, dtype=torch.float, device=DEVICE).unsqueeze(0)
-            q_values, x = self.online_model.forward(state)  # (1, action_size)
+            state = to_model_input(state, DEVICE).unsqueeze(0)
+            q_values, x = self.acting_model()(state)  # (1, action_size)
         else:
             with torch.no_grad():
-                state = torch.tensor(state, dtype=torch.float, device=DEVICE).unsqueeze(0)
-                q_values, x = self.online_model.forward(state)  # (1, action_size)
+                state = to_model_input(state, DEVICE).unsqueeze(0)
+                q_values, x = self.acting_model()(state)  # (1, action_size)
                 action = torch.argmax(q_values).item()  # Returns the indices of the maximum value of all elements
 
         return action, x
@@ -200,28 +224,16 @@ class Agent:
         Train neural nets with replay memory
         returns loss and max_q val predicted from online_net
         """
-        if len(agent.memory) < MIN_MEMORY_LEN:
+        if len(self.memory) < MIN_MEMORY_LEN:
             loss, max_q = [0, 0]
             return loss, max_q
-        # We get out minibatch and turn it to numpy array
-        state, action, reward, next_state, done = zip(*random.sample(self.memory, BATCH_SIZE))
-
-        # Concat batches in one array
-        # (np.arr, np.arr) ==> np.BIGarr
-        state = np.concatenate(state)
-        next_state = np.concatenate(next_state)
-
-        # Convert them to tensors
-        state = torch.tensor(state, dtype=torch.float, device=DEVICE)
-        next_state = torch.tensor(next_state, dtype=torch.float, device=DEVICE)
-        action = torch.tensor(action, dtype=torch.long, device=DEVICE)
-        reward = torch.tensor(reward, dtype=torch.float, device=DEVICE)
-        done = torch.tensor(done, dtype=torch.float, device=DEVICE)
+        # We get out minibatch as tensors on DEVICE
+        state, action, reward, next_state, done = self.memory.sample(BATCH_SIZE)
 
         # Make predictions
-        state_q_values = self.online_model(state)
-        next_states_q_values = self.online_model(next_state)
-        next_states_target_q_values = self.target_model(next_state)
+        state_q_values, _ = self.online_model(state)
+        next_states_q_values, _ = self.online_model(next_state)
+        next_states_target_q_values, _ = self.target_model(next_state)
 
         # Find selected action's q_value
         selected_q_value = state_q_values.gather(1, action.unsqueeze(1)).squeeze(1)
@@ -245,7 +257,8 @@ class Agent:
         """
         Store every result to memory
         """
-        self.memory.append([state[None, :], action, reward, nextState[None, :], done])
+        if self.memory is not None:
+            self.memory.push(state, action, reward, nextState, done)
 
     def adaptiveEpsilon(self):
         """
@@ -291,12 +304,10 @@ class PWNet(nn.Module):
             + incorrect_class_connection * negative_one_weights_locations)
         
     def __proto_layer_l2(self, x, p):
-        output = list()
         b_size = x.shape[0]
-        p = p.view(1, PROTOTYPE_SIZE).tile(b_size, 1).to(DEVICE) 
-        c = x.view(b_size, PROTOTYPE_SIZE).to(DEVICE)      
-        l2s = ( (c - p)**2 ).sum(axis=1).to(DEVICE) 
-        act = torch.log( (l2s + 1. ) / (l2s + self.epsilon) ).to(DEVICE)  
+        c = x.view(b_size, PROTOTYPE_SIZE)
+        # similarity function from Chen et al. 2019
+        act, _ = l2_similarity(c, p.view(1, PROTOTYPE_SIZE), self.epsilon)
         return act
     
     def __output_act_func(self, p_acts):        
@@ -325,6 +336,7 @@ class PWNet(nn.Module):
         return final_outputs
 
 
+@timer.timed('evaluate_loader')
 def evaluate_loader(model, loader, cce_loss):
     model.eval()
     total_correct = 0
@@ -380,6 +392,7 @@ if not os.path.exists(MODEL_DIR):
     os.makedirs(MODEL_DIR)
 
 #### Start Collecting Data To Form Final Mean and Standard Error Results
+store = ResultsStore('AtariPong', 'pwnet', dict(NUM_CLASSES=NUM_CLASSES, NUM_PROTOTYPES=NUM_PROTOTYPES, LATENT_SIZE=LATENT_SIZE, PROTOTYPE_SIZE=PROTOTYPE_SIZE, BATCH_SIZE=BATCH_SIZE, NUM_EPOCHS=NUM_EPOCHS), enabled=RESULTS_STORE)
 data_rewards = list()
 data_accuracy = list()
 
@@ -403,10 +416,13 @@ for iter in range(NUM_ITERATIONS):
         startEpisode = LOAD_FILE_EPISODE + 1
     else:
         startEpisode = 1
+    if FOLDED_INFERENCE:
+        agent.fold_online_model()
     last_100_ep_reward = deque(maxlen=100)  # Last 100 episode rewards
     total_step = 1  # Cumulkative sum of all steps in episodes
 
 
+    timer.start('data_load')
     with open('data/X_train.pkl', 'rb') as f:
         X_train = pickle.load(f)
     with open('data/a_train.pkl', 'rb') as f:
@@ -418,6 +434,7 @@ for iter in range(NUM_ITERATIONS):
     tensor_y = torch.tensor(a_train, dtype=torch.long)
     train_dataset = TensorDataset(tensor_x, tensor_y)
     train_loader = DataLoader(train_dataset, shuffle=True, batch_size=BATCH_SIZE)
+    timer.stop('data_load', samples=len(train_dataset))
 
     # Human defined Prototypes for interpretable model (these were gotten manually earlier)
     human_concepts = {'stay1':    [0.], 'stay2' :      [1.],
@@ -467,9 +484,12 @@ for iter in range(NUM_ITERATIONS):
         model.train()
         
         if current_acc > best_acc:
+            timer.start('checkpoint')
             torch.save(  model.state_dict(), MODEL_DIR_ITER)
+            timer.stop('checkpoint')
             best_acc = current_acc
         
+        timer.start('training_pass')
         for instances, labels in train_loader:
             
             optimizer.zero_grad()
@@ -485,10 +505,12 @@ for iter in range(NUM_ITERATIONS):
             optimizer.step()
             
             running_loss += loss.item()
+        timer.stop('training_pass', samples=len(train_dataset))
         
         print("Epoch:", epoch, "Running Loss:", running_loss / len(train_loader), "Current Accuracy :", current_acc)
         with open('results/pwnet_results.txt', 'a') as f:
             f.write(f"Epoch: {epoch}, Running Loss: {running_loss / len(train_loader)}, Current Accuracy: {current_acc}\n")
+        store.log_epoch(iter, epoch, running_loss=running_loss / len(train_loader), accuracy=current_acc)
             
         writer.add_scalar("Running_loss", running_loss/len(train_loader), epoch)
         writer.add_scalar("Current_accuracy", current_acc, epoch)
@@ -508,75 +530,98 @@ for iter in range(NUM_ITERATIONS):
     print("Final Accuracy... :", evaluate_loader(model, train_loader, cce_loss))
 
 
-    all_rewards = list()
-    all_acc = list()
-    for episode in range(SIMULATION_EPOCHS):
+    if OFFLINE_EVALUATION:
+        report = offline_fidelity(model, held_out_loader())
+        print("Held-out fidelity:", report)
+        with open('results/pwnet_results.txt', 'a') as f:
+            f.write(f"Held-out Accuracy: {report['accuracy']}, Accuracy per episode: {report['accuracy_episode']}\n")
 
-        startTime = time.time()  # Keep time
-        state = environment.reset()  # Reset env
+    if QUANTIZATION_REPORT:
+        report = quantization_report(model, train_loader)
+        print("Int8 wrapper:", report)
+        with open('results/pwnet_results.txt', 'a') as f:
+            f.write(f"Int8 Accuracy delta: {report['acc_delta']}, Step latency: {report['ms_float32']} ms -> {report['ms_int8']} ms\n")
 
-        state = agent.preProcess(state)  # Process image
+    all_rewards = list()
+    all_acc = list()
+    timer.start('simulation')
+    if VECTOR_SIMULATION:
+        all_rewards, matches, lengths = simulate(agent, model, SIMULATION_EPOCHS)
+        timer.add(steps=sum(lengths))
+        all_acc = [m / l for m, l in zip(matches, lengths)]
+    else:
+        stop = SequentialStop(max_episodes=SIMULATION_EPOCHS)
+        for episode in range(SIMULATION_EPOCHS):
 
-        # Stack state . Every state contains 4 time contionusly frames
-        # We stack frames like 4 channel image
-        state = np.stack((state, state, state, state))
+            startTime = time.time()  # Keep time
+            state = environment.reset()  # Reset env
 
-        total_max_q_val = 0  # Total max q vals
-        total_reward = 0     # Total reward for each episode
-        total_loss = 0       # Total loss for each episode
-        total_acc = list()
+            state = agent.frames.reset(state)  # Process image, stacked 4 times
 
-        for step in range(MAX_STEP):
+            total_max_q_val = 0  # Total max q vals
+            total_reward = 0     # Total reward for each episode
+            total_loss = 0       # Total loss for each episode
+            total_acc = list()
 
-            # Select and perform an action
-            agent_action, latent_x = agent.act(state)  # Act
-            action = torch.argmax(model(latent_x)).item()
+            for step in range(MAX_STEP):
 
-            # print(agent_action, action)
+                # Select and perform an action
+                agent_action, latent_x = agent.act(state)  # Act
+                action = torch.argmax(model(latent_x)).item()
 
-            # Normally the randomness is the number on the right (.049...)
-            # But as PW-Net is trained on the data from the original model which was already random
-            # we lower the randomness here for a fairer comparison.
-            # PW-Net here is trained on ~5% random data, plus 0.025 randomness
-            if np.random.random_sample() < .025:   #  .04953625663766238:
-                action = np.random.randint(0, 5)
+                # print(agent_action, action)
 
-            next_state, reward, done, info = environment.step(action)  # Observe
+                # Normally the randomness is the number on the right (.049...)
+                # But as PW-Net is trained on the data from the original model which was already random
+                # we lower the randomness here for a fairer comparison.
+                # PW-Net here is trained on ~5% random data, plus 0.025 randomness
+                if np.random.random_sample() < .025:   #  .04953625663766238:
+                    action = np.random.randint(0, 5)
 
-            next_state = agent.preProcess(next_state)  # Process image
+                next_state, reward, done, info = environment.step(action)  # Observe
+                timer.add(steps=1)
 
-            # Stack state . Every state contains 4 time contionusly frames
-            # We stack frames like 4 channel image
-            next_state = np.stack((next_state, state[0], state[1], state[2]))
+                next_state = agent.frames.push(next_state)  # Process image, on top of the last 3 of state
 
-            # Store the transition in memory
-            agent.storeResults(state, action, reward, next_state, done)  # Store to mem
+                # Store the transition in memory
+                agent.storeResults(state, action, reward, next_state, done)  # Store to mem
 
-            # Move to the next state
-            state = next_state  # Update state
+                # Move to the next state
+                state = next_state  # Update state
 
-            total_reward += reward
-            total_acc.append( agent_action == action )
+                total_reward += reward
+                total_acc.append( agent_action == action )
 
-            if done:
-                all_rewards.append(total_reward)
-                all_acc.append( sum(total_acc) / len(total_acc ) )
+                if done:
+                    all_rewards.append(total_reward)
+                    all_acc.append( sum(total_acc) / len(total_acc ) )
+                    break
+            if EARLY_STOP and stop.update(total_reward):
                 break
-
-    data_rewards.append(  sum(all_rewards) / SIMULATION_EPOCHS  )
-    data_accuracy.append(  sum(all_acc) / SIMULATION_EPOCHS  )
-    print("Reward: ", sum(all_rewards) / SIMULATION_EPOCHS)
-    print("Accuracy: ", sum(all_acc) / SIMULATION_EPOCHS )
+        if EARLY_STOP:
+            summary = stop.summary()
+            print("Early stop:", summary)
+            with open('results/pwnet_results.txt', 'a') as f:
+                f.write(f"Simulated episodes: {summary['episodes']}, saved: {summary['saved_episodes']} ({summary['reason']})\n")
+    timer.stop('simulation')
+    timer.log(writer, iter)
+
+    data_rewards.append(  sum(all_rewards) / len(all_rewards)  )
+    data_accuracy.append(  sum(all_acc) / len(all_acc)  )
+    store.log_iteration(iter, timer.last_iteration(), reward=data_rewards[-1], accuracy=data_accuracy[-1])
+    print("Reward: ", sum(all_rewards) / len(all_rewards))
+    print("Accuracy: ", sum(all_acc) / len(all_acc) )
 
     # log the reward and Acc
-    writer.add_scalar("Reward", sum(all_rewards) / SIMULATION_EPOCHS, iter)
-    writer.add_scalar("Accuracy", sum(all_acc) / SIMULATION_EPOCHS, iter)
+    writer.add_scalar("Reward", sum(all_rewards) / len(all_rewards), iter)
+    writer.add_scalar("Accuracy", sum(all_acc) / len(all_acc), iter)
 
     with open('results/pwnet_results.txt', 'a') as f:
-        f.write(f"Reward: {sum(all_rewards) / SIMULATION_EPOCHS}, Accuracy: {sum(all_acc) / SIMULATION_EPOCHS}\n")
+        f.write(f"Reward: {sum(all_rewards) / len(all_rewards)}, Accuracy: {sum(all_acc) / len(all_acc)}\n")
         
 data_accuracy = np.array(data_accuracy)
 data_rewards = np.array(data_rewards)
+timer.save('results/pwnet_timing.json')
 
 
 print(" ")
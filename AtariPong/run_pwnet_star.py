@@ -4,7 +4,6 @@ import torch.nn as nn
 import numpy as np      
 import pickle
 import toml
-import cv2
 import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
@@ -15,7 +14,6 @@ from torch.utils.tensorboard import SummaryWriter
 
 import os
 from PIL import Image
-from collections import Counter
 from copy import deepcopy
 from torch.utils.data import TensorDataset, DataLoader
 from argparse import ArgumentParser
@@ -30,9 +28,19 @@ from sklearn.cluster import KMeans
 
 from random import sample
 from tqdm import tqdm
+from quantization import quantization_report
+from prototype_ops import l2_similarity
+from vector_simulation import simulate
+from offline_evaluation import held_out_loader, offline_fidelity
+from early_stop import SequentialStop
+from instrumentation import PhaseTimer
+from results_store import ResultsStore
 from time import sleep
 
 from collections import deque
+from replay_memory import FrameReplayMemory
+from preprocessing import FrameStack, to_model_input
+from bn_folding import FoldedDuelCNN
 
 
 NUM_ITERATIONS = 15
@@ -45,6 +53,18 @@ BATCH_SIZE = 32
 delay_ms = 0
 NUM_PROTOTYPES = 6
 SIMULATION_EPOCHS = 30
+QUANTIZATION_REPORT = False  # compare the trained wrapper with its int8 copy before the simulation
+VECTOR_SIMULATION = False  # play the simulation episodes together on worker processes, batching the agent and the wrapper forward
+OFFLINE_EVALUATION = False  # fidelity on the held-out trajectories recorded by collect_data.py with HELD_OUT = True
+EARLY_STOP = False  # stop the simulation once the reward mean is known well enough (early_stop.SequentialStop)
+TIMING = False  # per-phase wall time and throughput to the SummaryWriter and a JSON summary in results/ (instrumentation.PhaseTimer), synchronizes CUDA at each phase boundary
+RESULTS_STORE = True  # epoch and iteration metrics (and the phase timings) in the SQLite results/results.db, see results_store.aggregate
+
+if VECTOR_SIMULATION and EARLY_STOP:
+    # the sequential test needs the episodes in the order they are played, the vector simulation ends the short ones first
+    raise ValueError("EARLY_STOP only applies to the sequential simulation, set VECTOR_SIMULATION = False")
+
+timer = PhaseTimer(enabled=TIMING)
 
 
 
@@ -54,6 +74,7 @@ SAVE_MODELS = False  # Save models to file so you can test later
 MODEL_PATH = "./models/pong-cnn-"  # Models path for saving or loading
 SAVE_MODEL_INTERVAL = 10  # Save models at every X epoch
 TRAIN_MODEL = False  # Train model while playing (Make it False when testing a model)
+FOLDED_INFERENCE = False  # Act with the eval-mode BatchNorm-folded copy of the loaded model (bn_folding.py) instead of the train-mode one
 LOAD_MODEL_FROM_FILE = True  # Load model from file
 LOAD_FILE_EPISODE = 900  # Load Xth episode from file
 BATCH_SIZE = 64  # Minibatch size that select randomly from mem for train nets
@@ -124,9 +145,10 @@ class DuelCNN(nn.Module):
 
 
 class Agent:
-    def __init__(self, environment):
+    def __init__(self, environment, replay_memory=TRAIN_MODEL):
         """
         Hyperparameters definition for Agent
+        replay_memory=False skips the replay memory entirely, when the agent only plays
         """
 
         # State size for breakout env. SS images (210, 160, 3). Used as input size in network
@@ -142,6 +164,8 @@ class Agent:
         self.target_w = 64  # Widht after process
 
         self.crop_dim = [20, self.state_size_h, 0, self.state_size_w]  # Cut 20 px from top to get rid of the score table
+        # frames cropped, grayscaled and resized, stacked by 4 as uint8 in a ring buffer
+        self.frames = FrameStack(self.target_h, self.target_w, self.crop_dim[0])
 
         # Trust rate to our experiences
         self.gamma = GAMMA  # Discount coef for future predictions
@@ -153,28 +177,27 @@ class Agent:
         self.epsilon_decay = EPSILON_DECAY  # Adaptive Epsilon Decay Rate
         self.epsilon_minimum = 0.05  # Minimum for Explore
 
-        # Deque holds replay mem.
-        self.memory = deque(maxlen=MAX_MEMORY_LEN)
+        # Replay mem. of uint8 frames, stacks rebuilt when sampled
+        self.memory = FrameReplayMemory(MAX_MEMORY_LEN, (self.target_w, self.target_h), device=DEVICE) if replay_memory else None
 
         # Create two model for DDQN algorithm
         self.online_model = DuelCNN(h=self.target_h, w=self.target_w, output_size=self.action_size).to(DEVICE)
         self.target_model = DuelCNN(h=self.target_h, w=self.target_w, output_size=self.action_size).to(DEVICE)
         self.target_model.load_state_dict(self.online_model.state_dict())
         self.target_model.eval()
+        self.inference_model = None  # FoldedDuelCNN of the online model, after fold_online_model
 
         # Adam used as optimizer
         self.optimizer = optim.Adam(self.online_model.parameters(), lr=self.alpha)
 
-    def preProcess(self, image):
+    def fold_online_model(self):
         """
-        Process image crop resize, grayscale and normalize the images
+        Act with the BatchNorm-folded eval-mode copy of the online model (fold again after changing its weights)
         """
-        frame = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)  # To grayscale
-        frame = frame[self.crop_dim[0]:self.crop_dim[1], self.crop_dim[2]:self.crop_dim[3]]  # Cut 20 px from top
-        frame = cv2.resize(frame, (self.target_w, self.target_h))  # Resize
-        frame = frame.reshape(self.target_w, self.target_h) / 255  # Normalize
+        self.inference_model = FoldedDuelCNN(self.online_model)
 
-        return frame
+    def acting_model(self):
+        return self.online_model if self.inference_model is None else self.inference_model
 
     def act(self, state):
         """
@@ -187,12 +210,12 @@ class Agent:
 
         if act_protocol == 'Explore':
             action = random.randrange(self.action_size)
-            state = torch.tensor(state, dtype=torch.float, device=DEVICE).unsqueeze(0)
-            q_values, x = self.online_model.forward(state)  # (1, action_size)
+            state = to_model_input(state, DEVICE).unsqueeze(0)
+            q_values, x = self.acting_model()(state)  # (1, action_size)
         else:
             with torch.no_grad():
-                state = torch.tensor(state, dtype=torch.float, device=DEVICE).unsqueeze(0)
-                q_values, x = self.online_model.forward(state)  # (1, action_size)
+                state = to_model_input(state, DEVICE).unsqueeze(0)
+                q_values, x = self.acting_model()(state)  # (1, action_size)
                 action = torch.argmax(q_values).item()  # Returns the indices of the maximum value of all elements
 
         return action, x
@@ -202,28 +225,16 @@ class Agent:
         Train neural nets with replay memory
         returns loss and max_q val predicted from online_net
         """
-        if len(agent.memory) < MIN_MEMORY_LEN:
+        if len(self.memory) < MIN_MEMORY_LEN:
             loss, max_q = [0, 0]
             return loss, max_q
-        # We get out minibatch and turn it to numpy array
-        state, action, reward, next_state, done = zip(*random.sample(self.memory, BATCH_SIZE))
-
-        # Concat batches in one array
-        # (np.arr, np.arr) ==> np.BIGarr
-        state = np.concatenate(state)
-        next_state = np.concatenate(next_state)
-
-        # Convert them to tensors
-        state = torch.tensor(state, dtype=torch.float, device=DEVICE)
-        next_state = torch.tensor(next_state, dtype=torch.float, device=DEVICE)
-        action = torch.tensor(action, dtype=torch.long, device=DEVICE)
-        reward = torch.tensor(reward, dtype=torch.float, device=DEVICE)
-        done = torch.tensor(done, dtype=torch.float, device=DEVICE)
+        # We get out minibatch as tensors on DEVICE
+        state, action, reward, next_state, done = self.memory.sample(BATCH_SIZE)
 
         # Make predictions
-        state_q_values = self.online_model(state)
-        next_states_q_values = self.online_model(next_state)
-        next_states_target_q_values = self.target_model(next_state)
+        state_q_values, _ = self.online_model(state)
+        next_states_q_values, _ = self.online_model(next_state)
+        next_states_target_q_values, _ = self.target_model(next_state)
 
         # Find selected action's q_value
         selected_q_value = state_q_values.gather(1, action.unsqueeze(1)).squeeze(1)
@@ -247,7 +258,8 @@ class Agent:
         """
         Store every result to memory
         """
-        self.memory.append([state[None, :], action, reward, nextState[None, :], done])
+        if self.memory is not None:
+            self.memory.push(state, action, reward, nextState, done)
 
     def adaptiveEpsilon(self):
         """
@@ -297,12 +309,10 @@ class PPNet(nn.Module):
             + incorrect_class_connection * negative_one_weights_locations)
         
     def __proto_layer_l2(self, x):
-        output = list()
         b_size = x.shape[0]
-        p = self.prototypes.T.view(1, PROTOTYPE_SIZE, NUM_PROTOTYPES).tile(b_size, 1, 1).to(DEVICE) 
-        c = x.view(b_size, PROTOTYPE_SIZE, 1).tile(1, 1, NUM_PROTOTYPES).to(DEVICE)            
-        l2s = ( (c - p)**2 ).sum(axis=1).to(DEVICE) 
-        act = torch.log( (l2s + 1. ) / (l2s + self.epsilon) ).to(DEVICE)   
+        c = x.view(b_size, PROTOTYPE_SIZE)
+        # similarity function from Chen et al. 2019
+        act, l2s = l2_similarity(c, self.prototypes, self.epsilon)
         return act, l2s
     
     def __output_act_func(self, p_acts):        
@@ -325,6 +335,7 @@ class PPNet(nn.Module):
         return final_outputs, x
 
 
+@timer.timed('evaluate_loader')
 def evaluate_loader(model, loader, cce_loss):
     model.eval()
     total_correct = 0
@@ -355,64 +366,40 @@ def trans_human_concepts(model, nn_human_x):
     return torch.cat(trans_nn_human_x, dim=0)
 
 
-def clust_loss(x, y, model, criterion):
+def clust_loss(x, y, model):
     """
     Forces each datapoint of a certain class to get closer to its prototype
+    x is the batch already transformed into the new feature space by the forward
     """
     
     p = model.prototypes  # take prototypes in new feature space
-    
-    model = model.eval()
-    x = model.main(x)  # transform into new feature space
-            
-    for idx, i in enumerate(Counter(y.cpu().numpy()).keys()):
-        x_sub = x[y==i]
-        target = p[i].repeat(len(x_sub), 1) 
-        
-        if idx == 0:
-            loss = criterion(x_sub, target) 
-        else:
-            loss += criterion(x_sub, target)
-            
-    model = model.train()
-        
-    return loss
+    counts = torch.bincount(y, minlength=NUM_CLASSES)
+    present = counts > 0
+
+    # MSE of each datapoint to the prototype of its class, averaged per class and summed over the classes in the batch
+    dist = ((x - p[y])**2).mean(dim=1)
+    class_dist = torch.zeros(NUM_CLASSES, device=x.device).index_add_(0, y, dist)
+    return (class_dist[present] / counts[present]).sum()
 
 
-def sep_loss(x, y, model, criterion):
+def sep_loss(x, y, model):
     """
     Take the distance of each training instance to each prototype NOT of its own class
     Sums them up and returns a negative distance to minimize
     """
     
-    p = model.prototypes  # take prototypes in new feature space
-
-    model = model.eval()
-    x = model.main(x)  # transform into new feature space
-
-    loss = criterion(x, x)
+    p = model.prototypes[:NUM_CLASSES]  # take prototypes in new feature space
+    counts = torch.bincount(y, minlength=NUM_CLASSES)
+    present = counts > 0
 
-    # Iterate each prototype
-    for idx1, i in enumerate(Counter(y.cpu().numpy()).keys()):
+    # MSE of each datapoint to each prototype, averaged over the datapoints of each class: [class of x, prototype]
+    dist = ((x.unsqueeze(1) - p.unsqueeze(0))**2).mean(dim=2)
+    class_dist = torch.zeros(NUM_CLASSES, NUM_CLASSES, device=x.device).index_add_(0, y, dist)
+    class_dist = class_dist / counts.clamp(min=1).unsqueeze(1)
 
-        # select all training data aligned with that prototype
-        x_sub = x[y==i]
-
-        # Iterate all other prototypes
-        for idx2, j in enumerate(Counter(y.cpu().numpy()).keys()):
-
-            if i == j:
-                continue
-
-            # Select other prototype
-            target = p[j].repeat(len(x_sub), 1) 
-
-            # Take distance loss of training data to other prototypes
-            loss += criterion(x_sub, target)
-
-    model = model.train()
-
-    return -loss / len(Counter(y.cpu().numpy()).keys())**2
+    # only pairs of different classes that are both in the batch
+    other_class = present.unsqueeze(1) & present.unsqueeze(0) & ~torch.eye(NUM_CLASSES, dtype=torch.bool, device=x.device)
+    return -class_dist[other_class].sum() / present.sum()**2
 
 if not os.path.exists('results/'):
     os.makedirs('results/')
@@ -423,6 +410,7 @@ with open('results/pwnet_star_results.txt', 'a') as f:
     f.write(f"NUM_PROTOTYPES: {NUM_PROTOTYPES}\n")
     
 #### Start Collecting Data To Form Final Mean and Standard Error Results
+store = ResultsStore('AtariPong', 'pwnet_star', dict(NUM_CLASSES=NUM_CLASSES, NUM_PROTOTYPES=NUM_PROTOTYPES, LATENT_SIZE=LATENT_SIZE, PROTOTYPE_SIZE=PROTOTYPE_SIZE, BATCH_SIZE=BATCH_SIZE, NUM_EPOCHS=NUM_EPOCHS), enabled=RESULTS_STORE)
 data_rewards = list()
 data_accuracy = list()
 
@@ -454,10 +442,13 @@ for iter in range(NUM_ITERATIONS):
         startEpisode = LOAD_FILE_EPISODE + 1
     else:
         startEpisode = 1
+    if FOLDED_INFERENCE:
+        agent.fold_online_model()
     last_100_ep_reward = deque(maxlen=100)  # Last 100 episode rewards
     total_step = 1  # Cumulkative sum of all steps in episodes
 
 
+    timer.start('data_load')
     with open('data/X_train.pkl', 'rb') as f:
         X_train = pickle.load(f)
     with open('data/a_train.pkl', 'rb') as f:
@@ -471,6 +462,7 @@ for iter in range(NUM_ITERATIONS):
     tensor_y = torch.tensor(a_train, dtype=torch.long)
     train_dataset = TensorDataset(tensor_x, tensor_y)
     train_loader = DataLoader(train_dataset, shuffle=True, batch_size=BATCH_SIZE)
+    timer.stop('data_load', samples=len(train_dataset))
 
 
     #### Train Wrapper
@@ -500,29 +492,34 @@ for iter in range(NUM_ITERATIONS):
         model.train()
         
         if current_acc > best_acc:
+            timer.start('checkpoint')
             torch.save(model.state_dict(), MODEL_DIR_ITER)
+            timer.stop('checkpoint')
             best_acc = current_acc
         
+        timer.start('training_pass')
         for instances, labels in train_loader:
             
             optimizer.zero_grad()
                     
             instances, labels = instances.to(DEVICE), labels.to(DEVICE)
-            logits, _ = model(instances)
+            logits, x = model(instances)
                     
             loss1 = cce_loss(logits, labels) * lambda1
-            loss2 = clust_loss(instances, labels, model, mse_loss) * lambda2
-            loss3 = sep_loss(instances, labels, model, mse_loss) * lambda3
+            loss2 = clust_loss(x, labels, model) * lambda2
+            loss3 = sep_loss(x, labels, model) * lambda3
             
             loss  = loss1 + loss2 + loss3
                     
             loss.backward()
             optimizer.step()
             running_loss += loss.item()
+        timer.stop('training_pass', samples=len(train_dataset))
             
         print("Epoch:", epoch, "Running Loss:", running_loss / len(train_loader), "Current Accuracy:", current_acc)
         with open('results/pwnet_star_results.txt', 'a') as f:
             f.write(f"Epoch: {epoch}, Running Loss: {running_loss / len(train_loader)}, Current Accuracy: {current_acc}\n")
+        store.log_epoch(iter, epoch, running_loss=running_loss / len(train_loader), accuracy=current_acc)
         
         writer.add_scalar("Running_loss", running_loss/len(train_loader), epoch)
         writer.add_scalar("Current_accuracy", current_acc, epoch)
@@ -534,6 +531,7 @@ for iter in range(NUM_ITERATIONS):
     model = PPNet().eval()
     model.load_state_dict(torch.load(MODEL_DIR_ITER))
     
+    timer.start('projection')
     trans_x = list()
     model.eval()
     with torch.no_grad():    
@@ -569,72 +567,98 @@ for iter in range(NUM_ITERATIONS):
     real_trans_x = nn_xs
     real_trans_x = torch.tensor( real_trans_x, dtype=torch.float32 )
     model.prototypes = torch.nn.Parameter(torch.tensor(real_trans_x.to(DEVICE), dtype=torch.float32))
+    timer.stop('projection', samples=len(X_train))
+    timer.start('checkpoint')
     torch.save(model.state_dict(), MODEL_DIR_ITER)
+    timer.stop('checkpoint')
 
     model.to(DEVICE)
-    all_acc = list()
-    all_rewards = list()
-    for episode in range(SIMULATION_EPOCHS):
+    if OFFLINE_EVALUATION:
+        report = offline_fidelity(model, held_out_loader())
+        print("Held-out fidelity:", report)
+        with open('results/pwnet_star_results.txt', 'a') as f:
+            f.write(f"Held-out Accuracy: {report['accuracy']}, Accuracy per episode: {report['accuracy_episode']}\n")
 
-        startTime = time.time()  # Keep time
-        state = environment.reset()  # Reset env
+    if QUANTIZATION_REPORT:
+        report = quantization_report(model, train_loader)
+        print("Int8 wrapper:", report)
+        with open('results/pwnet_star_results.txt', 'a') as f:
+            f.write(f"Int8 Accuracy delta: {report['acc_delta']}, Step latency: {report['ms_float32']} ms -> {report['ms_int8']} ms\n")
 
-        state = agent.preProcess(state)  # Process image
+    all_acc = list()
+    all_rewards = list()
+    timer.start('simulation')
+    if VECTOR_SIMULATION:
+        all_rewards, matches, lengths = simulate(agent, model, SIMULATION_EPOCHS)
+        timer.add(steps=sum(lengths))
+        all_acc = [m / l for m, l in zip(matches, lengths)]
+    else:
+        stop = SequentialStop(max_episodes=SIMULATION_EPOCHS)
+        for episode in range(SIMULATION_EPOCHS):
 
-        # Stack state . Every state contains 4 time contionusly frames
-        # We stack frames like 4 channel image
-        state = np.stack((state, state, state, state))
+            startTime = time.time()  # Keep time
+            state = environment.reset()  # Reset env
 
-        total_max_q_val = 0  # Total max q vals
-        total_reward = 0     # Total reward for each episode
-        total_loss = 0       # Total loss for each episode
-        total_acc = list()
-        for step in range(MAX_STEP):
+            state = agent.frames.reset(state)  # Process image, stacked 4 times
 
+            total_max_q_val = 0  # Total max q vals
+            total_reward = 0     # Total reward for each episode
+            total_loss = 0       # Total loss for each episode
+            total_acc = list()
+            for step in range(MAX_STEP):
 
-            # Select and perform an action
-            agent_action, latent_x = agent.act(state)  # Act
-            action = torch.argmax(model(latent_x.to(DEVICE))[0]).item()
 
-            if np.random.random_sample() < .04953625663766238:
-                action = np.random.randint(0, 5)
+                # Select and perform an action
+                agent_action, latent_x = agent.act(state)  # Act
+                action = torch.argmax(model(latent_x.to(DEVICE))[0]).item()
 
-            next_state, reward, done, info = environment.step(action)  # Observe
+                if np.random.random_sample() < .04953625663766238:
+                    action = np.random.randint(0, 5)
 
-            next_state = agent.preProcess(next_state)  # Process image
+                next_state, reward, done, info = environment.step(action)  # Observe
+                timer.add(steps=1)
 
-            # Stack state . Every state contains 4 time contionusly frames
-            # We stack frames like 4 channel image
-            next_state = np.stack((next_state, state[0], state[1], state[2]))
+                next_state = agent.frames.push(next_state)  # Process image, on top of the last 3 of state
 
-            # Store the transition in memory
-            agent.storeResults(state, action, reward, next_state, done)  # Store to mem
+                # Store the transition in memory
+                agent.storeResults(state, action, reward, next_state, done)  # Store to mem
 
-            # Move to the next state
-            state = next_state  # Update state
+                # Move to the next state
+                state = next_state  # Update state
 
-            total_reward += reward
-            total_acc.append( agent_action == action )
+                total_reward += reward
+                total_acc.append( agent_action == action )
 
-            if done:
-                all_rewards.append(total_reward)
-                all_acc.append( sum(total_acc) / len(total_acc ) )
+                if done:
+                    all_rewards.append(total_reward)
+                    all_acc.append( sum(total_acc) / len(total_acc ) )
+                    break
+            if EARLY_STOP and stop.update(total_reward):
                 break
-
-    data_rewards.append(  sum(all_rewards) / SIMULATION_EPOCHS  )
-    data_accuracy.append(  sum(all_acc) / SIMULATION_EPOCHS  )
+        if EARLY_STOP:
+            summary = stop.summary()
+            print("Early stop:", summary)
+            with open('results/pwnet_star_results.txt', 'a') as f:
+                f.write(f"Simulated episodes: {summary['episodes']}, saved: {summary['saved_episodes']} ({summary['reason']})\n")
+    timer.stop('simulation')
+    timer.log(writer, iter)
+
+    data_rewards.append(  sum(all_rewards) / len(all_rewards)  )
+    data_accuracy.append(  sum(all_acc) / len(all_acc)  )
+    store.log_iteration(iter, timer.last_iteration(), reward=data_rewards[-1], accuracy=data_accuracy[-1])
     print("Reward:", data_rewards)
     print("Accuracy:", data_accuracy)
     
     # log the reward and Acc
-    writer.add_scalar("Reward", sum(all_rewards) / SIMULATION_EPOCHS, iter)
-    writer.add_scalar("Accuracy", sum(all_acc) / SIMULATION_EPOCHS, iter)
+    writer.add_scalar("Reward", sum(all_rewards) / len(all_rewards), iter)
+    writer.add_scalar("Accuracy", sum(all_acc) / len(all_acc), iter)
     
     with open('results/pwnet_star_results.txt', 'a') as f:
-        f.write(f"Reward: {sum(all_rewards) / SIMULATION_EPOCHS}, Accuracy: {sum(all_acc) / SIMULATION_EPOCHS}\n")
+        f.write(f"Reward: {sum(all_rewards) / len(all_rewards)}, Accuracy: {sum(all_acc) / len(all_acc)}\n")
 
 data_accuracy = np.array(data_accuracy)
 data_rewards = np.array(data_rewards)
+timer.save('results/pwnet_star_timing.json')
 
 
 print(" ")
@@ -4,7 +4,6 @@ import torch.nn as nn
 import numpy as np      
 import pickle
 import toml
-import cv2
 import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
@@ -34,10 +33,22 @@ from sklearn.cluster import KMeans, DBSCAN, OPTICS
 
 from random import sample
 from tqdm import tqdm
+from quantization import quantization_report
+from sparse_sharedpwnet import SparseSharedPwNet
+from prototype_ops import l2_similarity
+from vector_simulation import simulate
+from offline_evaluation import held_out_loader, offline_fidelity
+from early_stop import SequentialStop
+from instrumentation import PhaseTimer
+from results_store import ResultsStore
+from pipeline_cache import PipelineCache
 from time import sleep
 import datetime
 
 from collections import deque
+from replay_memory import FrameReplayMemory
+from preprocessing import FrameStack, to_model_input
+from bn_folding import FoldedDuelCNN
 
 parser = argparse.ArgumentParser()
 
@@ -59,6 +70,21 @@ PROTOTYPE_SIZE = 50
 BATCH_SIZE = 32
 delay_ms = 0
 SIMULATION_EPOCHS = 30
+QUANTIZATION_REPORT = False  # compare the trained wrapper with its int8 copy before the simulation
+SPARSE_INFERENCE = False  # simulate with the hard-assignment model, computing only the used prototypes
+VECTOR_SIMULATION = False  # play the simulation episodes together on worker processes, batching the agent and the wrapper forward
+OFFLINE_EVALUATION = False  # fidelity on the held-out trajectories recorded by collect_data.py with HELD_OUT = True
+EARLY_STOP = False  # stop the simulation once the reward mean is known well enough (early_stop.SequentialStop)
+TIMING = False  # per-phase wall time and throughput to the SummaryWriter and a JSON summary in results/ (instrumentation.PhaseTimer), synchronizes CUDA at each phase boundary
+RESULTS_STORE = True  # epoch and iteration metrics (and the phase timings) in the SQLite results/results.db, see results_store.aggregate
+PIPELINE_CACHE = False  # skip the init, train and simulation stages whose inputs are unchanged, restoring their outputs from cache/ (pipeline_cache.PipelineCache)
+
+if VECTOR_SIMULATION and EARLY_STOP:
+    # the sequential test needs the episodes in the order they are played, the vector simulation ends the short ones first
+    raise ValueError("EARLY_STOP only applies to the sequential simulation, set VECTOR_SIMULATION = False")
+
+timer = PhaseTimer(enabled=TIMING)
+cache = PipelineCache(enabled=PIPELINE_CACHE)
 
 ENVIRONMENT = "PongDeterministic-v4"
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -66,6 +92,7 @@ SAVE_MODELS = False  # Save models to file so you can test later
 MODEL_PATH = "./models/pong-cnn-"  # Models path for saving or loading
 SAVE_MODEL_INTERVAL = 10  # Save models at every X epoch
 TRAIN_MODEL = False  # Train model while playing (Make it False when testing a model)
+FOLDED_INFERENCE = False  # Act with the eval-mode BatchNorm-folded copy of the loaded model (bn_folding.py) instead of the train-mode one
 LOAD_MODEL_FROM_FILE = True  # Load model from file
 LOAD_FILE_EPISODE = 900  # Load Xth episode from file
 BATCH_SIZE = 64  # Minibatch size that select randomly from mem for train nets
@@ -138,9 +165,10 @@ class DuelCNN(nn.Module):
         return q, x
 
 class Agent:
-    def __init__(self, environment):
+    def __init__(self, environment, replay_memory=TRAIN_MODEL):
         """
         Hyperparameters definition for Agent
+        replay_memory=False skips the replay memory entirely, when the agent only plays
         """
 
         # State size for breakout env. SS images (210, 160, 3). Used as input size in network
@@ -156,6 +184,8 @@ class Agent:
         self.target_w = 64  # Widht after process
 
         self.crop_dim = [20, self.state_size_h, 0, self.state_size_w]  # Cut 20 px from top to get rid of the score table
+        # frames cropped, grayscaled and resized, stacked by 4 as uint8 in a ring buffer
+        self.frames = FrameStack(self.target_h, self.target_w, self.crop_dim[0])
 
         # Trust rate to our experiences
         self.gamma = GAMMA  # Discount coef for future predictions
@@ -167,28 +197,27 @@ class Agent:
         self.epsilon_decay = EPSILON_DECAY  # Adaptive Epsilon Decay Rate
         self.epsilon_minimum = 0.05  # Minimum for Explore
 
-        # Deque holds replay mem.
-        self.memory = deque(maxlen=MAX_MEMORY_LEN)
+        # Replay mem. of uint8 frames, stacks rebuilt when sampled
+        self.memory = FrameReplayMemory(MAX_MEMORY_LEN, (self.target_w, self.target_h), device=DEVICE) if replay_memory else None
 
         # Create two model for DDQN algorithm
         self.online_model = DuelCNN(h=self.target_h, w=self.target_w, output_size=self.action_size).to(DEVICE)
         self.target_model = DuelCNN(h=self.target_h, w=self.target_w, output_size=self.action_size).to(DEVICE)
         self.target_model.load_state_dict(self.online_model.state_dict())
         self.target_model.eval()
+        self.inference_model = None  # FoldedDuelCNN of the online model, after fold_online_model
 
         # Adam used as optimizer
         self.optimizer = optim.Adam(self.online_model.parameters(), lr=self.alpha)
 
-    def preProcess(self, image):
+    def fold_online_model(self):
         """
-        Process image crop resize, grayscale and normalize the images
+        Act with the BatchNorm-folded eval-mode copy of the online model (fold again after changing its weights)
         """
-        frame = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)  # To grayscale
-        frame = frame[self.crop_dim[0]:self.crop_dim[1], self.crop_dim[2]:self.crop_dim[3]]  # Cut 20 px from top
-        frame = cv2.resize(frame, (self.target_w, self.target_h))  # Resize
-        frame = frame.reshape(self.target_w, self.target_h) / 255  # Normalize
+        self.inference_model = FoldedDuelCNN(self.online_model)
 
-        return frame
+    def acting_model(self):
+        return self.online_model if self.inference_model is None else self.inference_model
 
     def act(self, state):
         """
@@ -201,12 +230,12 @@ class Agent:
 
         if act_protocol == 'Explore':
             action = random.randrange(self.action_size)
-            state = torch.tensor(state, dtype=torch.float, device=DEVICE).unsqueeze(0)
-            q_values, x = self.online_model.forward(state)  # (1, action_size)
+            state = to_model_input(state, DEVICE).unsqueeze(0)
+            q_values, x = self.acting_model()(state)  # (1, action_size)
         else:
             with torch.no_grad():
-                state = torch.tensor(state, dtype=torch.float, device=DEVICE).unsqueeze(0)
-                q_values, x = self.online_model.forward(state)  # (1, action_size)
+                state = to_model_input(state, DEVICE).unsqueeze(0)
+                q_values, x = self.acting_model()(state)  # (1, action_size)
                 action = torch.argmax(q_values).item()  # Returns the indices of the maximum value of all elements
 
         return action, x
@@ -216,28 +245,16 @@ class Agent:
         Train neural nets with replay memory
         returns loss and max_q val predicted from online_net
         """
-        if len(agent.memory) < MIN_MEMORY_LEN:
+        if len(self.memory) < MIN_MEMORY_LEN:
             loss, max_q = [0, 0]
             return loss, max_q
-        # We get out minibatch and turn it to numpy array
-        state, action, reward, next_state, done = zip(*random.sample(self.memory, BATCH_SIZE))
-
-        # Concat batches in one array
-        # (np.arr, np.arr) ==> np.BIGarr
-        state = np.concatenate(state)
-        next_state = np.concatenate(next_state)
-
-        # Convert them to tensors
-        state = torch.tensor(state, dtype=torch.float, device=DEVICE)
-        next_state = torch.tensor(next_state, dtype=torch.float, device=DEVICE)
-        action = torch.tensor(action, dtype=torch.long, device=DEVICE)
-        reward = torch.tensor(reward, dtype=torch.float, device=DEVICE)
-        done = torch.tensor(done, dtype=torch.float, device=DEVICE)
+        # We get out minibatch as tensors on DEVICE
+        state, action, reward, next_state, done = self.memory.sample(BATCH_SIZE)
 
         # Make predictions
-        state_q_values = self.online_model(state)
-        next_states_q_values = self.online_model(next_state)
-        next_states_target_q_values = self.target_model(next_state)
+        state_q_values, _ = self.online_model(state)
+        next_states_q_values, _ = self.online_model(next_state)
+        next_states_target_q_values, _ = self.target_model(next_state)
 
         # Find selected action's q_value
         selected_q_value = state_q_values.gather(1, action.unsqueeze(1)).squeeze(1)
@@ -261,7 +278,8 @@ class Agent:
         """
         Store every result to memory
         """
-        self.memory.append([state[None, :], action, reward, nextState[None, :], done])
+        if self.memory is not None:
+            self.memory.push(state, action, reward, nextState, done)
 
     def adaptiveEpsilon(self):
         """
@@ -296,36 +314,44 @@ def normalize_list(values):
 # actions space= [0,1,2,3,4,5]
 
 # qui mappo stato e azione corrispondente del dataset 
-action_states = {}
-for action_id in range(NUM_CLASSES):
-    action_states[action_id] = []
+DATASET_FILES = ['data/X_train.pkl', 'data/a_train.pkl']  # inputs of the cached init and train stages
+init_key = cache.key('init', files=DATASET_FILES, config=dict(NUM_CLASSES=NUM_CLASSES, NUM_SLOTS_PER_CLASS=NUM_SLOTS_PER_CLASS))
+if cache.done('init', init_key):
+    prototypes = list(cache.load('init', init_key)['centres'])
+else:
+    action_states = {}
+    for action_id in range(NUM_CLASSES):
+        action_states[action_id] = []
     
-    for state, action in zip(X_train, a_train):
-        if action == action_id:
-            action_states[action_id].append(state)
+        for state, action in zip(X_train, a_train):
+            if action == action_id:
+                action_states[action_id].append(state)
         
-'''state_actions = {}
-for action_id in range(NUM_CLASSES): 						
-	state_actions[action_id] = []						
+    '''state_actions = {}
+    for action_id in range(NUM_CLASSES): 						
+        state_actions[action_id] = []						
 
-	action_values = [x[1][action_id] for x in states_actions_zip]   
+        action_values = [x[1][action_id] for x in states_actions_zip]   
 
-	median = medians[action_id]
+        median = medians[action_id]
         
-	diff = [np.abs(p-median) for p in action_values]
-	normalized_diff = normalize_list(diff)
+        diff = [np.abs(p-median) for p in action_values]
+        normalized_diff = normalize_list(diff)
 
-	probs_50_perc = np.percentile(normalized_diff, 50)			
+        probs_50_perc = np.percentile(normalized_diff, 50)			
 
-	for (state, action), action_probs in zip(states_actions_zip, normalized_diff):
-		if action_probs > probs_50_perc:
-			state_actions[action_id].append(state)		# state_actions = {0: [stato1>50,stato2>50, stato3>50, ...]  1: , 2: }
-'''
+        for (state, action), action_probs in zip(states_actions_zip, normalized_diff):
+            if action_probs > probs_50_perc:
+                state_actions[action_id].append(state)		# state_actions = {0: [stato1>50,stato2>50, stato3>50, ...]  1: , 2: }
+    '''
 
-prototypes = []
+    timer.start('init_kmeans')
+    prototypes = []
 
-for action_id in range(NUM_CLASSES):
-	prototypes.append(KMeans(NUM_SLOTS_PER_CLASS, n_init="auto").fit(action_states[action_id]).cluster_centers_)   # prototypes = [[p11,p12,p13],[p21,p22,p23],[p31,p32,p33],]
+    for action_id in range(NUM_CLASSES):
+        prototypes.append(KMeans(NUM_SLOTS_PER_CLASS, n_init="auto").fit(action_states[action_id]).cluster_centers_)   # prototypes = [[p11,p12,p13],[p21,p22,p23],[p31,p32,p33],]
+    timer.stop('init_kmeans')
+    cache.save('init', init_key, centres=np.array(prototypes))
 
 ordered_prototypes = []
 
@@ -379,12 +405,9 @@ class SharedPwNet(nn.Module):
             transf_proto.append(self.projection_network(self.prototypes[i].view(1, -1)))
         latent_protos = torch.cat(transf_proto, dim=0) 
         
-        p = latent_protos.T.view(1, PROTOTYPE_SIZE, NUM_PROTOTYPES).tile(b_size, 1, 1).to(DEVICE) 
-        c = x.view(b_size, PROTOTYPE_SIZE, 1).tile(1, 1, NUM_PROTOTYPES).to(DEVICE)    
-                
-        l2s = ( (c - p)**2 ).sum(axis=1).to(DEVICE) 
+        c = x.view(b_size, PROTOTYPE_SIZE)
         # similarity function from Chen et al. 2019: to score the distance between state c and prototype p
-        similarity = torch.log( (l2s + 1. ) / (l2s + self.epsilon) ).to(DEVICE)  
+        similarity, _ = l2_similarity(c, latent_protos, self.epsilon)
         return similarity # (batch, NUM_PROTOTYPES)
     
     def output_activations(self, out):
@@ -410,6 +433,7 @@ class SharedPwNet(nn.Module):
         return out2, x, similarity, proto_presence
     
     
+@timer.timed('evaluate_loader')
 def evaluate_loader(model, gumbel_scalar, loader, cce_loss, tau):
     model.eval()
     total_correct = 0
@@ -467,6 +491,7 @@ with open(results_file, 'a') as f:
     f.write(f"NUM_PROTOTYPES: {NUM_PROTOTYPES}\n")
     f.write(f"NUM_SLOTS: {NUM_SLOTS_PER_CLASS}\n")
         
+store = ResultsStore('AtariPong', 'sharedpwnet', dict(NUM_CLASSES=NUM_CLASSES, NUM_PROTOTYPES=NUM_PROTOTYPES, NUM_SLOTS_PER_CLASS=NUM_SLOTS_PER_CLASS, new_proto_init=args.new_proto_init, LATENT_SIZE=LATENT_SIZE, PROTOTYPE_SIZE=PROTOTYPE_SIZE, BATCH_SIZE=BATCH_SIZE, NUM_EPOCHS=NUM_EPOCHS), enabled=RESULTS_STORE)
 data_rewards = list()
 data_accuracy = list()
 
@@ -502,16 +527,20 @@ for iter in range(NUM_ITERATIONS):
         startEpisode = LOAD_FILE_EPISODE + 1
     else:
         startEpisode = 1
+    if FOLDED_INFERENCE:
+        agent.fold_online_model()
     last_100_ep_reward = deque(maxlen=100)  # Last 100 episode rewards
     total_step = 1  # Cumulkative sum of all steps in episodes
 
     
     X_train = np.array(X_train)
     a_train = np.array(a_train)
+    timer.start('data_load')
     tensor_x = torch.Tensor(X_train)
     tensor_y = torch.tensor(a_train, dtype=torch.long)
     train_dataset = TensorDataset(tensor_x.to(DEVICE), tensor_y.to(DEVICE))
     train_loader = DataLoader(train_dataset, shuffle=True, batch_size=BATCH_SIZE)
+    timer.stop('data_load', samples=len(train_dataset))
         
     #### Train
     model = SharedPwNet().eval()
@@ -535,139 +564,152 @@ for iter in range(NUM_ITERATIONS):
     '''
     running_loss = running_loss_mse = running_loss_clst = running_loss_sep = running_loss_l1 =  running_loss_ortho = 0.
 
-    for epoch in range(NUM_EPOCHS):
+    train_key = cache.key('train', files=DATASET_FILES, config=dict(NUM_EPOCHS=NUM_EPOCHS, BATCH_SIZE=BATCH_SIZE, NUM_PROTOTYPES=NUM_PROTOTYPES, PROTOTYPE_SIZE=PROTOTYPE_SIZE, clst_weight=clst_weight, sep_weight=sep_weight, l1_weight=l1_weight, start_val=start_val, end_val=end_val, epoch_interval=epoch_interval, new_proto_init=args.new_proto_init, iteration=iter), code=[SharedPwNet, dist_loss, lambda1, evaluate_loader, cache.module_source(l2_similarity), cache.stage_source(__file__, 'train')], upstream=[init_key])
+    if cache.done('train', train_key):
+        schedule = cache.load('train', train_key, files=[MODEL_DIR_ITER], directories=[prototype_path])
+        gumbel_scalar, tau = schedule['gumbel_scalar'], schedule['tau']
+    else:
+        for epoch in range(NUM_EPOCHS):
 
-        model.eval()
-        gumbel_scalar = lambda1(epoch)
+            model.eval()
+            gumbel_scalar = lambda1(epoch)
         
-        if epoch == 0:
-            tau = 1
-        elif (epoch + 1) % 8 == 0 and tau > 0.3:
-            tau = 0.8 * tau   
+            if epoch == 0:
+                tau = 1
+            elif (epoch + 1) % 8 == 0 and tau > 0.3:
+                tau = 0.8 * tau   
             
-        current_acc = evaluate_loader(model, gumbel_scalar, train_loader, cce_loss, tau)
-        model.train()
+            current_acc = evaluate_loader(model, gumbel_scalar, train_loader, cce_loss, tau)
+            model.train()
 
-        if current_acc > best_acc and epoch > NUM_EPOCHS-20:
-            torch.save(model.state_dict(), MODEL_DIR_ITER) # saves model parameters
-            best_acc = current_acc
+            if current_acc > best_acc and epoch > NUM_EPOCHS-20:
+                timer.start('checkpoint')
+                torch.save(model.state_dict(), MODEL_DIR_ITER) # saves model parameters
+                timer.stop('checkpoint')
+                best_acc = current_acc
         
-        # prototype projection every 2 epochs
-        if epoch >= 10 and epoch % 2 == 0 and epoch < NUM_EPOCHS-20:
-            #print("Projecting prototypes...")
-            transformed_x = list()
-            model.eval()
-            with torch.no_grad():
-                for i in range(len(X_train)):
-                    img = X_train[i]
-                    img_tensor = torch.tensor(img, dtype=torch.float32).view(1, -1) # (1, 256)
-                    _, x, _, _ = model(img_tensor.to(DEVICE), gumbel_scalar, tau)
-                    # x è lo stato s dopo la projection network
-                    transformed_x.append(x[0].tolist())
-            transformed_x = np.array(transformed_x)
+            # prototype projection every 2 epochs
+            if epoch >= 10 and epoch % 2 == 0 and epoch < NUM_EPOCHS-20:
+                #print("Projecting prototypes...")
+                timer.start('projection')
+                transformed_x = list()
+                model.eval()
+                with torch.no_grad():
+                    for i in range(len(X_train)):
+                        img = X_train[i]
+                        img_tensor = torch.tensor(img, dtype=torch.float32).view(1, -1) # (1, 256)
+                        _, x, _, _ = model(img_tensor.to(DEVICE), gumbel_scalar, tau)
+                        # x è lo stato s dopo la projection network
+                        transformed_x.append(x[0].tolist())
+                transformed_x = np.array(transformed_x)
             
-            list_projected_prototype = list()
-            for i in range(NUM_PROTOTYPES):
-                trained_p = model.projection_network(model.prototypes)
-                trained_prototype_clone = trained_p.clone().detach()[i].view(1,-1)
-                trained_prototype = trained_prototype_clone.cpu()
-                knn = KNeighborsRegressor(algorithm='brute')
-                knn.fit(transformed_x, list(range(len(transformed_x)))) # lista da 0 a len(transformed_x) - n of training data
-                dist, transf_idx = knn.kneighbors(X=trained_prototype, n_neighbors=1, return_distance=True)
-                projected_prototype = X_train[transf_idx.item()]# transformed_x[transf_idx.item()]
-                list_projected_prototype.append(projected_prototype.tolist())
+                list_projected_prototype = list()
+                for i in range(NUM_PROTOTYPES):
+                    trained_p = model.projection_network(model.prototypes)
+                    trained_prototype_clone = trained_p.clone().detach()[i].view(1,-1)
+                    trained_prototype = trained_prototype_clone.cpu()
+                    knn = KNeighborsRegressor(algorithm='brute')
+                    knn.fit(transformed_x, list(range(len(transformed_x)))) # lista da 0 a len(transformed_x) - n of training data
+                    dist, transf_idx = knn.kneighbors(X=trained_prototype, n_neighbors=1, return_distance=True)
+                    projected_prototype = X_train[transf_idx.item()]# transformed_x[transf_idx.item()]
+                    list_projected_prototype.append(projected_prototype.tolist())
                 
-                if epoch == NUM_EPOCHS-20-2: 
-                    print("I'm saving prototypes' images in prototypes/ directory...")
-                    prototype_image = X_train_observations[transf_idx.item()]
-                    for j, frame in enumerate(prototype_image):
-                        prototype_image = Image.fromarray(frame, 'RGB')
-                        p_path = prototype_path+f'p{i+1}_'+f'FRAME{j+1}.png'
-                        prototype_image.save(p_path)
+                    if epoch == NUM_EPOCHS-20-2: 
+                        print("I'm saving prototypes' images in prototypes/ directory...")
+                        prototype_image = X_train_observations[transf_idx.item()]
+                        for j, frame in enumerate(prototype_image):
+                            prototype_image = Image.fromarray(frame, 'RGB')
+                            p_path = prototype_path+f'p{i+1}_'+f'FRAME{j+1}.png'
+                            prototype_image.save(p_path)
                                             
-            trained_prototypes = model.prototypes.clone().detach()
-            tensor_projected_prototype = torch.tensor(list_projected_prototype, dtype=torch.float32) # (num_prot, 50)
-            #model.prototypes = torch.nn.Parameter(tensor_projected_prototype.to(DEVICE))
-            with torch.no_grad():
-                model.prototypes.copy_(tensor_projected_prototype.to(DEVICE))
-            model.train()
+                trained_prototypes = model.prototypes.clone().detach()
+                tensor_projected_prototype = torch.tensor(list_projected_prototype, dtype=torch.float32) # (num_prot, 50)
+                #model.prototypes = torch.nn.Parameter(tensor_projected_prototype.to(DEVICE))
+                with torch.no_grad():
+                    model.prototypes.copy_(tensor_projected_prototype.to(DEVICE))
+                timer.stop('projection', samples=len(X_train))
+                model.train()
             
-        # freezed prototypes and projection network, training only proto_presence (prototype assignment) + class_identity_layer (last layer)
-        if epoch >= NUM_EPOCHS-20:
-            for name, param in model.named_parameters():
-                if "prototypes" in name: 
-                    param.requires_grad = False 
-                elif "projection_network" in name:
-                    param.requires_grad = False 
+            # freezed prototypes and projection network, training only proto_presence (prototype assignment) + class_identity_layer (last layer)
+            if epoch >= NUM_EPOCHS-20:
+                for name, param in model.named_parameters():
+                    if "prototypes" in name: 
+                        param.requires_grad = False 
+                    elif "projection_network" in name:
+                        param.requires_grad = False 
                         
-        for instances, labels in train_loader:
-            optimizer.zero_grad()
+            timer.start('training_pass')
+            for instances, labels in train_loader:
+                optimizer.zero_grad()
                     
-            instances, labels = instances.to(DEVICE), labels.to(DEVICE)
-            logits, _, similarity, proto_presence = model(instances, gumbel_scalar, tau)
+                instances, labels = instances.to(DEVICE), labels.to(DEVICE)
+                logits, _, similarity, proto_presence = model(instances, gumbel_scalar, tau)
             
-            loss1 = cce_loss(logits, labels) 
-            # orthogonal loss --> for slots orthogonality: in this way successive slots of a class are assigned to different prototypes
-            orthogonal_loss = torch.Tensor([0]).to(DEVICE)
-
-            for c in range(model.proto_presence.shape[0]): # NUM_CLASSES
-                list_p = list(range(1, model.proto_presence.shape[1]+1))
-                for (i,j) in list(combinations(list_p, 2)):
-                    s1 = model.proto_presence[c][i-1].view(1,-1)
-                    s2 = model.proto_presence[c][j-1].view(1,-1)
-                    sim = cosine_similarity(s1, s2, dim=1).sum()
-                    orthogonal_loss += sim
-            orthogonal_loss = orthogonal_loss / (NUM_SLOTS_PER_CLASS * NUM_CLASSES) - 1
+                loss1 = cce_loss(logits, labels) 
+                # orthogonal loss --> for slots orthogonality: in this way successive slots of a class are assigned to different prototypes
+                orthogonal_loss = torch.Tensor([0]).to(DEVICE)
+
+                for c in range(model.proto_presence.shape[0]): # NUM_CLASSES
+                    list_p = list(range(1, model.proto_presence.shape[1]+1))
+                    for (i,j) in list(combinations(list_p, 2)):
+                        s1 = model.proto_presence[c][i-1].view(1,-1)
+                        s2 = model.proto_presence[c][j-1].view(1,-1)
+                        sim = cosine_similarity(s1, s2, dim=1).sum()
+                        orthogonal_loss += sim
+                orthogonal_loss = orthogonal_loss / (NUM_SLOTS_PER_CLASS * NUM_CLASSES) - 1
             
-            #print("labels: ", labels) # [batch size, int] tensor([2, 4, 5, 4, 0, 5, 4, 4, 3, 3, 3, 0, 0, 2, 5, 5, 5, 1, 1, 1, 0, 1, 4, 0,
-            #0, 3, 4, 4, 4, 4, 3, 4, 4, 0, 2, 1, 0, 3, 3, 0], device='cuda:0')
-            labels_p = labels.cpu().numpy().tolist()
-            #label = [0/1/2/3/4/5]
+                #print("labels: ", labels) # [batch size, int] tensor([2, 4, 5, 4, 0, 5, 4, 4, 3, 3, 3, 0, 0, 2, 5, 5, 5, 1, 1, 1, 0, 1, 4, 0,
+                #0, 3, 4, 4, 4, 4, 3, 4, 4, 0, 2, 1, 0, 3, 3, 0], device='cuda:0')
+                labels_p = labels.cpu().numpy().tolist()
+                #label = [0/1/2/3/4/5]
             
-            proto_presence = proto_presence[labels_p] # (?) labels_pp deve essere un vettore (batch size, classe) classe = 0,1,2
-            inverted_proto_presence = 1 - proto_presence
-            labels.to(DEVICE)
+                proto_presence = proto_presence[labels_p] # (?) labels_pp deve essere un vettore (batch size, classe) classe = 0,1,2
+                inverted_proto_presence = 1 - proto_presence
+                labels.to(DEVICE)
             
-            clst_loss_val = dist_loss(model, similarity, proto_presence, NUM_SLOTS_PER_CLASS)  
-            sep_loss_val = dist_loss(model, similarity, inverted_proto_presence, NUM_PROTOTYPES - NUM_SLOTS_PER_CLASS) 
+                clst_loss_val = dist_loss(model, similarity, proto_presence, NUM_SLOTS_PER_CLASS)  
+                sep_loss_val = dist_loss(model, similarity, inverted_proto_presence, NUM_PROTOTYPES - NUM_SLOTS_PER_CLASS) 
             
-            prototypes_of_correct_class = proto_presence.sum(dim=-1).detach()
-            prototypes_of_wrong_class = 1 - prototypes_of_correct_class
-            avg_separation_cost = torch.sum(similarity * prototypes_of_wrong_class, dim=1) / torch.sum(prototypes_of_wrong_class,dim=1)
-            avg_separation_cost = torch.mean(avg_separation_cost)
+                prototypes_of_correct_class = proto_presence.sum(dim=-1).detach()
+                prototypes_of_wrong_class = 1 - prototypes_of_correct_class
+                avg_separation_cost = torch.sum(similarity * prototypes_of_wrong_class, dim=1) / torch.sum(prototypes_of_wrong_class,dim=1)
+                avg_separation_cost = torch.mean(avg_separation_cost)
             
-            l1_mask = 1 - torch.t(model.prototype_class_identity).cuda()
-            l1 = (model.class_identity_layer.weight * l1_mask).norm(p=1)
-            # We use the following weighting schema for loss function: L entropy = 1.0, L clst = 0.8, L sep = −0.08, L orth = 1.0, and L l 1 = 10 −4 . Finally, 
-            # we normalize L orth , dividing it by the number of classes multiplied by the number of slots per class. (page 20)
-            loss = loss1 + clst_loss_val * clst_weight + sep_loss_val * sep_weight + l1 * l1_weight + orthogonal_loss 
-            #print(loss1, clst_loss_val * clst_weight, sep_loss_val * sep_weight, l1 * l1_weight , orthogonal_loss )
-            #loss2 = clust_loss(instances, labels, model, mse_loss) * lambda22
-            #loss3 = sep_loss(instances, labels, model, mse_loss) * lambda33
+                l1_mask = 1 - torch.t(model.prototype_class_identity).cuda()
+                l1 = (model.class_identity_layer.weight * l1_mask).norm(p=1)
+                # We use the following weighting schema for loss function: L entropy = 1.0, L clst = 0.8, L sep = −0.08, L orth = 1.0, and L l 1 = 10 −4 . Finally, 
+                # we normalize L orth , dividing it by the number of classes multiplied by the number of slots per class. (page 20)
+                loss = loss1 + clst_loss_val * clst_weight + sep_loss_val * sep_weight + l1 * l1_weight + orthogonal_loss 
+                #print(loss1, clst_loss_val * clst_weight, sep_loss_val * sep_weight, l1 * l1_weight , orthogonal_loss )
+                #loss2 = clust_loss(instances, labels, model, mse_loss) * lambda22
+                #loss3 = sep_loss(instances, labels, model, mse_loss) * lambda33
             
-            running_loss_mse += loss1.item()
-            running_loss_clst += clst_loss_val.item() * clst_weight
-            running_loss_sep += sep_loss_val.item() * sep_weight
-            running_loss_l1 += l1.item() * l1_weight
-            running_loss_ortho += orthogonal_loss.item() 
-            running_loss += loss.item()
-
-            loss.backward()
-            optimizer.step()
+                running_loss_mse += loss1.item()
+                running_loss_clst += clst_loss_val.item() * clst_weight
+                running_loss_sep += sep_loss_val.item() * sep_weight
+                running_loss_l1 += l1.item() * l1_weight
+                running_loss_ortho += orthogonal_loss.item() 
+                running_loss += loss.item()
+
+                loss.backward()
+                optimizer.step()
+            timer.stop('training_pass', samples=len(train_dataset))
     
-        print("Epoch:", epoch, "Running Loss:", running_loss / len(train_loader), "Current accuracy:", current_acc)
-        with open(results_file, 'a') as f:
-            f.write(f"Epoch: {epoch}, Running Loss: {running_loss / len(train_loader)}, Current accuracy: {current_acc}\n")
-        #writer.add_scalar("Loss_mse/train", running_loss_mse/len(train_loader), epoch)
-        #writer.add_scalar("Loss_clst/train", running_loss_clst/len(train_loader), epoch)
-        #writer.add_scalar("Loss_sep/train", running_loss_sep/len(train_loader), epoch)
-        #writer.add_scalar("Loss_l1/train", running_loss_l1/len(train_loader), epoch)
-        #writer.add_scalar("Loss_ortho/train", running_loss_ortho/len(train_loader), epoch)
-        writer.add_scalar("Running_loss: ", running_loss/len(train_loader), epoch)
-        writer.add_scalar("Current_accuracy: ", current_acc, epoch)
-        running_loss = running_loss_mse = running_loss_clst = running_loss_sep = running_loss_l1 =  running_loss_ortho = 0.
+            print("Epoch:", epoch, "Running Loss:", running_loss / len(train_loader), "Current accuracy:", current_acc)
+            with open(results_file, 'a') as f:
+                f.write(f"Epoch: {epoch}, Running Loss: {running_loss / len(train_loader)}, Current accuracy: {current_acc}\n")
+            store.log_epoch(iter, epoch, running_loss=running_loss / len(train_loader), accuracy=current_acc)
+            #writer.add_scalar("Loss_mse/train", running_loss_mse/len(train_loader), epoch)
+            #writer.add_scalar("Loss_clst/train", running_loss_clst/len(train_loader), epoch)
+            #writer.add_scalar("Loss_sep/train", running_loss_sep/len(train_loader), epoch)
+            #writer.add_scalar("Loss_l1/train", running_loss_l1/len(train_loader), epoch)
+            #writer.add_scalar("Loss_ortho/train", running_loss_ortho/len(train_loader), epoch)
+            writer.add_scalar("Running_loss: ", running_loss/len(train_loader), epoch)
+            writer.add_scalar("Current_accuracy: ", current_acc, epoch)
+            running_loss = running_loss_mse = running_loss_clst = running_loss_sep = running_loss_l1 =  running_loss_ortho = 0.
             
-        scheduler.step()
+            scheduler.step()
+        cache.save('train', train_key, files=[MODEL_DIR_ITER], directories=[prototype_path], gumbel_scalar=gumbel_scalar, tau=tau)
     
     states, actions, rewards, log_probs, values, dones = [], [], [], [], [], []
     
@@ -677,76 +719,113 @@ for iter in range(NUM_ITERATIONS):
     model.to(DEVICE)
     print("Final accuracy... :", evaluate_loader(model, gumbel_scalar, train_loader, cce_loss, tau))
 
+    if OFFLINE_EVALUATION:
+        report = offline_fidelity(model, held_out_loader(), gumbel_scalar, tau)
+        print("Held-out fidelity:", report)
+        with open(results_file, 'a') as f:
+            f.write(f"Held-out Accuracy: {report['accuracy']}, Accuracy per episode: {report['accuracy_episode']}\n")
+
+    if QUANTIZATION_REPORT:
+        report = quantization_report(model, train_loader, gumbel_scalar, tau)
+        print("Int8 wrapper:", report)
+        with open(results_file, 'a') as f:
+            f.write(f"Int8 Accuracy delta: {report['acc_delta']}, Step latency: {report['ms_float32']} ms -> {report['ms_int8']} ms\n")
+
+    if SPARSE_INFERENCE:
+        model = SparseSharedPwNet(model, gumbel_scalar, tau).to(DEVICE)
+        report = model.pruning_report()
+        print("Sparse wrapper:", report)
+        print("Final accuracy (sparse)... :", evaluate_loader(model, gumbel_scalar, train_loader, cce_loss, tau))
+        with open(results_file, 'a') as f:
+            f.write(f"Used prototypes: {report['used_prototypes']}, Pruned prototypes: {report['pruned_prototypes']}, Min presence: {report['min_presence']}\n")
+
     all_rewards = list()
     all_acc = list()
-    for episode in tqdm(range(SIMULATION_EPOCHS)):
-        startTime = time.time()  # Keep time
-        state = environment.reset()  # Reset env
+    simulation_key = cache.key('simulation', files=[MODEL_PATH + str(LOAD_FILE_EPISODE) + '.pkl'] if LOAD_MODEL_FROM_FILE else [], config=dict(simulations=SIMULATION_EPOCHS, VECTOR_SIMULATION=VECTOR_SIMULATION, EARLY_STOP=EARLY_STOP, SPARSE_INFERENCE=SPARSE_INFERENCE, FOLDED_INFERENCE=FOLDED_INFERENCE), code=[cache.stage_source(__file__, 'simulation'), cache.module_source(simulate), cache.module_source(SequentialStop), cache.module_source(SparseSharedPwNet), Agent, DuelCNN, cache.module_source(FrameStack), cache.module_source(FoldedDuelCNN)], upstream=[train_key])
+    if cache.done('simulation', simulation_key):
+        simulation = cache.load('simulation', simulation_key)
+        all_rewards, all_acc = simulation['all_rewards'], simulation['all_acc']
+    else:
+        timer.start('simulation')
+        if VECTOR_SIMULATION:
+            all_rewards, matches, lengths = simulate(agent, model, SIMULATION_EPOCHS, gumbel_scalar, tau)
+            timer.add(steps=sum(lengths))
+            all_acc = [m / l for m, l in zip(matches, lengths)]
+        else:
+            stop = SequentialStop(max_episodes=SIMULATION_EPOCHS)
+            for episode in tqdm(range(SIMULATION_EPOCHS)):
+                startTime = time.time()  # Keep time
+                state = environment.reset()  # Reset env
 
-        state = agent.preProcess(state)  # Process image
+                state = agent.frames.reset(state)  # Process image, stacked 4 times
         
-        # Stack state . Every state contains 4 time contionusly frames
-        # We stack frames like 4 channel image
-        state = np.stack((state, state, state, state))
-        
-        total_max_q_val = 0  # Total max q vals
-        total_reward = 0     # Total reward for each episode
-        total_loss = 0       # Total loss for each episode
-        total_acc = list()
-        model.eval()
+                total_max_q_val = 0  # Total max q vals
+                total_reward = 0     # Total reward for each episode
+                total_loss = 0       # Total loss for each episode
+                total_acc = list()
+                model.eval()
 
-        for step in range(MAX_STEP):
+                for step in range(MAX_STEP):
             
-            # Select and perform an action
-            agent_action, latent_x = agent.act(state)  # Act
-            action, _, _, _ = model(latent_x.to(DEVICE), gumbel_scalar, tau)
-            action = torch.argmax(action).item()
-
-            # print(agent_action, action)
-
-            # Normally the randomness is the number on the right (.049...)
-            # But as PW-Net is trained on the data from the original model which was already random
-            # we lower the randomness here for a fairer comparison.
-            # PW-Net here is trained on ~5% random data, plus 0.025 randomness
-            if np.random.random_sample() < .025:   #  .04953625663766238:
-                action = np.random.randint(0, 5)
-
-            next_state, reward, done, info = environment.step(action)  # Observe
-
-            next_state = agent.preProcess(next_state)  # Process image
-
-            # Stack state . Every state contains 4 time contionusly frames
-            # We stack frames like 4 channel image
-            next_state = np.stack((next_state, state[0], state[1], state[2]))
-
-            # Store the transition in memory
-            agent.storeResults(state, action, reward, next_state, done)  # Store to mem
-
-            # Move to the next state
-            state = next_state  # Update state
-
-            total_reward += reward
-            total_acc.append( agent_action == action )
-
-            if done:
-                all_rewards.append(total_reward)
-                all_acc.append( sum(total_acc) / len(total_acc ) )
-                break
+                    # Select and perform an action
+                    agent_action, latent_x = agent.act(state)  # Act
+                    action, _, _, _ = model(latent_x.to(DEVICE), gumbel_scalar, tau)
+                    action = torch.argmax(action).item()
+
+                    # print(agent_action, action)
+
+                    # Normally the randomness is the number on the right (.049...)
+                    # But as PW-Net is trained on the data from the original model which was already random
+                    # we lower the randomness here for a fairer comparison.
+                    # PW-Net here is trained on ~5% random data, plus 0.025 randomness
+                    if np.random.random_sample() < .025:   #  .04953625663766238:
+                        action = np.random.randint(0, 5)
+
+                    next_state, reward, done, info = environment.step(action)  # Observe
+                    timer.add(steps=1)
+
+                    next_state = agent.frames.push(next_state)  # Process image, on top of the last 3 of state
+
+                    # Store the transition in memory
+                    agent.storeResults(state, action, reward, next_state, done)  # Store to mem
+
+                    # Move to the next state
+                    state = next_state  # Update state
+
+                    total_reward += reward
+                    total_acc.append( agent_action == action )
+
+                    if done:
+                        all_rewards.append(total_reward)
+                        all_acc.append( sum(total_acc) / len(total_acc ) )
+                        break
+                if EARLY_STOP and stop.update(total_reward):
+                    break
+            if EARLY_STOP:
+                summary = stop.summary()
+                print("Early stop:", summary)
+                with open(results_file, 'a') as f:
+                    f.write(f"Simulated episodes: {summary['episodes']}, saved: {summary['saved_episodes']} ({summary['reason']})\n")
+        timer.stop('simulation')
+        cache.save('simulation', simulation_key, all_rewards=all_rewards, all_acc=all_acc)
+    timer.log(writer, iter)
             
 
-    data_rewards.append(sum(all_rewards) / SIMULATION_EPOCHS)
-    data_accuracy.append(sum(all_acc) / SIMULATION_EPOCHS)
-    print("Reward: ", sum(all_rewards) / SIMULATION_EPOCHS)
-    print("Accuracy: ", sum(all_acc) / SIMULATION_EPOCHS)
+    data_rewards.append(sum(all_rewards) / len(all_rewards))
+    data_accuracy.append(sum(all_acc) / len(all_acc))
+    store.log_iteration(iter, timer.last_iteration(), reward=data_rewards[-1], accuracy=data_accuracy[-1])
+    print("Reward: ", sum(all_rewards) / len(all_rewards))
+    print("Accuracy: ", sum(all_acc) / len(all_acc))
     
-    writer.add_scalar("Reward", sum(all_rewards) / SIMULATION_EPOCHS, iter)
-    writer.add_scalar("Accuracy", sum(all_acc) / SIMULATION_EPOCHS, iter)
+    writer.add_scalar("Reward", sum(all_rewards) / len(all_rewards), iter)
+    writer.add_scalar("Accuracy", sum(all_acc) / len(all_acc), iter)
     
     with open(results_file, 'a') as f:
-        f.write(f"Reward: {sum(all_rewards) / SIMULATION_EPOCHS}, Accuracy: {sum(all_acc) / SIMULATION_EPOCHS}\n")
+        f.write(f"Reward: {sum(all_rewards) / len(all_rewards)}, Accuracy: {sum(all_acc) / len(all_acc)}\n")
 
 data_accuracy = np.array(data_accuracy)
 data_rewards = np.array(data_rewards)
+timer.save(results_file.replace('_results', '_timing').replace('.txt', '.json'))
 
 
 print(" ")
@@ -0,0 +1,156 @@
+import os
+
+import gym
+import numpy as np
+import torch
+import torch.nn.functional as F
+from gym.spaces import Box
+from gym.vector import AsyncVectorEnv
+from gym.wrappers import TimeLimit
+
+from preprocessing import FrameStack, to_model_input
+from prototype_ops import wrapper_outputs
+
+
+NUM_ENVS = os.cpu_count()  # one environment per worker process
+PIPELINE = True  # step half of the envs while the policy runs on the other half
+ENVIRONMENT = "PongDeterministic-v4"
+MAX_STEP = 100000  # same cap of the sequential simulation
+RANDOM_ACTION_PROB = .025  # randomness added to the wrapper actions, as in the sequential simulation
+
+
+class StackedFrames(gym.Wrapper):
+    """
+    Pong observations processed and stacked by 4 by FrameStack, the most recent first,
+    so that every worker returns the state the agent acts on (uint8, scaled to [0, 1] by to_model_input)
+    """
+
+    def __init__(self, env, target_h=80, target_w=64, crop_top=20):
+        super().__init__(env)
+        self.frames = FrameStack(target_h, target_w, crop_top)
+        self.observation_space = Box(low=0, high=255, shape=(4, target_w, target_h), dtype=np.uint8)
+
+    def reset(self, **kwargs):
+        return self.frames.reset(self.env.reset(**kwargs))
+
+    def step(self, action):
+        next_frame, reward, done, info = self.env.step(action)
+        return self.frames.push(next_frame), reward, done, info
+
+
+def make_env():
+    return TimeLimit(StackedFrames(gym.make(ENVIRONMENT)), max_episode_steps=MAX_STEP)
+
+
+class EnvGroup:
+    """
+    Environments stepped together in worker processes, with the running statistics of their episodes
+    """
+
+    def __init__(self, make_env, n_envs):
+        self.envs = AsyncVectorEnv([make_env] * n_envs)
+        self.state = self.envs.reset()
+        self.ep_reward = np.zeros(n_envs)
+        self.ep_metric = 0
+        self.ep_length = np.zeros(n_envs, dtype=int)
+        self.running = np.ones(n_envs, dtype=bool)
+        self.metric = None
+        self.pending = False
+
+    def step_async(self, policy_step):
+        action, self.metric = policy_step(self.state)
+        self.envs.step_async(action)
+        self.pending = True
+
+    def step_wait(self, episodes):
+        # the vector env resets by itself the environments that are done
+        self.state, reward, done, _ = self.envs.step_wait()
+        self.pending = False
+        self.ep_reward += reward
+        self.ep_metric = self.ep_metric + torch.as_tensor(self.metric)
+        self.ep_length += 1
+
+        for i in np.flatnonzero(done & self.running):
+            episodes['rewards'].append(float(self.ep_reward[i]))
+            episodes['metrics'].append(float(self.ep_metric[i]))  # host sync, once per episode
+            episodes['lengths'].append(int(self.ep_length[i]))
+            self.ep_reward[i], self.ep_metric[i], self.ep_length[i] = 0, 0, 0
+            if episodes['to_start'] > 0:
+                episodes['to_start'] -= 1
+            else:
+                self.running[i] = False
+
+
+def run_episodes(make_env, policy_step, n_episodes, n_envs=NUM_ENVS, pipeline=PIPELINE):
+    """
+    Plays n_episodes on n_envs copies of the environment stepped together in worker processes.
+    policy_step maps the batch of observations to the batch of actions and a per-env step metric,
+    which can stay on the device: it is summed there and read back only when an episode ends.
+    With pipeline the envs are split in two groups: while the workers step one group, the main process
+    runs policy_step on the observations of the other one, so neither side waits for the other.
+    Returns per-episode rewards, sums of the step metric and lengths, in the order the episodes end.
+    """
+    n_envs = min(n_envs, n_episodes)
+    sizes = [n_envs - n_envs // 2, n_envs // 2] if pipeline and n_envs > 1 else [n_envs]
+    groups = [EnvGroup(make_env, n) for n in sizes]
+    episodes = {'rewards': list(), 'metrics': list(), 'lengths': list(), 'to_start': n_episodes - n_envs}
+
+    with torch.no_grad():
+        for group in groups:
+            group.step_async(policy_step)
+        while any(group.pending for group in groups):
+            for group in groups:
+                if group.pending:
+                    group.step_wait(episodes)
+                    if group.running.any():
+                        group.step_async(policy_step)
+
+    for group in groups:
+        group.envs.close()
+    return episodes['rewards'], episodes['metrics'], episodes['lengths']
+
+
+def duel_cnn_forward(net, state):
+    """
+    DuelCNN.forward for a batch of states. The scripts leave the online model in train mode, where every
+    BatchNorm2d normalizes the single state with its own statistics: instance_norm with the BatchNorm
+    parameters keeps exactly that per state of the batch (without updating the running statistics).
+    Returns the advantages, which have the same argmax of the q values, and the latent x.
+    """
+    x = state
+    for conv, bn in ((net.conv1, net.bn1), (net.conv2, net.bn2), (net.conv3, net.bn3)):
+        x = conv(x)
+        x = F.instance_norm(x, weight=bn.weight, bias=bn.bias, eps=bn.eps) if bn.training else bn(x)
+        x = F.relu(x)
+    x = x.view(x.size(0), -1)  # Flatten every batch
+    Ax = net.Alinear2(net.Alrelu(net.Alinear1(x)))
+    return Ax, x
+
+
+def simulate(agent, model, n_episodes, *model_args, n_envs=NUM_ENVS):
+    """
+    Simulation of the wrapper playing Pong, with the DuelCNN and the wrapper forward batched over all the envs.
+    Returns per-episode rewards, number of steps where the wrapper took the agent action, and lengths.
+    """
+    net = agent.online_model
+    net_device = next(net.parameters()).device
+    model_device = next(model.parameters()).device
+    model.eval()
+
+    def policy_step(state):
+        state = to_model_input(state, net_device)
+        if agent.inference_model is not None:
+            # q of the folded model, same argmax of the advantages
+            Ax, latent_x = agent.inference_model(state)
+        else:
+            Ax, latent_x = duel_cnn_forward(net, state)
+        agent_action = torch.argmax(Ax, dim=1).cpu().numpy()
+        explore = np.random.uniform(0, 1, len(state)) <= agent.epsilon  # as Agent.act
+        agent_action[explore] = np.random.randint(0, agent.action_size, explore.sum())
+
+        action = torch.argmax(wrapper_outputs(model(latent_x.to(model_device), *model_args)), dim=1).cpu().numpy()
+        random_action = np.random.random_sample(len(state)) < RANDOM_ACTION_PROB
+        action[random_action] = np.random.randint(0, 5, random_action.sum())
+        return action, agent_action == action
+
+    return run_episodes(make_env, policy_step, n_episodes, n_envs)
@@ -3,6 +3,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 
+from utils import prefetch_batches
+
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
 class Actor(nn.Module):
@@ -37,71 +39,156 @@ class Critic(nn.Module):
         q = self.l3(q)
         return q
     
+class TwinCritic(nn.Module):
+    """
+    critic_1 and critic_2 in a single module: the weights of the two critics are stacked on a first dimension
+    of size 2, so every layer of both Q heads is one batched matmul
+    """
+    def __init__(self, state_dim, action_dim):
+        super(TwinCritic, self).__init__()
+        
+        critics = [Critic(state_dim, action_dim), Critic(state_dim, action_dim)]  # same initialization of two Critic
+        for name in ('l1', 'l2', 'l3'):
+            setattr(self, name + '_weight', nn.Parameter(torch.stack([getattr(c, name).weight.detach() for c in critics])))
+            setattr(self, name + '_bias', nn.Parameter(torch.stack([getattr(c, name).bias.detach() for c in critics]).unsqueeze(1)))
+        
+    def forward(self, state, action):
+        state_action = torch.cat([state, action], 1).expand(2, -1, -1)
+        
+        q = F.relu(torch.baddbmm(self.l1_bias, state_action, self.l1_weight.transpose(1, 2)))
+        q = F.relu(torch.baddbmm(self.l2_bias, q, self.l2_weight.transpose(1, 2)))
+        q = torch.baddbmm(self.l3_bias, q, self.l3_weight.transpose(1, 2))
+        return q[0], q[1]
+    
+    def Q1(self, state, action):
+        # critic_1 alone, for the actor loss
+        state_action = torch.cat([state, action], 1)
+        
+        q = F.relu(F.linear(state_action, self.l1_weight[0], self.l1_bias[0, 0]))
+        q = F.relu(F.linear(q, self.l2_weight[0], self.l2_bias[0, 0]))
+        q = F.linear(q, self.l3_weight[0], self.l3_bias[0, 0])
+        return q
+    
+    def critic_state_dicts(self):
+        # state dicts of critic_1 and critic_2 as two Critic, the format of the saved models
+        return [{name + '.' + p: getattr(self, name + '_' + p)[i].reshape(shape).detach().clone()
+                 for name, shapes in self._shapes().items() for p, shape in zip(('weight', 'bias'), shapes)} for i in range(2)]
+    
+    def load_critic_state_dicts(self, state_dict_1, state_dict_2):
+        with torch.no_grad():
+            for name, shapes in self._shapes().items():
+                for p, shape in zip(('weight', 'bias'), shapes):
+                    stacked = getattr(self, name + '_' + p)
+                    for i, state_dict in enumerate((state_dict_1, state_dict_2)):
+                        stacked[i].copy_(state_dict[name + '.' + p].view_as(stacked[i]))
+    
+    def _shapes(self):
+        return {name: (getattr(self, name + '_weight').shape[1:], getattr(self, name + '_bias').shape[2:]) for name in ('l1', 'l2', 'l3')}
+    
+def soft_update(nets, target_nets, polyak):
+    """
+    Polyak averaging target = polyak * target + (1 - polyak) * online of all the parameters at once,
+    with two multi-tensor kernels instead of a loop over every parameter
+    """
+    with torch.no_grad():
+        params = [p for net in nets for p in net.parameters()]
+        target_params = [p for net in target_nets for p in net.parameters()]
+        torch._foreach_mul_(target_params, polyak)
+        torch._foreach_add_(target_params, params, alpha=1 - polyak)
+    
 class TD3:
-    def __init__(self, lr, state_dim, action_dim, max_action):
+    def __init__(self, lr, state_dim, action_dim, max_action, fused_critics=False):
         
         self.actor = Actor(state_dim, action_dim, max_action).to(device)
         self.actor_target = Actor(state_dim, action_dim, max_action).to(device)
         self.actor_target.load_state_dict(self.actor.state_dict())
         self.actor_optimizer = optim.Adam(self.actor.parameters(), lr=lr)
         
-        self.critic_1 = Critic(state_dim, action_dim).to(device)
-        self.critic_1_target = Critic(state_dim, action_dim).to(device)
-        self.critic_1_target.load_state_dict(self.critic_1.state_dict())
-        self.critic_1_optimizer = optim.Adam(self.critic_1.parameters(), lr=lr)
-        
-        self.critic_2 = Critic(state_dim, action_dim).to(device)
-        self.critic_2_target = Critic(state_dim, action_dim).to(device)
-        self.critic_2_target.load_state_dict(self.critic_2.state_dict())
-        self.critic_2_optimizer = optim.Adam(self.critic_2.parameters(), lr=lr)
+        # fused_critics: both critics (and both targets) in a TwinCritic, trained by a single optimizer
+        # (Adam is elementwise, so it is the same as one optimizer per critic)
+        self.fused_critics = fused_critics
+        if fused_critics:
+            self.critic = TwinCritic(state_dim, action_dim).to(device)
+            self.critic_target = TwinCritic(state_dim, action_dim).to(device)
+            self.critic_target.load_state_dict(self.critic.state_dict())
+            self.critic_optimizer = optim.Adam(self.critic.parameters(), lr=lr)
+        else:
+            self.critic_1 = Critic(state_dim, action_dim).to(device)
+            self.critic_1_target = Critic(state_dim, action_dim).to(device)
+            self.critic_1_target.load_state_dict(self.critic_1.state_dict())
+            self.critic_1_optimizer = optim.Adam(self.critic_1.parameters(), lr=lr)
+            
+            self.critic_2 = Critic(state_dim, action_dim).to(device)
+            self.critic_2_target = Critic(state_dim, action_dim).to(device)
+            self.critic_2_target.load_state_dict(self.critic_2.state_dict())
+            self.critic_2_optimizer = optim.Adam(self.critic_2.parameters(), lr=lr)
         
         self.max_action = max_action
     
     def select_action(self, state):
-        state = torch.FloatTensor(state.reshape(1, -1)).to(device)
-        return self.actor(state)[0].cpu().data.numpy().flatten(), self.actor(state)[1].cpu().data.numpy().flatten() ## state added
+        action, latent = self.act(state.reshape(1, -1))
+        return action.cpu().numpy().flatten(), latent.cpu().numpy().flatten() ## state added
     
-    def update(self, replay_buffer, n_iter, batch_size, gamma, polyak, policy_noise, noise_clip, policy_delay):
-        
-        for i in range(n_iter):
-            # Sample a batch of transitions from replay buffer:
-            state, action_, reward, next_state, done = replay_buffer.sample(batch_size)
-            state = torch.FloatTensor(state).to(device)
-            action = torch.FloatTensor(action_).to(device)
-            reward = torch.FloatTensor(reward).reshape((batch_size,1)).to(device)
-            next_state = torch.FloatTensor(next_state).to(device)
-            done = torch.FloatTensor(done).reshape((batch_size,1)).to(device)
-            
+    def act(self, states):
+        """
+        Actions and latents (the 300 features before the last layer of the actor) of a batch of states
+        (batch, state_dim), with a single forward of the actor. Returns two tensors on device
+        """
+        with torch.inference_mode():
+            states = torch.as_tensor(states, dtype=torch.float32, device=device)
+            return self.actor(states)
+    
+    def update(self, replay_buffer, n_iter, batch_size, gamma, polyak, policy_noise, noise_clip, policy_delay, prefetch=False):
+        
+        # with prefetch the next batch is sampled and copied to device in a background thread during the update
+        if prefetch:
+            batches = prefetch_batches(replay_buffer, n_iter, batch_size, device)
+        else:
+            batches = (replay_buffer.sample_tensors(batch_size, device) for _ in range(n_iter))
+        
+        for i, (state, action, reward, next_state, done) in enumerate(batches):
             # Select next action according to target policy:
-            noise = torch.FloatTensor(action_).data.normal_(0, policy_noise).to(device)
+            noise = torch.empty_like(action).normal_(0, policy_noise)
             noise = noise.clamp(-noise_clip, noise_clip)
-            next_action = (self.actor_target(next_state) + noise)
+            next_action = (self.actor_target(next_state)[0] + noise)
             next_action = next_action.clamp(-self.max_action, self.max_action)
             
             # Compute target Q-value:
-            target_Q1 = self.critic_1_target(next_state, next_action)
-            target_Q2 = self.critic_2_target(next_state, next_action)
+            if self.fused_critics:
+                target_Q1, target_Q2 = self.critic_target(next_state, next_action)
+            else:
+                target_Q1 = self.critic_1_target(next_state, next_action)
+                target_Q2 = self.critic_2_target(next_state, next_action)
             target_Q = torch.min(target_Q1, target_Q2)
             target_Q = reward + ((1-done) * gamma * target_Q).detach()
             
-            # Optimize Critic 1:
-            current_Q1 = self.critic_1(state, action)
-            loss_Q1 = F.mse_loss(current_Q1, target_Q)
-            self.critic_1_optimizer.zero_grad()
-            loss_Q1.backward()
-            self.critic_1_optimizer.step()
-            
-            # Optimize Critic 2:
-            current_Q2 = self.critic_2(state, action)
-            loss_Q2 = F.mse_loss(current_Q2, target_Q)
-            self.critic_2_optimizer.zero_grad()
-            loss_Q2.backward()
-            self.critic_2_optimizer.step()
+            if self.fused_critics:
+                # Optimize both critics: the two losses have no parameter in common
+                current_Q1, current_Q2 = self.critic(state, action)
+                loss_Q = F.mse_loss(current_Q1, target_Q) + F.mse_loss(current_Q2, target_Q)
+                self.critic_optimizer.zero_grad()
+                loss_Q.backward()
+                self.critic_optimizer.step()
+            else:
+                # Optimize Critic 1:
+                current_Q1 = self.critic_1(state, action)
+                loss_Q1 = F.mse_loss(current_Q1, target_Q)
+                self.critic_1_optimizer.zero_grad()
+                loss_Q1.backward()
+                self.critic_1_optimizer.step()
+                
+                # Optimize Critic 2:
+                current_Q2 = self.critic_2(state, action)
+                loss_Q2 = F.mse_loss(current_Q2, target_Q)
+                self.critic_2_optimizer.zero_grad()
+                loss_Q2.backward()
+                self.critic_2_optimizer.step()
             
             # Delayed policy updates:
             if i % policy_delay == 0:
                 # Compute actor loss:
-                actor_loss = -self.critic_1(state, self.actor(state)).mean()
+                critic_1 = self.critic.Q1 if self.fused_critics else self.critic_1
+                actor_loss = -critic_1(state, self.actor(state)[0]).mean()
                 
                 # Optimize the actor
                 self.actor_optimizer.zero_grad()
@@ -109,35 +196,51 @@ class TD3:
                 self.actor_optimizer.step()
                 
                 # Polyak averaging update:
-                for param, target_param in zip(self.actor.parameters(), self.actor_target.parameters()):
-                    target_param.data.copy_( (polyak * target_param.data) + ((1-polyak) * param.data))
-                
-                for param, target_param in zip(self.critic_1.parameters(), self.critic_1_target.parameters()):
-                    target_param.data.copy_( (polyak * target_param.data) + ((1-polyak) * param.data))
-                
-                for param, target_param in zip(self.critic_2.parameters(), self.critic_2_target.parameters()):
-                    target_param.data.copy_( (polyak * target_param.data) + ((1-polyak) * param.data))
+                soft_update(self._critics() + [self.actor], self._critic_targets() + [self.actor_target], polyak)
+    
+    def _critics(self):
+        return [self.critic] if self.fused_critics else [self.critic_1, self.critic_2]
+    
+    def _critic_targets(self):
+        return [self.critic_target] if self.fused_critics else [self.critic_1_target, self.critic_2_target]
+    
+    def _critic_state_dicts(self):
+        # critic_1, critic_1_target, critic_2, critic_2_target as separate Critic, also when fused
+        if self.fused_critics:
+            (critic_1, critic_2), (critic_1_target, critic_2_target) = self.critic.critic_state_dicts(), self.critic_target.critic_state_dicts()
+            return critic_1, critic_1_target, critic_2, critic_2_target
+        return self.critic_1.state_dict(), self.critic_1_target.state_dict(), self.critic_2.state_dict(), self.critic_2_target.state_dict()
                     
                 
     def save(self, directory, name):
         torch.save(self.actor.state_dict(), '%s/%s_actor.pth' % (directory, name))
         torch.save(self.actor_target.state_dict(), '%s/%s_actor_target.pth' % (directory, name))
         
-        torch.save(self.critic_1.state_dict(), '%s/%s_crtic_1.pth' % (directory, name))
-        torch.save(self.critic_1_target.state_dict(), '%s/%s_critic_1_target.pth' % (directory, name))
+        critic_1, critic_1_target, critic_2, critic_2_target = self._critic_state_dicts()
+        torch.save(critic_1, '%s/%s_crtic_1.pth' % (directory, name))
+        torch.save(critic_1_target, '%s/%s_critic_1_target.pth' % (directory, name))
         
-        torch.save(self.critic_2.state_dict(), '%s/%s_crtic_2.pth' % (directory, name))
-        torch.save(self.critic_2_target.state_dict(), '%s/%s_critic_2_target.pth' % (directory, name))
+        torch.save(critic_2, '%s/%s_crtic_2.pth' % (directory, name))
+        torch.save(critic_2_target, '%s/%s_critic_2_target.pth' % (directory, name))
         
     def load(self, directory, name):
         self.actor.load_state_dict(torch.load('%s/%s_actor.pth' % (directory, name), map_location=lambda storage, loc: storage))
         self.actor_target.load_state_dict(torch.load('%s/%s_actor_target.pth' % (directory, name), map_location=lambda storage, loc: storage))
         
-        self.critic_1.load_state_dict(torch.load('%s/%s_crtic_1.pth' % (directory, name), map_location=lambda storage, loc: storage))
-        self.critic_1_target.load_state_dict(torch.load('%s/%s_critic_1_target.pth' % (directory, name), map_location=lambda storage, loc: storage))
+        critic_1 = torch.load('%s/%s_crtic_1.pth' % (directory, name), map_location=lambda storage, loc: storage)
+        critic_1_target = torch.load('%s/%s_critic_1_target.pth' % (directory, name), map_location=lambda storage, loc: storage)
+        
+        critic_2 = torch.load('%s/%s_crtic_2.pth' % (directory, name), map_location=lambda storage, loc: storage)
+        critic_2_target = torch.load('%s/%s_critic_2_target.pth' % (directory, name), map_location=lambda storage, loc: storage)
         
-        self.critic_2.load_state_dict(torch.load('%s/%s_crtic_2.pth' % (directory, name), map_location=lambda storage, loc: storage))
-        self.critic_2_target.load_state_dict(torch.load('%s/%s_critic_2_target.pth' % (directory, name), map_location=lambda storage, loc: storage))
+        if self.fused_critics:
+            self.critic.load_critic_state_dicts(critic_1, critic_2)
+            self.critic_target.load_critic_state_dicts(critic_1_target, critic_2_target)
+        else:
+            self.critic_1.load_state_dict(critic_1)
+            self.critic_1_target.load_state_dict(critic_1_target)
+            self.critic_2.load_state_dict(critic_2)
+            self.critic_2_target.load_state_dict(critic_2_target)
         
         
     def load_actor(self, directory, name):
@@ -0,0 +1,73 @@
+import time
+
+import gym
+import numpy as np
+import torch
+
+from TD3 import TD3, device
+
+
+ENV_NAME = "BipedalWalker-v3"
+DIRECTORY = "./preTrained/BipedalWalker-v2/ONE"  # same agent of collect_data.py
+FILENAME = "TD3_BipedalWalker-v2_0_solved"
+NUM_STEPS = 5000
+BATCH_SIZES = [1, 16, 64]
+
+
+def legacy_select_action(policy, state):
+    # select_action before TD3.act: a FloatTensor per step and two forwards of the actor
+    state = torch.FloatTensor(state.reshape(1, -1)).to(device)
+    return policy.actor(state)[0].cpu().data.numpy().flatten(), policy.actor(state)[1].cpu().data.numpy().flatten()
+
+
+def inference_rate(select, states):
+    """
+    States per second of select over states, one call per state
+    """
+    start = time.perf_counter()
+    for state in states:
+        select(state)
+    return len(states) / (time.perf_counter() - start)
+
+
+def batched_rate(policy, states, batch_size):
+    """
+    States per second of TD3.act on batches of batch_size states (as in the vector simulation)
+    """
+    start = time.perf_counter()
+    for i in range(0, len(states), batch_size):
+        action, latent = policy.act(states[i:i + batch_size])
+        action.cpu().numpy(), latent.cpu().numpy()
+    return len(states) / (time.perf_counter() - start)
+
+
+def env_step_rate(env, select, n_steps=NUM_STEPS):
+    """
+    Steps per second of the simulation loop of the run_*.py (env step included) with select
+    """
+    state = env.reset()
+    start = time.perf_counter()
+    for _ in range(n_steps):
+        action, _ = select(state)
+        state, _, done, _ = env.step(action)
+        if done:
+            state = env.reset()
+    return n_steps / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    env = gym.make(ENV_NAME)
+    policy = TD3(0.001, env.observation_space.shape[0], env.action_space.shape[0], float(env.action_space.high[0]))
+    policy.load_actor(DIRECTORY, FILENAME)
+
+    states = np.random.uniform(-1, 1, size=(NUM_STEPS, env.observation_space.shape[0])).astype(np.float32)
+    legacy = inference_rate(lambda state: legacy_select_action(policy, state), states)
+    single = inference_rate(policy.select_action, states)
+    print(f"actor inference: {legacy:.0f} -> {single:.0f} states/s ({single / legacy:.2f}x)")
+    for batch_size in BATCH_SIZES:
+        print(f"TD3.act, batch {batch_size}: {batched_rate(policy, states, batch_size):.0f} states/s")
+
+    legacy = env_step_rate(env, lambda state: legacy_select_action(policy, state))
+    single = env_step_rate(env, policy.select_action)
+    print(f"simulation: {legacy:.1f} -> {single:.1f} steps/s ({single / legacy:.2f}x)")
+    env.close()
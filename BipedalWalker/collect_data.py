@@ -12,6 +12,7 @@ if not os.path.exists('data/'):
     os.mkdir('data/')
     
 n_episodes = 100
+HELD_OUT = False  # record held-out trajectories for offline_evaluation.py instead of the training data
 env_name = "BipedalWalker-v3"
 random_seed = 0
 lr = 0.002
@@ -35,6 +36,7 @@ X_train = list()
 A_train = list()
 #obs_train = list()
 states = list()
+episodes = list()
 total_reward = 0
 
 for ep in range(n_episodes):
@@ -43,14 +45,16 @@ for ep in range(n_episodes):
     for t in range(max_timesteps):
         #obs_train.append(state)
         
-        img_array = env.render(mode='rgb_array')
-        states.append(img_array)
+        if not HELD_OUT:  # the held-out set keeps no observations
+            img_array = env.render(mode='rgb_array')
+            states.append(img_array)
   
         A, x = policy.select_action(state)
         state, reward, done, _ = env.step(A)
         #shape_x = len(x)#.size()
         X_train.append(x)
         A_train.append(A)
+        episodes.append(ep)
         ep_reward += reward        
         if done:
             break
@@ -68,11 +72,16 @@ X_train = np.array(X_train)
 A_train = np.array(A_train)
 #obs_train = np.array(obs_train)
 
-obs_train = np.array(states)
+if HELD_OUT:
+    np.save('data/X_held_out.npy', X_train)
+    np.save('data/a_held_out.npy', A_train)
+    np.save('data/ep_held_out.npy', np.array(episodes))
+else:
+    obs_train = np.array(states)
 
-np.save('data/X_train.npy', X_train)
-np.save('data/a_train.npy', A_train)
-np.save('data/obs_train.npy', obs_train)
+    np.save('data/X_train.npy', X_train)
+    np.save('data/a_train.npy', A_train)
+    np.save('data/obs_train.npy', obs_train)
 
 
 
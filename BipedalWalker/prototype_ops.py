@@ -0,0 +1,51 @@
+import torch
+from torch.autograd.function import once_differentiable
+
+
+class L2Similarity(torch.autograd.Function):
+    """
+    Similarity function from Chen et al. 2019, log( (l2 + 1) / (l2 + epsilon) ), fused with the squared
+    l2 distance between every input and every prototype.
+    Autograd would keep the (batch, PROTOTYPE_SIZE, NUM_PROTOTYPES) differences and every intermediate of
+    the log, here only the inputs, the prototypes and the (batch, NUM_PROTOTYPES) distances are saved and
+    the gradient is computed analytically.
+    """
+
+    @staticmethod
+    def forward(ctx, x, prototypes, epsilon):
+        # exact differences (no matmul expansion), so distances close to 0 keep their precision
+        l2s = torch.cdist(x, prototypes, compute_mode='donot_use_mm_for_euclid_dist').pow_(2)
+        similarity = torch.log( (l2s + 1. ) / (l2s + epsilon) )
+        ctx.save_for_backward(x, prototypes, l2s)
+        ctx.epsilon = epsilon
+        ctx.mark_non_differentiable(l2s)
+        return similarity, l2s
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_similarity, grad_l2s):
+        x, prototypes, l2s = ctx.saved_tensors
+        # d similarity / d l2 = 1 / (l2 + 1) - 1 / (l2 + epsilon)
+        g = grad_similarity * (ctx.epsilon - 1.) / ( (l2s + 1.) * (l2s + ctx.epsilon) )
+        # d l2 / d x = 2 (x - p), d l2 / d p = 2 (p - x)
+        grad_x = grad_p = None
+        if ctx.needs_input_grad[0]:
+            grad_x = 2 * (g.sum(dim=1, keepdim=True) * x - g @ prototypes)
+        if ctx.needs_input_grad[1]:
+            grad_p = 2 * (g.sum(dim=0).unsqueeze(1) * prototypes - g.T @ x)
+        return grad_x, grad_p, None
+
+
+def l2_similarity(x, prototypes, epsilon):
+    """
+    x (batch, PROTOTYPE_SIZE), prototypes (NUM_PROTOTYPES, PROTOTYPE_SIZE)
+    Returns the similarities and the squared l2 distances, both (batch, NUM_PROTOTYPES)
+    """
+    return L2Similarity.apply(x, prototypes, epsilon)
+
+
+def wrapper_outputs(result):
+    """
+    Final outputs of a wrapper forward: SharedPwNet and PPNet return a tuple, PWNet only the final outputs
+    """
+    return result[0] if isinstance(result, tuple) else result
@@ -0,0 +1,72 @@
+import time
+from copy import deepcopy
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import quantize_dynamic
+
+from prototype_ops import wrapper_outputs
+
+
+# human-defined last layers (W' in PW-Net, class identity in Shared-PW-Net) are kept in float32
+FLOAT_LAYERS = ('linear', 'class_identity_layer')
+
+
+def quantize_wrapper(model):
+    """
+    Post-training dynamic int8 quantization of a trained SharedPwNet/PPNet/PWNet.
+    Only the projection linears are quantized, the distance layer and the last layer stay float32.
+    The returned copy lives on the CPU, the original model is left untouched.
+    """
+    float_model = deepcopy(model).cpu().eval()
+    layers = {name for name, module in float_model.named_modules()
+              if isinstance(module, nn.Linear) and name not in FLOAT_LAYERS}
+    return quantize_dynamic(float_model, layers, dtype=torch.qint8)
+
+
+def fidelity(model, loader, *model_args):
+    """
+    MSE between the wrapper actions and the black-box actions stored in the loader
+    """
+    mse_loss = nn.MSELoss(reduction='sum')
+    total_error = 0
+    total = 0
+    with torch.no_grad():
+        for imgs, labels in loader:
+            imgs, labels = imgs.cpu(), labels.cpu()
+            logits = wrapper_outputs(model(imgs, *model_args))
+            total_error += mse_loss(logits, labels).item() / labels.shape[1]
+            total += len(imgs)
+    return total_error / total
+
+
+def step_latency(model, latent, *model_args, n_steps=1000, n_warmup=50):
+    """
+    Mean time in ms of one simulation step of the wrapper (batch size 1, CPU)
+    """
+    latent = latent.cpu().view(1, -1)
+    with torch.no_grad():
+        for _ in range(n_warmup):
+            model(latent, *model_args)
+        start = time.perf_counter()
+        for _ in range(n_steps):
+            model(latent, *model_args)
+    return (time.perf_counter() - start) / n_steps * 1000
+
+
+def quantization_report(model, loader, *model_args):
+    """
+    Compares the float32 wrapper with its int8 copy: fidelity to the agent and per-step latency on CPU
+    """
+    float_model = deepcopy(model).cpu().eval()
+    int8_model = quantize_wrapper(model)
+    latent = next(iter(loader))[0][0]
+
+    report = dict()
+    report['mse_float32'] = fidelity(float_model, loader, *model_args)
+    report['mse_int8'] = fidelity(int8_model, loader, *model_args)
+    report['mse_delta'] = report['mse_int8'] - report['mse_float32']
+    report['ms_float32'] = step_latency(float_model, latent, *model_args)
+    report['ms_int8'] = step_latency(int8_model, latent, *model_args)
+    report['speedup'] = report['ms_float32'] / report['ms_int8']
+    return report
@@ -25,6 +25,14 @@ import os
 
 from random import sample
 from tqdm import tqdm
+from quantization import quantization_report
+from prototype_ops import l2_similarity
+from vector_simulation import simulate
+from offline_evaluation import held_out_loader, offline_fidelity
+from early_stop import SequentialStop
+from instrumentation import PhaseTimer
+from results_store import ResultsStore
+from metrics import EpisodeMetrics
 from time import sleep
 from sklearn.cluster import KMeans
 from sklearn.metrics import mean_absolute_error
@@ -50,6 +58,18 @@ PROTOTYPE_SIZE = 50
 MAX_SAMPLES = 100000
 delay_ms = 0
 SIMULATION_EPOCHS = 10 #30
+QUANTIZATION_REPORT = False  # compare the trained wrapper with its int8 copy before the simulation
+VECTOR_SIMULATION = False  # play the simulation episodes together on worker processes, batching the agent and the wrapper forward
+OFFLINE_EVALUATION = False  # fidelity on the held-out trajectories recorded by collect_data.py with HELD_OUT = True
+EARLY_STOP = False  # stop the simulation once the reward mean is known well enough (early_stop.SequentialStop)
+TIMING = False  # per-phase wall time and throughput to the SummaryWriter and a JSON summary in results/ (instrumentation.PhaseTimer), synchronizes CUDA at each phase boundary
+RESULTS_STORE = True  # epoch and iteration metrics (and the phase timings) in the SQLite results/results.db, see results_store.aggregate
+
+if VECTOR_SIMULATION and EARLY_STOP:
+    # the sequential test needs the episodes in the order they are played, the vector simulation ends the short ones first
+    raise ValueError("EARLY_STOP only applies to the sequential simulation, set VECTOR_SIMULATION = False")
+
+timer = PhaseTimer(enabled=TIMING)
 
 
 env_name = "BipedalWalker-v3"
@@ -131,12 +151,10 @@ class PWNet(nn.Module):
         self.linear.weight.data.copy_(custom_weight_matrix.T)   
         
     def __proto_layer_l2(self, x, p):
-        output = list()
         b_size = x.shape[0]
-        p = p.view(1, PROTOTYPE_SIZE).tile(b_size, 1).to(DEVICE) 
-        c = x.view(b_size, PROTOTYPE_SIZE).to(DEVICE)      
-        l2s = ( (c - p)**2 ).sum(axis=1).to(DEVICE) 
-        act = torch.log( (l2s + 1. ) / (l2s + self.epsilon) ).to(DEVICE)  
+        c = x.view(b_size, PROTOTYPE_SIZE)
+        # similarity function from Chen et al. 2019
+        act, _ = l2_similarity(c, p.view(1, PROTOTYPE_SIZE), self.epsilon)
         return act
     
     def __output_act_func(self, p_acts):        
@@ -168,6 +186,7 @@ class PWNet(nn.Module):
 
 
 
+@timer.timed('evaluate_loader')
 def evaluate_loader(model, loader, mse_loss):
     model.eval()
     total_loss = 0
@@ -213,6 +232,7 @@ if not os.path.exists(MODEL_DIR):
     os.makedirs(MODEL_DIR)
     
 #### Start Collecting Data To Form Final Mean and Standard Error Results
+store = ResultsStore('BipedalWalker', 'pwnet', dict(NUM_CLASSES=NUM_CLASSES, NUM_PROTOTYPES=NUM_PROTOTYPES, LATENT_SIZE=LATENT_SIZE, PROTOTYPE_SIZE=PROTOTYPE_SIZE, BATCH_SIZE=BATCH_SIZE, NUM_EPOCHS=NUM_EPOCHS), enabled=RESULTS_STORE)
 data_rewards = list()
 data_errors = list()
 
@@ -225,12 +245,14 @@ for iter in range(NUM_ITERATIONS):
     
     writer = SummaryWriter(f"runs/pwnet/Iteration_{iter}")
     
+    timer.start('data_load')
     X_train = np.load('data/X_train.npy')
     a_train = np.load('data/a_train.npy')
     tensor_x = torch.Tensor(X_train)
     tensor_y = torch.tensor(a_train, dtype=torch.float32)
     train_dataset = TensorDataset(tensor_x, tensor_y)
     train_loader = DataLoader(train_dataset, shuffle=True, batch_size=BATCH_SIZE)
+    timer.stop('data_load', samples=len(train_dataset))
 
     # Get prototypes
     human_concepts = {'Hip1_Forward':  [1., 0., 0., 0.], 'Hip1_Back' :     [-1., 0., 0., 0.],
@@ -276,9 +298,12 @@ for iter in range(NUM_ITERATIONS):
         model.train()
         
         if train_error < best_error:
+            timer.start('checkpoint')
             torch.save(  model.state_dict(), MODEL_DIR_ITER  )
+            timer.stop('checkpoint')
             best_error = train_error
         
+        timer.start('training_pass')
         for instances, labels in train_loader:
             
             optimizer.zero_grad()
@@ -293,10 +318,12 @@ for iter in range(NUM_ITERATIONS):
             optimizer.step()
             
             running_loss += loss.item()
+        timer.stop('training_pass', samples=len(train_dataset))
                     
         print("Epoch:", epoch, "Running Loss:", running_loss / len(train_loader), "Train error:", train_error)
         with open('results/pwnet_results.txt', 'a') as f:
             f.write(f"Epoch: {epoch}, Running Loss: {running_loss / len(train_loader)}, Train error: {train_error}\n")
+        store.log_epoch(iter, epoch, running_loss=running_loss / len(train_loader), train_error=train_error)
             
         writer.add_scalar("Running_loss", running_loss/len(train_loader), epoch)
         writer.add_scalar("Train_error", train_error, epoch)
@@ -317,46 +344,78 @@ for iter in range(NUM_ITERATIONS):
     
 
 
+    if OFFLINE_EVALUATION:
+        report = offline_fidelity(model, held_out_loader())
+        print("Held-out fidelity:", report)
+        with open('results/pwnet_results.txt', 'a') as f:
+            f.write(f"Held-out MSE: {report['mse']}, MSE per step: {report['mse_step']}\n")
+
+    if QUANTIZATION_REPORT:
+        report = quantization_report(model, train_loader)
+        print("Int8 wrapper:", report)
+        with open('results/pwnet_results.txt', 'a') as f:
+            f.write(f"Int8 MSE delta: {report['mse_delta']}, Step latency: {report['ms_float32']} ms -> {report['ms_int8']} ms\n")
+
     total_reward = list()
     all_errors = list()
     model.eval()
-    for ep in range(SIMULATION_EPOCHS):
-        ep_reward = 0
-        ep_errors = 0
-        state = env.reset()
-
-        for t in range(max_timesteps):
-            bb_action, x = policy.select_action(state)
-            A = model( torch.tensor(x, dtype=torch.float32).view(1, -1) )
-            state, reward, done, _ = env.step(A.detach().numpy()[0])
-
-            ep_reward += reward
-            ep_errors += mse_loss( torch.tensor(bb_action), A[0]).detach().item()
-
-            if done:
-                break
+    timer.start('simulation')
+    if VECTOR_SIMULATION:
+        total_reward, all_errors, lengths = simulate(policy, model, SIMULATION_EPOCHS, max_steps=max_timesteps)
+        timer.add(steps=sum(lengths))
+        for ep, ep_reward in enumerate(total_reward):
+            print('Episode: {}\tReward: {}'.format(ep, int(ep_reward)))
+    else:
+        stop = SequentialStop(max_episodes=SIMULATION_EPOCHS)
+        for ep in range(SIMULATION_EPOCHS):
+            ep_reward = 0
+            metrics = EpisodeMetrics()
+            state = env.reset()
+
+            for t in range(max_timesteps):
+                bb_action, x = policy.select_action(state)
+                A = model( torch.tensor(x, dtype=torch.float32).view(1, -1) )
+                state, reward, done, _ = env.step(A.detach().numpy()[0])
+                timer.add(steps=1)
+
+                ep_reward += reward
+                metrics.add_error(bb_action, A[0])
+
+                if done:
+                    break
                 
-        print('Episode: {}\tReward: {}'.format(ep, int(ep_reward)))
-        total_reward.append( ep_reward )
-        all_errors.append( ep_errors )
-        ep_reward = 0
+            print('Episode: {}\tReward: {}'.format(ep, int(ep_reward)))
+            total_reward.append( ep_reward )
+            all_errors.append( metrics.episode_error() )
+            ep_reward = 0
+            if EARLY_STOP and stop.update(total_reward[-1]):
+                break
+        if EARLY_STOP:
+            summary = stop.summary()
+            print("Early stop:", summary)
+            with open('results/pwnet_results.txt', 'a') as f:
+                f.write(f"Simulated episodes: {summary['episodes']}, saved: {summary['saved_episodes']} ({summary['reason']})\n")
+    timer.stop('simulation')
+    timer.log(writer, iter)
 
     env.close()  
 
-    data_rewards.append(  sum(total_reward) / SIMULATION_EPOCHS  )
-    data_errors.append(  sum(all_errors) / SIMULATION_EPOCHS )
-    print("Reward: ", sum(total_reward) / SIMULATION_EPOCHS)
-    print("MSE: ", sum(all_errors) / SIMULATION_EPOCHS )
+    data_rewards.append(  sum(total_reward) / len(total_reward)  )
+    data_errors.append(  sum(all_errors) / len(all_errors) )
+    store.log_iteration(iter, timer.last_iteration(), reward=data_rewards[-1], mse=data_errors[-1])
+    print("Reward: ", sum(total_reward) / len(total_reward))
+    print("MSE: ", sum(all_errors) / len(all_errors) )
 
     # log the reward and MAE
-    writer.add_scalar("Reward", sum(total_reward) / SIMULATION_EPOCHS, iter)
-    writer.add_scalar("MSE", sum(all_errors) / SIMULATION_EPOCHS, iter)
+    writer.add_scalar("Reward", sum(total_reward) / len(total_reward), iter)
+    writer.add_scalar("MSE", sum(all_errors) / len(all_errors), iter)
 
     with open('results/pwnet_results.txt', 'a') as f:
-        f.write(f"Reward: {sum(total_reward) / SIMULATION_EPOCHS}, MSE: {sum(all_errors) / SIMULATION_EPOCHS}\n")     
+        f.write(f"Reward: {sum(total_reward) / len(total_reward)}, MSE: {sum(all_errors) / len(all_errors)}\n")     
 
 data_errors = np.array(data_errors)
 data_rewards = np.array(data_rewards)
+timer.save('results/pwnet_timing.json')
 
 
 print(" ")
@@ -19,6 +19,14 @@ from torch.distributions import Beta
 from sklearn.neighbors import KNeighborsRegressor
 from random import sample
 from tqdm import tqdm
+from quantization import quantization_report
+from prototype_ops import l2_similarity
+from vector_simulation import simulate
+from offline_evaluation import held_out_loader, offline_fidelity
+from early_stop import SequentialStop
+from instrumentation import PhaseTimer
+from results_store import ResultsStore
+from metrics import EpisodeMetrics
 from time import sleep
 
 NUM_ITERATIONS = 15
@@ -33,6 +41,18 @@ PROTOTYPE_SIZE = 50
 MAX_SAMPLES = 100000
 delay_ms = 0
 SIMULATION_EPOCHS = 30
+QUANTIZATION_REPORT = False  # compare the trained wrapper with its int8 copy before the simulation
+VECTOR_SIMULATION = False  # play the simulation episodes together on worker processes, batching the agent and the wrapper forward
+OFFLINE_EVALUATION = False  # fidelity on the held-out trajectories recorded by collect_data.py with HELD_OUT = True
+EARLY_STOP = False  # stop the simulation once the reward mean is known well enough (early_stop.SequentialStop)
+TIMING = False  # per-phase wall time and throughput to the SummaryWriter and a JSON summary in results/ (instrumentation.PhaseTimer), synchronizes CUDA at each phase boundary
+RESULTS_STORE = True  # epoch and iteration metrics (and the phase timings) in the SQLite results/results.db, see results_store.aggregate
+
+if VECTOR_SIMULATION and EARLY_STOP:
+    # the sequential test needs the episodes in the order they are played, the vector simulation ends the short ones first
+    raise ValueError("EARLY_STOP only applies to the sequential simulation, set VECTOR_SIMULATION = False")
+
+timer = PhaseTimer(enabled=TIMING)
 
 
 env_name = "BipedalWalker-v3"
@@ -83,13 +103,10 @@ class PPPNet(nn.Module):
         self.linear.weight.data.copy_(custom_weight_matrix.T)   
         
     def __proto_layer_l2(self, x):
-        #output = list()
         b_size = x.shape[0]
-        p = self.prototypes.T.view(1, PROTOTYPE_SIZE, NUM_PROTOTYPES).tile(b_size, 1, 1).to(DEVICE) 
-        c = x.view(b_size, PROTOTYPE_SIZE, 1).tile(1, 1, NUM_PROTOTYPES).to(DEVICE)            
-        l2s = ( (c - p)**2 ).sum(axis=1).to(DEVICE) 
+        c = x.view(b_size, PROTOTYPE_SIZE)
         # similarity function from Chen et al. 2019
-        act = torch.log( (l2s + 1. ) / (l2s + self.epsilon) ).to(DEVICE)   
+        act, l2s = l2_similarity(c, self.prototypes, self.epsilon)
         return act, l2s
     
     def __output_act_func(self, p_acts):        
@@ -103,6 +120,7 @@ class PPPNet(nn.Module):
         return final_outputs, x
 
 
+@timer.timed('evaluate_loader')
 def evaluate_loader(model, loader, mse_loss):
     model.eval()
     total_loss = 0
@@ -122,33 +140,23 @@ def evaluate_loader(model, loader, mse_loss):
 
 
 
-def clust_loss(x, y, model, criterion):
+def clust_loss(x, y, model):
     """
     Forces each prototype to be close to training data
+    x is the batch already transformed into the new feature space by the forward
     """
     
     ps = model.prototypes  # take prototypes in new feature space
-    model = model.eval()
-    x = model.main(instances)  # transform into new feature space
-    b_size = x.shape[0]
-    for idx, p in enumerate(ps):
-        target = p.repeat(b_size, 1)
-        if idx == 0:
-            loss = criterion(x, target) 
-        else:
-            loss += criterion(x, target)
-    model = model.train()  
-    return loss
-
-
-def sep_loss(x, y, model, criterion):
+    # sum over the prototypes of the MSE between the batch and each prototype, in one broadcast
+    return ((x.unsqueeze(1) - ps.unsqueeze(0))**2).mean(dim=(0, 2)).sum()
+
+
+def sep_loss(x, y, model):
     """
     Force each prototype to be far from eachother
     """
     
     p = model.prototypes  # take prototypes in new feature space
-    model = model.eval()
-    x = model.main(x)  # transform into new feature space
     #pnorm distance
     loss = torch.cdist(p, p).sum() / ((NUM_PROTOTYPES**2 - NUM_PROTOTYPES) / 2)
     return -loss 
@@ -161,6 +169,7 @@ with open('results/pwnet_star_star_results.txt', 'a') as f:
     f.write(f"model_pwnet_star_star\n")
     f.write(f"NUM_PROTOTYPES: {NUM_PROTOTYPES}\n")
 
+store = ResultsStore('BipedalWalker', 'pwnet_star_star', dict(NUM_CLASSES=NUM_CLASSES, NUM_PROTOTYPES=NUM_PROTOTYPES, LATENT_SIZE=LATENT_SIZE, PROTOTYPE_SIZE=PROTOTYPE_SIZE, BATCH_SIZE=BATCH_SIZE, NUM_EPOCHS=NUM_EPOCHS), enabled=RESULTS_STORE)
 data_rewards = list()
 data_errors = list()
 
@@ -181,6 +190,7 @@ for iter in range(NUM_ITERATIONS):
                 
     writer = SummaryWriter(f"runs/pwnet_star_star/Iteration_{iter}")
 
+    timer.start('data_load')
     X_train = np.load('data/X_train.npy')
     a_train = np.load('data/a_train.npy')
     obs_train = np.load('data/obs_train.npy')
@@ -189,6 +199,7 @@ for iter in range(NUM_ITERATIONS):
     tensor_y = torch.tensor(a_train, dtype=torch.float32)
     train_dataset = TensorDataset(tensor_x, tensor_y)
     train_loader = DataLoader(train_dataset, shuffle=True, batch_size=BATCH_SIZE)
+    timer.stop('data_load', samples=len(train_dataset))
 
 
     #### Train
@@ -225,13 +236,16 @@ for iter in range(NUM_ITERATIONS):
         
         
         if train_error < best_error:
+            timer.start('checkpoint')
             torch.save(model.state_dict(), MODEL_DIR_ITER)
+            timer.stop('checkpoint')
             best_error = train_error
 
         # prototype projection every 2 epochs
         if epoch >= 10 and epoch % 4 == 0:
             print("Projecting prototypes...")
 
+            timer.start('projection')
             trans_x = list()
             model.eval()
             with torch.no_grad():
@@ -267,27 +281,31 @@ for iter in range(NUM_ITERATIONS):
             #model.prototypes = torch.nn.Parameter(tensor_proj_prototypes.to(DEVICE))
             with torch.no_grad():
                 model.prototypes.copy_(tensor_proj_prototypes.to(DEVICE))
+            timer.stop('projection', samples=len(X_train))
             model.train()
 
 
+        timer.start('training_pass')
         for instances, labels in train_loader:
             optimizer.zero_grad()
                     
             instances, labels = instances.to(DEVICE), labels.to(DEVICE)
-            logits, _ = model(instances)
+            logits, x = model(instances)
                     
             loss1 = mse_loss(logits, labels) * lambda1
-            loss2 = clust_loss(instances, labels, model, mse_loss) * lambda2
-            loss3 = sep_loss(instances, labels, model, mse_loss) * lambda3
+            loss2 = clust_loss(x, labels, model) * lambda2
+            loss3 = sep_loss(x, labels, model) * lambda3
             loss  = loss1 + loss2 + loss3   
             running_loss += loss.item()
              
             loss.backward()
             optimizer.step()
+        timer.stop('training_pass', samples=len(train_dataset))
             
         print("Epoch:", epoch, "Running Loss:", running_loss / len(train_loader), "Train error:", train_error)
         with open('results/pwnet_star_star_results.txt', 'a') as f:
             f.write(f"Epoch: {epoch}, Running Loss: {running_loss / len(train_loader)}, Train error: {train_error}\n")
+        store.log_epoch(iter, epoch, running_loss=running_loss / len(train_loader), train_error=train_error)
         
         writer.add_scalar("Running_loss", running_loss/len(train_loader), epoch)
         writer.add_scalar("Train_error", train_error, epoch)
@@ -300,42 +318,74 @@ for iter in range(NUM_ITERATIONS):
 
     # Wapper model with learned weights
     model.eval()
+    if OFFLINE_EVALUATION:
+        report = offline_fidelity(model, held_out_loader())
+        print("Held-out fidelity:", report)
+        with open('results/pwnet_star_star_results.txt', 'a') as f:
+            f.write(f"Held-out MSE: {report['mse']}, MSE per step: {report['mse_step']}\n")
+
+    if QUANTIZATION_REPORT:
+        report = quantization_report(model, train_loader)
+        print("Int8 wrapper:", report)
+        with open('results/pwnet_star_star_results.txt', 'a') as f:
+            f.write(f"Int8 MSE delta: {report['mse_delta']}, Step latency: {report['ms_float32']} ms -> {report['ms_int8']} ms\n")
+
     total_reward = list()
     all_errors = list()
-    for ep in tqdm(range(SIMULATION_EPOCHS)):
-        ep_reward = 0
-        ep_errors = 0
-        state = env.reset()
-        for t in range(max_timesteps):
-            bb_action, x = policy.select_action(state)
-            A, _ = model( torch.tensor(x, dtype=torch.float32).view(1, -1) )
-            state, reward, done, _ = env.step(A.detach().numpy()[0])
-            ep_reward += reward
-            ep_errors += mse_loss( torch.tensor(bb_action), A[0]).detach().item()
-
-            if done:
+    timer.start('simulation')
+    if VECTOR_SIMULATION:
+        total_reward, all_errors, lengths = simulate(policy, model, SIMULATION_EPOCHS, max_steps=max_timesteps)
+        timer.add(steps=sum(lengths))
+        for ep, ep_reward in enumerate(total_reward):
+            print('Episode: {}\tReward: {}'.format(ep, int(ep_reward)))
+    else:
+        stop = SequentialStop(max_episodes=SIMULATION_EPOCHS)
+        for ep in tqdm(range(SIMULATION_EPOCHS)):
+            ep_reward = 0
+            metrics = EpisodeMetrics()
+            state = env.reset()
+            for t in range(max_timesteps):
+                bb_action, x = policy.select_action(state)
+                A, _ = model( torch.tensor(x, dtype=torch.float32).view(1, -1) )
+                state, reward, done, _ = env.step(A.detach().numpy()[0])
+                timer.add(steps=1)
+                ep_reward += reward
+                metrics.add_error(bb_action, A[0])
+
+                if done:
+                    break
+
+            print('Episode: {}\tReward: {}'.format(ep, int(ep_reward)))
+            total_reward.append( ep_reward )
+            all_errors.append( metrics.episode_error() )
+            ep_reward = 0
+            if EARLY_STOP and stop.update(total_reward[-1]):
                 break
-
-        print('Episode: {}\tReward: {}'.format(ep, int(ep_reward)))
-        total_reward.append( ep_reward )
-        all_errors.append( ep_errors )
-        ep_reward = 0
+        if EARLY_STOP:
+            summary = stop.summary()
+            print("Early stop:", summary)
+            with open('results/pwnet_star_star_results.txt', 'a') as f:
+                f.write(f"Simulated episodes: {summary['episodes']}, saved: {summary['saved_episodes']} ({summary['reason']})\n")
+    timer.stop('simulation')
+    timer.log(writer, iter)
         
     env.close()  
-    data_rewards.append(  sum(total_reward) / SIMULATION_EPOCHS  )
-    data_errors.append(  sum(all_errors) / SIMULATION_EPOCHS )
-    print("Reward: ", sum(total_reward) / SIMULATION_EPOCHS)
-    print("MSE: ", sum(all_errors) / SIMULATION_EPOCHS )
+    data_rewards.append(  sum(total_reward) / len(total_reward)  )
+    data_errors.append(  sum(all_errors) / len(all_errors) )
+    store.log_iteration(iter, timer.last_iteration(), reward=data_rewards[-1], mse=data_errors[-1])
+    print("Reward: ", sum(total_reward) / len(total_reward))
+    print("MSE: ", sum(all_errors) / len(all_errors) )
     
     # log the reward and MAE
-    writer.add_scalar("Reward", sum(total_reward) / SIMULATION_EPOCHS, iter)
-    writer.add_scalar("MSE", sum(all_errors) / SIMULATION_EPOCHS, iter)
+    writer.add_scalar("Reward", sum(total_reward) / len(total_reward), iter)
+    writer.add_scalar("MSE", sum(all_errors) / len(all_errors), iter)
     
     with open('results/pwnet_star_star_results.txt', 'a') as f:
-        f.write(f"Reward: {sum(total_reward) / SIMULATION_EPOCHS}, MSE: {sum(all_errors) / SIMULATION_EPOCHS}\n")
+        f.write(f"Reward: {sum(total_reward) / len(total_reward)}, MSE: {sum(all_errors) / len(all_errors)}\n")
     
 data_errors = np.array(data_errors)
 data_rewards = np.array(data_rewards)
+timer.save('results/pwnet_star_star_timing.json')
 
 print(" ")
 print("===== Data MAE:")
@@ -23,6 +23,16 @@ from os.path import join
 from itertools import combinations
 from torch.distributions import Beta
 from tqdm import tqdm
+from quantization import quantization_report
+from sparse_sharedpwnet import SparseSharedPwNet
+from prototype_ops import l2_similarity
+from vector_simulation import simulate
+from offline_evaluation import held_out_loader, offline_fidelity
+from early_stop import SequentialStop
+from instrumentation import PhaseTimer
+from results_store import ResultsStore
+from pipeline_cache import PipelineCache
+from metrics import EpisodeMetrics
 from sklearn.neighbors import KNeighborsRegressor
 from sklearn.cluster import KMeans
 
@@ -47,6 +57,21 @@ LATENT_SIZE = 300
 PROTOTYPE_SIZE = 50
 DEVICE = 'cuda'
 SIMULATION_EPOCHS = 30 
+QUANTIZATION_REPORT = False  # compare the trained wrapper with its int8 copy before the simulation
+SPARSE_INFERENCE = False  # simulate with the hard-assignment model, computing only the used prototypes
+VECTOR_SIMULATION = False  # play the simulation episodes together on worker processes, batching the agent and the wrapper forward
+OFFLINE_EVALUATION = False  # fidelity on the held-out trajectories recorded by collect_data.py with HELD_OUT = True
+EARLY_STOP = False  # stop the simulation once the reward mean is known well enough (early_stop.SequentialStop)
+TIMING = False  # per-phase wall time and throughput to the SummaryWriter and a JSON summary in results/ (instrumentation.PhaseTimer), synchronizes CUDA at each phase boundary
+RESULTS_STORE = True  # epoch and iteration metrics (and the phase timings) in the SQLite results/results.db, see results_store.aggregate
+PIPELINE_CACHE = False  # skip the init, train and simulation stages whose inputs are unchanged, restoring their outputs from cache/ (pipeline_cache.PipelineCache)
+
+if VECTOR_SIMULATION and EARLY_STOP:
+    # the sequential test needs the episodes in the order they are played, the vector simulation ends the short ones first
+    raise ValueError("EARLY_STOP only applies to the sequential simulation, set VECTOR_SIMULATION = False")
+
+timer = PhaseTimer(enabled=TIMING)
+cache = PipelineCache(enabled=PIPELINE_CACHE)
 
 name_file = "run_sharedpwnet"
 
@@ -87,43 +112,51 @@ def normalize_list(values):
     normalized_values = [(x - min_value) / (max_value - min_value) for x in values]
     return normalized_values
 
-list_actions = {}
-medians = {}
-for actions in a_train:
-    for action_id in range(NUM_CLASSES):
-        list_actions[action_id] = []
-        a = actions[action_id]
-        list_actions[action_id].append(a)
+DATASET_FILES = ['data/X_train.npy', 'data/a_train.npy']  # inputs of the cached init and train stages
+init_key = cache.key('init', files=DATASET_FILES, config=dict(NUM_CLASSES=NUM_CLASSES, NUM_SLOTS_PER_CLASS=NUM_SLOTS_PER_CLASS))
+if cache.done('init', init_key):
+    prototypes = list(cache.load('init', init_key)['centres'])
+else:
+    list_actions = {}
+    medians = {}
+    for actions in a_train:
+        for action_id in range(NUM_CLASSES):
+            list_actions[action_id] = []
+            a = actions[action_id]
+            list_actions[action_id].append(a)
         
-for action_id in range(NUM_CLASSES):        
-    m = np.median(list_actions[action_id])
-    medians[action_id] = m
+    for action_id in range(NUM_CLASSES):        
+        m = np.median(list_actions[action_id])
+        medians[action_id] = m
 
-states_actions_zip = []
-for state, action in zip(X_train, a_train):
-	states_actions_zip.append((state, action))
+    states_actions_zip = []
+    for state, action in zip(X_train, a_train):
+        states_actions_zip.append((state, action))
 
-state_actions = {}
-for action_id in range(NUM_CLASSES): 						
-	state_actions[action_id] = []						
+    state_actions = {}
+    for action_id in range(NUM_CLASSES): 						
+        state_actions[action_id] = []						
 
-	action_values = [x[1][action_id] for x in states_actions_zip]   
+        action_values = [x[1][action_id] for x in states_actions_zip]   
 
-	median = medians[action_id]
+        median = medians[action_id]
         
-	diff = [np.abs(p-median) for p in action_values]
-	normalized_diff = normalize_list(diff)
+        diff = [np.abs(p-median) for p in action_values]
+        normalized_diff = normalize_list(diff)
 
-	probs_50_perc = np.percentile(normalized_diff, 50)			
+        probs_50_perc = np.percentile(normalized_diff, 50)			
 
-	for (state, action), action_probs in zip(states_actions_zip, normalized_diff):
-		if action_probs > probs_50_perc:
-			state_actions[action_id].append(state)		# state_actions = {0: [stato1>50,stato2>50, stato3>50, ...]  1: , 2: }
+        for (state, action), action_probs in zip(states_actions_zip, normalized_diff):
+            if action_probs > probs_50_perc:
+                state_actions[action_id].append(state)		# state_actions = {0: [stato1>50,stato2>50, stato3>50, ...]  1: , 2: }
 
-prototypes = []
+    timer.start('init_kmeans')
+    prototypes = []
 
-for action_id in range(NUM_CLASSES):
-	prototypes.append(KMeans(NUM_SLOTS_PER_CLASS, n_init="auto").fit(state_actions[action_id]).cluster_centers_)   # prototypes = [[p11,p12,p13],[p21,p22,p23],[p31,p32,p33],]
+    for action_id in range(NUM_CLASSES):
+        prototypes.append(KMeans(NUM_SLOTS_PER_CLASS, n_init="auto").fit(state_actions[action_id]).cluster_centers_)   # prototypes = [[p11,p12,p13],[p21,p22,p23],[p31,p32,p33],]
+    timer.stop('init_kmeans')
+    cache.save('init', init_key, centres=np.array(prototypes))
 
 ordered_prototypes = []
 
@@ -176,12 +209,9 @@ class SharedPwNet(nn.Module):
             transf_proto.append(self.projection_network(self.prototypes[i].view(1, -1)))
         latent_protos = torch.cat(transf_proto, dim=0) 
         
-        p = latent_protos.T.view(1, PROTOTYPE_SIZE, NUM_PROTOTYPES).tile(b_size, 1, 1).to(DEVICE) 
-        c = x.view(b_size, PROTOTYPE_SIZE, 1).tile(1, 1, NUM_PROTOTYPES).to(DEVICE)    
-                
-        l2s = ( (c - p)**2 ).sum(axis=1).to(DEVICE) 
+        c = x.view(b_size, PROTOTYPE_SIZE)
         # similarity function from Chen et al. 2019: to score the distance between state c and prototype p
-        similarity = torch.log( (l2s + 1. ) / (l2s + self.epsilon) ).to(DEVICE)  
+        similarity, _ = l2_similarity(c, latent_protos, self.epsilon)
         return similarity # (batch, NUM_PROTOTYPES)
     
     def output_activations(self, out):
@@ -206,6 +236,7 @@ class SharedPwNet(nn.Module):
         out2 = self.output_activations(out1)
         return out2, x, similarity, proto_presence
 
+@timer.timed('evaluate_loader')
 def evaluate_loader(model, gumbel_scalar, loader, loss, tau):
     model.eval()
     total_loss = 0
@@ -281,6 +312,7 @@ with open(results_file, 'a') as f:
     f.write(f"NUM_SLOTS: {NUM_SLOTS_PER_CLASS}\n")
 
 
+store = ResultsStore('BipedalWalker', 'sharedpwnet', dict(NUM_CLASSES=NUM_CLASSES, NUM_PROTOTYPES=NUM_PROTOTYPES, NUM_SLOTS_PER_CLASS=NUM_SLOTS_PER_CLASS, new_proto_init=args.new_proto_init, LATENT_SIZE=LATENT_SIZE, PROTOTYPE_SIZE=PROTOTYPE_SIZE, BATCH_SIZE=BATCH_SIZE, NUM_EPOCHS=NUM_EPOCHS), enabled=RESULTS_STORE)
 data_rewards = list()
 data_errors = list()
 
@@ -305,6 +337,7 @@ for iter in range(NUM_ITERATIONS):
     writer = SummaryWriter(f"runs/{date}_{name_file}_p{NUM_PROTOTYPES}_s{NUM_SLOTS_PER_CLASS}/Iteration_{iter}")
 
     # TO SAVE PROTOTYPES
+    timer.start('data_load')
     obs_train = np.load('data/obs_train.npy')
     
     X_train = np.load('data/X_train.npy')
@@ -315,6 +348,7 @@ for iter in range(NUM_ITERATIONS):
     tensor_y = torch.tensor(a_train, dtype=torch.float32)
     train_dataset = TensorDataset(tensor_x, tensor_y)
     train_loader = DataLoader(train_dataset, shuffle=True, batch_size=BATCH_SIZE)
+    timer.stop('data_load', samples=len(train_dataset))
     
     #### Train
     model = SharedPwNet().eval()
@@ -337,144 +371,157 @@ for iter in range(NUM_ITERATIONS):
     
     running_loss = running_loss_mse = running_loss_clst = running_loss_sep = running_loss_l1 =  running_loss_ortho = 0.
     
-    for epoch in range(NUM_EPOCHS):
+    train_key = cache.key('train', files=DATASET_FILES, config=dict(NUM_EPOCHS=NUM_EPOCHS, BATCH_SIZE=BATCH_SIZE, NUM_PROTOTYPES=NUM_PROTOTYPES, PROTOTYPE_SIZE=PROTOTYPE_SIZE, clst_weight=clst_weight, sep_weight=sep_weight, l1_weight=l1_weight, start_val=start_val, end_val=end_val, epoch_interval=epoch_interval, new_proto_init=args.new_proto_init, iteration=iter), code=[SharedPwNet, dist_loss, lambda1, evaluate_loader, maximum, cache.module_source(l2_similarity), cache.stage_source(__file__, 'train')], upstream=[init_key])
+    if cache.done('train', train_key):
+        schedule = cache.load('train', train_key, files=[MODEL_DIR_ITER], directories=[prototype_path])
+        gumbel_scalar, tau = schedule['gumbel_scalar'], schedule['tau']
+    else:
+        for epoch in range(NUM_EPOCHS):
 
-        model.eval()
-        gumbel_scalar = lambda1(epoch)
+            model.eval()
+            gumbel_scalar = lambda1(epoch)
             
-        if epoch == 0:
-            tau = 1
-        elif (epoch + 1) % 8 == 0 and tau > 0.3:
-            tau = 0.8 * tau   
+            if epoch == 0:
+                tau = 1
+            elif (epoch + 1) % 8 == 0 and tau > 0.3:
+                tau = 0.8 * tau   
         
-        train_error = evaluate_loader(model, gumbel_scalar, train_loader, mse_loss, tau)
-        model.train()
+            train_error = evaluate_loader(model, gumbel_scalar, train_loader, mse_loss, tau)
+            model.train()
 
-        if train_error < best_error and epoch > NUM_EPOCHS-20:
-            torch.save(model.state_dict(), MODEL_DIR_ITER) # saves model parameters
-            best_error = train_error
+            if train_error < best_error and epoch > NUM_EPOCHS-20:
+                timer.start('checkpoint')
+                torch.save(model.state_dict(), MODEL_DIR_ITER) # saves model parameters
+                timer.stop('checkpoint')
+                best_error = train_error
         
-        # prototype projection every 2 epochs
-        if epoch >= 10 and epoch % 2 == 0 and epoch < NUM_EPOCHS-20:
-            #print("Projecting prototypes...")
-            transformed_x = list()
-            model.eval()
-            with torch.no_grad():
-                for i in range(len(X_train)):
-                    img = X_train[i]
-                    img_tensor = torch.tensor(img, dtype=torch.float32).view(1, -1) # (1, 256)
-                    _, x, _, _ = model(img_tensor.to(DEVICE), gumbel_scalar, tau)
-                    # x è lo stato s dopo la projection network
-                    transformed_x.append(x[0].tolist())
-            transformed_x = np.array(transformed_x)
+            # prototype projection every 2 epochs
+            if epoch >= 10 and epoch % 2 == 0 and epoch < NUM_EPOCHS-20:
+                #print("Projecting prototypes...")
+                timer.start('projection')
+                transformed_x = list()
+                model.eval()
+                with torch.no_grad():
+                    for i in range(len(X_train)):
+                        img = X_train[i]
+                        img_tensor = torch.tensor(img, dtype=torch.float32).view(1, -1) # (1, 256)
+                        _, x, _, _ = model(img_tensor.to(DEVICE), gumbel_scalar, tau)
+                        # x è lo stato s dopo la projection network
+                        transformed_x.append(x[0].tolist())
+                transformed_x = np.array(transformed_x)
             
-            list_projected_prototype = list()
-            for i in range(NUM_PROTOTYPES):
-                trained_p = model.projection_network(model.prototypes)
-                trained_prototype_clone = trained_p.clone().detach()[i].view(1,-1)
-                trained_prototype = trained_prototype_clone.cpu()
-                knn = KNeighborsRegressor(algorithm='brute')
-                knn.fit(transformed_x, list(range(len(transformed_x)))) 
-                dist, transf_idx = knn.kneighbors(X=trained_prototype, n_neighbors=1, return_distance=True)
-                projected_prototype = X_train[transf_idx.item()] # transformed_x[transf_idx.item()]
-                list_projected_prototype.append(projected_prototype.tolist())
+                list_projected_prototype = list()
+                for i in range(NUM_PROTOTYPES):
+                    trained_p = model.projection_network(model.prototypes)
+                    trained_prototype_clone = trained_p.clone().detach()[i].view(1,-1)
+                    trained_prototype = trained_prototype_clone.cpu()
+                    knn = KNeighborsRegressor(algorithm='brute')
+                    knn.fit(transformed_x, list(range(len(transformed_x)))) 
+                    dist, transf_idx = knn.kneighbors(X=trained_prototype, n_neighbors=1, return_distance=True)
+                    projected_prototype = X_train[transf_idx.item()] # transformed_x[transf_idx.item()]
+                    list_projected_prototype.append(projected_prototype.tolist())
                 
-                if epoch == NUM_EPOCHS-20-2: 
-                    print("I'm saving prototypes' images in prototypes/ directory...")
-                    prototype_image = obs_train[transf_idx.item()]
-                    prototype_image = Image.fromarray(prototype_image, 'RGB')
-                    p_path = prototype_path+f'p{i+1}.png'
-                    prototype_image.save(p_path)
+                    if epoch == NUM_EPOCHS-20-2: 
+                        print("I'm saving prototypes' images in prototypes/ directory...")
+                        prototype_image = obs_train[transf_idx.item()]
+                        prototype_image = Image.fromarray(prototype_image, 'RGB')
+                        p_path = prototype_path+f'p{i+1}.png'
+                        prototype_image.save(p_path)
                 
-            trained_prototypes = model.prototypes.clone().detach()
-            tensor_projected_prototype = torch.tensor(list_projected_prototype, dtype=torch.float32) # (num_prot, 50)
-            #model.prototypes = torch.nn.Parameter(tensor_projected_prototype.to(DEVICE))
-            with torch.no_grad():
-                model.prototypes.copy_(tensor_projected_prototype.to(DEVICE))
-            model.train()
+                trained_prototypes = model.prototypes.clone().detach()
+                tensor_projected_prototype = torch.tensor(list_projected_prototype, dtype=torch.float32) # (num_prot, 50)
+                #model.prototypes = torch.nn.Parameter(tensor_projected_prototype.to(DEVICE))
+                with torch.no_grad():
+                    model.prototypes.copy_(tensor_projected_prototype.to(DEVICE))
+                timer.stop('projection', samples=len(X_train))
+                model.train()
             
-        # freezed prototypes and projection network, training only proto_presence (prototype assignment) + class_identity_layer (last layer)
-        if epoch >= NUM_EPOCHS-20:
-            for name, param in model.named_parameters():
-                if "prototypes" in name: 
-                    param.requires_grad = False 
-                elif "projection_network" in name:
-                    param.requires_grad = False 
+            # freezed prototypes and projection network, training only proto_presence (prototype assignment) + class_identity_layer (last layer)
+            if epoch >= NUM_EPOCHS-20:
+                for name, param in model.named_parameters():
+                    if "prototypes" in name: 
+                        param.requires_grad = False 
+                    elif "projection_network" in name:
+                        param.requires_grad = False 
                         
-        for instances, labels in train_loader:
-            optimizer.zero_grad()
+            timer.start('training_pass')
+            for instances, labels in train_loader:
+                optimizer.zero_grad()
                     
-            instances, labels = instances.to(DEVICE), labels.to(DEVICE)
-            logits, _, similarity, proto_presence = model(instances, gumbel_scalar, tau)
+                instances, labels = instances.to(DEVICE), labels.to(DEVICE)
+                logits, _, similarity, proto_presence = model(instances, gumbel_scalar, tau)
         
                 
-            loss1 = mse_loss(logits, labels) 
+                loss1 = mse_loss(logits, labels) 
 
                 
-            # orthogonal loss --> for slots orthogonality: in this way successive slots of a class are assigned to different prototypes
-            orthogonal_loss = torch.Tensor([0]).to(DEVICE)
-
-            for c in range(model.proto_presence.shape[0]): # NUM_CLASSES
-                list_p = list(range(1, model.proto_presence.shape[1]+1))
-                for (i,j) in list(combinations(list_p, 2)):
-                    s1 = model.proto_presence[c][i-1].view(1,-1)
-                    s2 = model.proto_presence[c][j-1].view(1,-1)
-                    sim = cosine_similarity(s1, s2, dim=1).sum()
-                    orthogonal_loss += sim
-            orthogonal_loss = orthogonal_loss / (NUM_SLOTS_PER_CLASS * NUM_CLASSES) - 1
+                # orthogonal loss --> for slots orthogonality: in this way successive slots of a class are assigned to different prototypes
+                orthogonal_loss = torch.Tensor([0]).to(DEVICE)
+
+                for c in range(model.proto_presence.shape[0]): # NUM_CLASSES
+                    list_p = list(range(1, model.proto_presence.shape[1]+1))
+                    for (i,j) in list(combinations(list_p, 2)):
+                        s1 = model.proto_presence[c][i-1].view(1,-1)
+                        s2 = model.proto_presence[c][j-1].view(1,-1)
+                        sim = cosine_similarity(s1, s2, dim=1).sum()
+                        orthogonal_loss += sim
+                orthogonal_loss = orthogonal_loss / (NUM_SLOTS_PER_CLASS * NUM_CLASSES) - 1
             
-            labels_p = labels.cpu().numpy().tolist()
-            labels_pp = list()
-            for label in (labels_p):
-                #label = 4 continuous actions: hip torque, knee torque for each leg each from -1.0 to 1.0
-                max_value = maximum(abs(label[0]), abs(label[1]), abs(label[2]), abs(label[3]))
-                if max_value == abs(label[0]):
-                    labels_pp.append(0)  
-                elif max_value == abs(label[1]):
-                    labels_pp.append(1)
-                elif max_value == abs(label[2]):
-                    labels_pp.append(2)
-                else:
-                    labels_pp.append(3)
+                labels_p = labels.cpu().numpy().tolist()
+                labels_pp = list()
+                for label in (labels_p):
+                    #label = 4 continuous actions: hip torque, knee torque for each leg each from -1.0 to 1.0
+                    max_value = maximum(abs(label[0]), abs(label[1]), abs(label[2]), abs(label[3]))
+                    if max_value == abs(label[0]):
+                        labels_pp.append(0)  
+                    elif max_value == abs(label[1]):
+                        labels_pp.append(1)
+                    elif max_value == abs(label[2]):
+                        labels_pp.append(2)
+                    else:
+                        labels_pp.append(3)
                                     
-            proto_presence = proto_presence[labels_pp] 
-            inverted_proto_presence = 1 - proto_presence
-            labels.to(DEVICE)
+                proto_presence = proto_presence[labels_pp] 
+                inverted_proto_presence = 1 - proto_presence
+                labels.to(DEVICE)
                 
-            clst_loss_val = dist_loss(model, similarity, proto_presence, NUM_SLOTS_PER_CLASS)  
-            sep_loss_val = dist_loss(model, similarity, inverted_proto_presence, NUM_PROTOTYPES - NUM_SLOTS_PER_CLASS) 
+                clst_loss_val = dist_loss(model, similarity, proto_presence, NUM_SLOTS_PER_CLASS)  
+                sep_loss_val = dist_loss(model, similarity, inverted_proto_presence, NUM_PROTOTYPES - NUM_SLOTS_PER_CLASS) 
             
-            # to remove
-            #prototypes_of_correct_class = proto_presence.sum(dim=-1).detach() # dovrebbe essere size: [num class, num prot]
-            #prototypes_of_wrong_class = 1 - prototypes_of_correct_class
-            #avg_separation_cost = torch.sum(similarity * prototypes_of_wrong_class, dim=1) / torch.sum(prototypes_of_wrong_class,dim=1)
-            #avg_separation_cost = torch.mean(avg_separation_cost)
+                # to remove
+                #prototypes_of_correct_class = proto_presence.sum(dim=-1).detach() # dovrebbe essere size: [num class, num prot]
+                #prototypes_of_wrong_class = 1 - prototypes_of_correct_class
+                #avg_separation_cost = torch.sum(similarity * prototypes_of_wrong_class, dim=1) / torch.sum(prototypes_of_wrong_class,dim=1)
+                #avg_separation_cost = torch.mean(avg_separation_cost)
             
-            l1_mask = 1 - torch.t(model.prototype_class_identity).cuda()
-            l1 = (model.class_identity_layer.weight * l1_mask).norm(p=1)
-            # We use the following weighting schema for loss function: L entropy = 1.0, L clst = 0.8, L sep = −0.08, L orth = 1.0, and L l 1 = 10 −4 . Finally, 
-            # we normalize L orth , dividing it by the number of classes multiplied by the number of slots per class. (page 20)
-            loss = loss1 + clst_loss_val * clst_weight + sep_loss_val * sep_weight + l1 * l1_weight + orthogonal_loss 
+                l1_mask = 1 - torch.t(model.prototype_class_identity).cuda()
+                l1 = (model.class_identity_layer.weight * l1_mask).norm(p=1)
+                # We use the following weighting schema for loss function: L entropy = 1.0, L clst = 0.8, L sep = −0.08, L orth = 1.0, and L l 1 = 10 −4 . Finally, 
+                # we normalize L orth , dividing it by the number of classes multiplied by the number of slots per class. (page 20)
+                loss = loss1 + clst_loss_val * clst_weight + sep_loss_val * sep_weight + l1 * l1_weight + orthogonal_loss 
             
-            running_loss_mse += loss1.item()
-            running_loss_clst += clst_loss_val.item() * clst_weight
-            running_loss_sep += sep_loss_val.item() * sep_weight
-            running_loss_l1 += l1.item() * l1_weight
-            running_loss_ortho += orthogonal_loss.item() 
-            running_loss += loss.item()
-
-            loss.backward()
-            optimizer.step()
+                running_loss_mse += loss1.item()
+                running_loss_clst += clst_loss_val.item() * clst_weight
+                running_loss_sep += sep_loss_val.item() * sep_weight
+                running_loss_l1 += l1.item() * l1_weight
+                running_loss_ortho += orthogonal_loss.item() 
+                running_loss += loss.item()
+
+                loss.backward()
+                optimizer.step()
+            timer.stop('training_pass', samples=len(train_dataset))
     
-        print("Epoch:", epoch, "Running Loss:", running_loss / len(train_loader), "Train error:", train_error)
-        with open(results_file, 'a') as f:
-            f.write(f"Epoch: {epoch}, Running Loss: {running_loss / len(train_loader)}, Train error: {train_error}\n")
-
-        writer.add_scalar("Running_loss", running_loss/len(train_loader), epoch)
-        writer.add_scalar("Train_error", train_error, epoch)
-        running_loss = running_loss_mse = running_loss_clst = running_loss_sep = running_loss_l1 =  running_loss_ortho = 0.
+            print("Epoch:", epoch, "Running Loss:", running_loss / len(train_loader), "Train error:", train_error)
+            with open(results_file, 'a') as f:
+                f.write(f"Epoch: {epoch}, Running Loss: {running_loss / len(train_loader)}, Train error: {train_error}\n")
+            store.log_epoch(iter, epoch, running_loss=running_loss / len(train_loader), train_error=train_error)
+
+            writer.add_scalar("Running_loss", running_loss/len(train_loader), epoch)
+            writer.add_scalar("Train_error", train_error, epoch)
+            running_loss = running_loss_mse = running_loss_clst = running_loss_sep = running_loss_l1 =  running_loss_ortho = 0.
             
-        scheduler.step()
+            scheduler.step()
+        cache.save('train', train_key, files=[MODEL_DIR_ITER], directories=[prototype_path], gumbel_scalar=gumbel_scalar, tau=tau)
     
     #states, actions, rewards, log_probs, values, dones, X_train = [], [], [], [], [], [], []
 
@@ -485,45 +532,91 @@ for iter in range(NUM_ITERATIONS):
     model.to(DEVICE)
     print("Checking for the error... :", evaluate_loader(model, gumbel_scalar, train_loader, mse_loss, tau))
 
+    if OFFLINE_EVALUATION:
+        report = offline_fidelity(model, held_out_loader(), gumbel_scalar, tau)
+        print("Held-out fidelity:", report)
+        with open(results_file, 'a') as f:
+            f.write(f"Held-out MSE: {report['mse']}, MSE per step: {report['mse_step']}\n")
+
+    if QUANTIZATION_REPORT:
+        report = quantization_report(model, train_loader, gumbel_scalar, tau)
+        print("Int8 wrapper:", report)
+        with open(results_file, 'a') as f:
+            f.write(f"Int8 MSE delta: {report['mse_delta']}, Step latency: {report['ms_float32']} ms -> {report['ms_int8']} ms\n")
+
+    if SPARSE_INFERENCE:
+        model = SparseSharedPwNet(model, gumbel_scalar, tau).to(DEVICE)
+        report = model.pruning_report()
+        print("Sparse wrapper:", report)
+        print("Checking for the error (sparse)... :", evaluate_loader(model, gumbel_scalar, train_loader, mse_loss, tau))
+        with open(results_file, 'a') as f:
+            f.write(f"Used prototypes: {report['used_prototypes']}, Pruned prototypes: {report['pruned_prototypes']}, Min presence: {report['min_presence']}\n")
+
     total_reward = list()
     all_errors = list()
     model.eval()
-    for ep in tqdm(range(SIMULATION_EPOCHS)):
-        ep_reward = 0
-        ep_errors = 0
-        state = env.reset()
-
-        for t in range(max_timesteps):
-            bb_action, x = policy.select_action(state)
-            A, _, _, _ = model( torch.tensor(x, dtype=torch.float32).view(1, -1).to(DEVICE), gumbel_scalar, tau )
-            state, reward, done, _ = env.step(A.detach().cpu().numpy()[0])
-
-            ep_reward += reward
-            ep_errors += mse_loss( torch.tensor(bb_action).to(DEVICE), A[0]).detach().item()
-
-            if done:
-                break
-
-        print('Episode: {}\tReward: {}'.format(ep, int(ep_reward)))
-        total_reward.append( ep_reward )
-        all_errors.append( ep_errors )
-        ep_reward = 0
+    simulation_key = cache.key('simulation', files=[f'{directory}/{filename}_actor.pth'], config=dict(simulations=SIMULATION_EPOCHS, VECTOR_SIMULATION=VECTOR_SIMULATION, EARLY_STOP=EARLY_STOP, SPARSE_INFERENCE=SPARSE_INFERENCE, max_timesteps=max_timesteps), code=[cache.stage_source(__file__, 'simulation'), cache.module_source(simulate), cache.module_source(SequentialStop), cache.module_source(SparseSharedPwNet), cache.module_source(EpisodeMetrics), cache.module_source(TD3)], upstream=[train_key])
+    if cache.done('simulation', simulation_key):
+        simulation = cache.load('simulation', simulation_key)
+        total_reward, all_errors = simulation['total_reward'], simulation['all_errors']
+    else:
+        timer.start('simulation')
+        if VECTOR_SIMULATION:
+            total_reward, all_errors, lengths = simulate(policy, model, SIMULATION_EPOCHS, gumbel_scalar, tau, max_steps=max_timesteps)
+            timer.add(steps=sum(lengths))
+            for ep, ep_reward in enumerate(total_reward):
+                print('Episode: {}\tReward: {}'.format(ep, int(ep_reward)))
+        else:
+            stop = SequentialStop(max_episodes=SIMULATION_EPOCHS)
+            for ep in tqdm(range(SIMULATION_EPOCHS)):
+                ep_reward = 0
+                metrics = EpisodeMetrics()
+                state = env.reset()
+
+                for t in range(max_timesteps):
+                    bb_action, x = policy.select_action(state)
+                    A, _, _, _ = model( torch.tensor(x, dtype=torch.float32).view(1, -1).to(DEVICE), gumbel_scalar, tau )
+                    state, reward, done, _ = env.step(A.detach().cpu().numpy()[0])
+                    timer.add(steps=1)
+
+                    ep_reward += reward
+                    metrics.add_error(bb_action, A[0])
+
+                    if done:
+                        break
+
+                print('Episode: {}\tReward: {}'.format(ep, int(ep_reward)))
+                total_reward.append( ep_reward )
+                all_errors.append( metrics.episode_error() )
+                ep_reward = 0
+                if EARLY_STOP and stop.update(total_reward[-1]):
+                    break
+            if EARLY_STOP:
+                summary = stop.summary()
+                print("Early stop:", summary)
+                with open(results_file, 'a') as f:
+                    f.write(f"Simulated episodes: {summary['episodes']}, saved: {summary['saved_episodes']} ({summary['reason']})\n")
+        timer.stop('simulation')
+        cache.save('simulation', simulation_key, total_reward=total_reward, all_errors=all_errors)
+    timer.log(writer, iter)
     
     env.close()
 
-    data_rewards.append(sum(total_reward) / SIMULATION_EPOCHS)
-    data_errors.append(sum(all_errors) / SIMULATION_EPOCHS)
-    print("Reward: ", sum(total_reward) / SIMULATION_EPOCHS)
-    print("MSE: ", sum(all_errors) / SIMULATION_EPOCHS)
+    data_rewards.append(sum(total_reward) / len(total_reward))
+    data_errors.append(sum(all_errors) / len(all_errors))
+    store.log_iteration(iter, timer.last_iteration(), reward=data_rewards[-1], mse=data_errors[-1])
+    print("Reward: ", sum(total_reward) / len(total_reward))
+    print("MSE: ", sum(all_errors) / len(all_errors))
     # log the reward and MAE
-    writer.add_scalar("Reward", sum(total_reward) / SIMULATION_EPOCHS, iter)
-    writer.add_scalar("MSE", sum(all_errors) / SIMULATION_EPOCHS, iter)
+    writer.add_scalar("Reward", sum(total_reward) / len(total_reward), iter)
+    writer.add_scalar("MSE", sum(all_errors) / len(all_errors), iter)
     
     with open(results_file, 'a') as f:
-        f.write(f"Reward: {sum(total_reward) / SIMULATION_EPOCHS}, MSE: {sum(all_errors) / SIMULATION_EPOCHS}\n")
+        f.write(f"Reward: {sum(total_reward) / len(total_reward)}, MSE: {sum(all_errors) / len(all_errors)}\n")
 
 data_errors = np.array(data_errors)
 data_rewards = np.array(data_rewards)
+timer.save(results_file.replace('_results', '_timing').replace('.txt', '.json'))
 
 print(" ")
 print("===== Data MAE:")
@@ -28,7 +28,7 @@ def test():
         ep_reward = 0
         state = env.reset()
         for t in range(max_timesteps):
-            action = policy.select_action(state)
+            action, _ = policy.select_action(state)
             state, reward, done, _ = env.step(action)
             ep_reward += reward
             if render:
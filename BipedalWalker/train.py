@@ -1,7 +1,7 @@
 import torch
 import gym
 import numpy as np
-from TD3 import TD3
+from TD3 import TD3, device
 from utils import ReplayBuffer
 
 def train():
@@ -17,6 +17,8 @@ def train():
     policy_noise = 0.2          # target policy smoothing noise
     noise_clip = 0.5
     policy_delay = 2            # delayed policy updates parameter
+    prefetch = device.type == 'cuda'  # sample the next batch in a background thread during the update (no overlap on CPU)
+    fused_critics = True        # both critics in one TwinCritic, evaluated with batched matmuls
     max_episodes = 1000         # max num of episodes
     max_timesteps = 2000        # max timesteps in one episode
     directory = "./preTrained/{}".format(env_name) # save trained models
@@ -28,7 +30,7 @@ def train():
     action_dim = env.action_space.shape[0]
     max_action = float(env.action_space.high[0])
     
-    policy = TD3(lr, state_dim, action_dim, max_action)
+    policy = TD3(lr, state_dim, action_dim, max_action, fused_critics)
     replay_buffer = ReplayBuffer()
     
     if random_seed:
@@ -47,7 +49,7 @@ def train():
         state = env.reset()
         for t in range(max_timesteps):
             # select action and add exploration noise:
-            action = policy.select_action(state)
+            action, _ = policy.select_action(state)
             action = action + np.random.normal(0, exploration_noise, size=env.action_space.shape[0])
             action = action.clip(env.action_space.low, env.action_space.high)
             
@@ -61,7 +63,7 @@ def train():
             
             # if episode is done then update policy:
             if done or t==(max_timesteps-1):
-                policy.update(replay_buffer, t, batch_size, gamma, polyak, policy_noise, noise_clip, policy_delay)
+                policy.update(replay_buffer, t, batch_size, gamma, polyak, policy_noise, noise_clip, policy_delay, prefetch)
                 break
         
         # logging updates:
@@ -1,32 +1,78 @@
+import queue
+import threading
+
 import numpy as np
+import torch
 
 class ReplayBuffer:
     def __init__(self, max_size=5e5):
-        self.buffer = []
         self.max_size = int(max_size)
         self.size = 0
-    
+        self.position = 0  # next slot to write, the oldest transition is overwritten once full
+        self.storage = None
+
+    def _allocate(self, transition):
+        # ring arrays, shaped from the first transition
+        state, action, _, _, _ = transition
+        self.storage = (
+            np.zeros((self.max_size, *np.shape(state)), dtype=np.float32),
+            np.zeros((self.max_size, *np.shape(action)), dtype=np.float32),
+            np.zeros(self.max_size, dtype=np.float32),
+            np.zeros((self.max_size, *np.shape(state)), dtype=np.float32),
+            np.zeros(self.max_size, dtype=np.float32),
+        )
+
     def add(self, transition):
-        self.size +=1
         # transiton is tuple of (state, action, reward, next_state, done)
-        self.buffer.append(transition)
-    
+        if self.storage is None:
+            self._allocate(transition)
+        for array, value in zip(self.storage, transition):
+            array[self.position] = value
+        self.position = (self.position + 1) % self.max_size
+        self.size = min(self.size + 1, self.max_size)
+
+    def __len__(self):
+        return self.size
+
     def sample(self, batch_size):
-        # delete 1/5th of the buffer when full
-        if self.size > self.max_size:
-            del self.buffer[0:int(self.size/5)]
-            self.size = len(self.buffer)
-        
-        indexes = np.random.randint(0, len(self.buffer), size=batch_size)
-        state, action, reward, next_state, done = [], [], [], [], []
-        
-        for i in indexes:
-            s, a, r, s_, d = self.buffer[i]
-            state.append(np.array(s, copy=False))
-            action.append(np.array(a, copy=False))
-            reward.append(np.array(r, copy=False))
-            next_state.append(np.array(s_, copy=False))
-            done.append(np.array(d, copy=False))
-        
-        return np.array(state), np.array(action), np.array(reward), np.array(next_state), np.array(done)
-    
+        indexes = np.random.randint(0, self.size, size=batch_size)
+        state, action, reward, next_state, done = (array[indexes] for array in self.storage)
+        return state, action, reward, next_state, done
+
+    def sample_tensors(self, batch_size, device):
+        """
+        Same batch of sample as tensors on device, with reward and done as (batch_size, 1) columns
+        """
+        state, action, reward, next_state, done = self.sample(batch_size)
+        reward, done = reward.reshape(-1, 1), done.reshape(-1, 1)
+        pin = torch.device(device).type == 'cuda'
+        return tuple(_to_device(torch.from_numpy(array), device, pin) for array in (state, action, reward, next_state, done))
+
+
+def _to_device(tensor, device, pin):
+    # pinned host memory lets the copy to the GPU run asynchronously
+    return tensor.pin_memory().to(device, non_blocking=True) if pin else tensor.to(device)
+
+
+def prefetch_batches(replay_buffer, n_batches, batch_size, device, depth=2):
+    """
+    Yields n_batches of replay_buffer.sample_tensors, sampled and moved to device by a background thread
+    up to depth batches ahead, while the caller runs the update on the previous one.
+    The buffer must not be written until all the batches are consumed.
+    An exception of the sampling is raised in the caller.
+    """
+    batches = queue.Queue(maxsize=depth)
+
+    def producer():
+        try:
+            for _ in range(n_batches):
+                batches.put(replay_buffer.sample_tensors(batch_size, device))
+        except Exception as error:
+            batches.put(error)
+
+    threading.Thread(target=producer, daemon=True).start()
+    for _ in range(n_batches):
+        batch = batches.get()
+        if isinstance(batch, Exception):
+            raise batch
+        yield batch
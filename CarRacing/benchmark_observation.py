@@ -0,0 +1,63 @@
+import time
+from collections import deque
+from copy import deepcopy
+
+import numpy as np
+import torch
+
+from games.carracing import CarRacing
+
+
+NUM_STEPS = 5000
+FRAME_STACK = 4
+
+
+def legacy_pipeline(frames):
+    """
+    Observation pipeline of the wrapper before the ring buffer: deepcopy of the raw frame, float64 grayscale,
+    stack rebuilt from a deque and copied again by torch.tensor
+    """
+    grayscale = np.array([0.299, 0.587, 0.114])
+    frame_buf = deque([np.zeros((96, 96))] * FRAME_STACK, maxlen=FRAME_STACK)
+    start = time.perf_counter()
+    for frame in frames:
+        deepcopy(frame)
+        frame_buf.append(np.dot(frame, grayscale) / 255.0)
+        torch.tensor(np.array(frame_buf), dtype=torch.float32).unsqueeze(0)
+    return len(frames) / (time.perf_counter() - start)
+
+
+def ring_pipeline(env, frames):
+    """
+    Same observations with the float32 ring buffer of the wrapper, handed to torch without copies
+    """
+    start = time.perf_counter()
+    for frame in frames:
+        env.push_frame(frame)
+        torch.from_numpy(env.get_observation()).unsqueeze(0)
+    return len(frames) / (time.perf_counter() - start)
+
+
+def env_step_rate(env, n_steps=NUM_STEPS):
+    """
+    Steps per second of the wrapper (Box2D simulation and state rendering included) with random actions
+    """
+    env.reset()
+    start = time.perf_counter()
+    for _ in range(n_steps):
+        state, _, done, _, _ = env.step(env.action_space.sample())
+        torch.from_numpy(state).unsqueeze(0)
+        if done:
+            env.reset()
+    return n_steps / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    env = CarRacing(frame_skip=0, frame_stack=FRAME_STACK)
+    frames = np.random.randint(0, 256, size=(NUM_STEPS, 96, 96, 3), dtype=np.uint8)
+
+    legacy = legacy_pipeline(frames)
+    ring = ring_pipeline(env, frames)
+    print(f"observation pipeline: {legacy:.0f} -> {ring:.0f} frames/s ({ring / legacy:.2f}x)")
+    print(f"env step rate: {env_step_rate(env):.1f} steps/s")
+    env.close()
@@ -0,0 +1,61 @@
+import os
+import time
+
+import toml
+import torch
+
+from games.carracing import RacingNet, CarRacing
+from ppo import PPO
+from render_policy import RenderPolicy
+
+
+CONFIG_FILE = "config.toml"
+NUM_STEPS = 2000  # steps of every measured rollout
+NUM_WARMUP = 100
+# rgb_array renders the same frame of the window without needing a display, so it also runs headless
+POLICIES = {
+    'never': RenderPolicy.never(),
+    'every_10_steps': RenderPolicy.every_n_steps(10, mode='rgb_array'),
+    'every_step': RenderPolicy.every_n_steps(1, mode='rgb_array'),
+    'record_first_episode': RenderPolicy.record([1], mode='rgb_array'),
+}
+
+
+def load_config():
+    with open(CONFIG_FILE, "r") as f:
+        config = toml.load(f)
+    return config
+
+
+def rollout_throughput(ppo, n_steps=NUM_STEPS, n_warmup=NUM_WARMUP):
+    """
+    Steps per second of PPO.collect_trajectory (policy forward, env step, rendering and GAE)
+    """
+    with torch.no_grad():
+        ppo.collect_trajectory(n_warmup)
+        start = time.perf_counter()
+        ppo.collect_trajectory(n_steps)
+    return n_steps / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    cfg = load_config()
+    results = dict()
+
+    for name, render_policy in POLICIES.items():
+        env = CarRacing(frame_skip=0, frame_stack=4)
+        net = RacingNet(env.observation_space.shape, env.action_space.shape)
+        ppo = PPO(env, net, horizon=cfg["horizon"], render_policy=render_policy)
+        if os.path.exists("weights/agent_weights.pt"):
+            ppo.load("weights/agent_weights.pt")
+
+        results[name] = rollout_throughput(ppo)
+        env.close()
+        print(f"{name}: {results[name]:.1f} steps/s")
+
+    if not os.path.exists('results/'):
+        os.makedirs('results/')
+    with open('results/render_benchmark.txt', 'a') as f:
+        f.write(f"NUM_STEPS: {NUM_STEPS}\n")
+        for name, steps_per_second in results.items():
+            f.write(f"{name}: {steps_per_second:.1f} steps/s ({steps_per_second / results['never']:.2f}x never)\n")
@@ -15,6 +15,7 @@ from tqdm import tqdm
 CONFIG_FILE = "config.toml"
 device = 'cpu'
 NUM_EPISODES = 30
+HELD_OUT = False  # record held-out trajectories for offline_evaluation.py instead of the training data
 
 if not os.path.exists('weights/'):
     os.mkdir('weights/')
@@ -85,8 +86,9 @@ for ep in tqdm(range(NUM_EPISODES)):
 		next_state, reward, done, info, real_action = ppo.env.step(input_action.cpu().numpy())
 		next_state = ppo._to_tensor(next_state)
 
-		img_array = env.render(mode='rgb_array')
-		ep_states.append(img_array)
+		if not HELD_OUT:  # the held-out set keeps no observations
+			img_array = env.render(mode='rgb_array')
+			ep_states.append(img_array)
   
 		# Store the transition
 		ep_actions.append(real_action.tolist())
@@ -101,7 +103,8 @@ for ep in tqdm(range(NUM_EPISODES)):
 	#print(count)
 
 	# Store the transition
-	states.append(ep_states) # prototypes
+	if not HELD_OUT:
+		states.append(ep_states) # prototypes
 	real_actions.append(ep_actions) # actions
 	X_train.append(ep_x) # states 
 	rew += reward
@@ -110,12 +113,18 @@ for ep in tqdm(range(NUM_EPISODES)):
 print("average reward per episode :", sum(reward_arr) / NUM_EPISODES)
 
 
-with open('data/X_train.pkl', 'wb') as f:
-	pickle.dump(X_train, f)
-with open('data/real_actions.pkl', 'wb') as f:
-	pickle.dump(real_actions, f)
-with open('data/obs_train.pkl', 'wb') as f:
- 	pickle.dump(states, f)
+if HELD_OUT:
+	# flattened as in the run scripts, with the episode of every step
+	np.save('data/X_held_out.npy', np.array([x for ep_x in X_train for x in ep_x]))
+	np.save('data/a_held_out.npy', np.array([a for ep_actions in real_actions for a in ep_actions]))
+	np.save('data/ep_held_out.npy', np.array([ep for ep, ep_x in enumerate(X_train) for _ in ep_x]))
+else:
+	with open('data/X_train.pkl', 'wb') as f:
+		pickle.dump(X_train, f)
+	with open('data/real_actions.pkl', 'wb') as f:
+		pickle.dump(real_actions, f)
+	with open('data/obs_train.pkl', 'wb') as f:
+	 	pickle.dump(states, f)
 
 #with open('data/saved_materials.pkl', 'wb') as f:
 #	pickle.dump(saved_materials, f)
@@ -3,8 +3,8 @@ from torch import nn
 import gym
 from gym.spaces import Box
 import numpy as np
-from collections import deque
-from copy import deepcopy
+
+from render_policy import RenderPolicy
 
 
 
@@ -67,7 +67,7 @@ class RacingNet(nn.Module):
 
 
 class CarRacing(gym.Wrapper):
-    def __init__(self, frame_skip=0, frame_stack=4):
+    def __init__(self, frame_skip=0, frame_stack=4, render_policy=None):
         self.env = gym.make("CarRacing-v1")
         super().__init__(self.env)
 
@@ -77,13 +77,21 @@ class CarRacing(gym.Wrapper):
         self.action_space = Box(low=0, high=1, shape=(2,))
         self.observation_space = Box(low=0, high=1, shape=(frame_stack, 96, 96))
 
-        self.frame_buf = deque(maxlen=frame_stack)
+        # ring buffer of the last frame_stack frames, each frame written twice (at i and i + frame_stack):
+        # frames[head + 1 : head + 1 + frame_stack] are always the stacked frames in order, without copies
+        self.frames = np.zeros((2 * frame_stack, 96, 96), dtype=np.float32)
+        self.head = frame_stack - 1
+        # grayscale and scaling to [0, 1] in a single float32 dot product
+        self.grayscale = np.array([0.299, 0.587, 0.114], dtype=np.float32) / 255.0
 
         self.t = 0
         self.last_reward_step = 0
         self.total_reward = 0
         self.n_episodes = 0
 
+        # headless by default: rendering the window costs more than the step itself
+        self.render_policy = render_policy if render_policy is not None else RenderPolicy.never()
+
 
     def preprocess(self, original_action):
         original_action = original_action * 2 - 1  # map from [0, 1] to [-1, 1]
@@ -98,18 +106,21 @@ class CarRacing(gym.Wrapper):
 
         return action
 
-    def postprocess(self, original_observation):
+    def postprocess(self, original_observation, out=None):
         # convert to grayscale
-        grayscale = np.array([0.299, 0.587, 0.114])
-        observation = np.dot(original_observation, grayscale) / 255.0
-
-        return observation
+        return np.dot(original_observation, self.grayscale, out=out)
 
     def shape_reward(self, reward):
         return np.clip(reward, -1, 1)
 
+    def push_frame(self, original_observation):
+        self.head = (self.head + 1) % self.frame_stack
+        self.postprocess(original_observation, out=self.frames[self.head])
+        self.frames[self.head + self.frame_stack] = self.frames[self.head]
+
     def get_observation(self):
-        return np.array(self.frame_buf)
+        # a view on the ring buffer: valid until the next step or reset
+        return self.frames[self.head + 1:self.head + 1 + self.frame_stack]
 
     def reset(self):
 
@@ -118,10 +129,8 @@ class CarRacing(gym.Wrapper):
         self.n_episodes += 1
         self.total_reward = 0
 
-        first_frame = self.postprocess(self.env.reset())
-
-        for _ in range(self.frame_stack):
-            self.frame_buf.append(first_frame)
+        self.push_frame(self.env.reset())
+        self.frames[:] = self.frames[self.head]
 
         return self.get_observation()
 
@@ -146,10 +155,10 @@ class CarRacing(gym.Wrapper):
 
         reward = total_reward / (self.frame_skip + 1)
 
-        real_frame = deepcopy(new_frame)
+        self.push_frame(new_frame)
 
-        new_frame = self.postprocess(new_frame)
-        self.frame_buf.append(new_frame)
+        if self.render_policy(self.n_episodes, self.t):
+            self.env.render(mode=self.render_policy.mode)
 
-        return self.get_observation(), reward, done, info, torch.tensor(action)  #, real_frame
+        return self.get_observation(), reward, done, info, torch.as_tensor(action)
 
@@ -0,0 +1,124 @@
+import functools
+import json
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import torch
+
+
+def _new_record():
+    return {'seconds': 0., 'calls': 0, 'samples': 0, 'steps': 0}
+
+
+def _with_rates(record):
+    record = dict(record)
+    if record['samples'] and record['seconds']:
+        record['samples_per_s'] = record['samples'] / record['seconds']
+    if record['steps'] and record['seconds']:
+        record['steps_per_s'] = record['steps'] / record['seconds']
+    return record
+
+
+class PhaseTimer:
+    """
+    Wall time and throughput of the phases of a run (data load, training pass, projection, simulation...).
+    Phases can be nested: a phase started while another one is open is recorded as "outer/inner".
+    Each phase counts the samples (e.g. training instances) and the env steps added to it while open,
+    reported as samples/s and steps/s. The phases of the current iteration go to a SummaryWriter with log,
+    the totals of the whole run to a JSON summary with save. With enabled=False every call is a no-op.
+    """
+
+    def __init__(self, enabled=True, sync_cuda=True):
+        self.enabled = enabled
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()  # CUDA kernels run asynchronously
+        self.open = list()  # [name, start time, samples, steps] of the open phases, the innermost last
+        self.iteration = defaultdict(_new_record)
+        self.iterations = list()
+        self.totals = defaultdict(_new_record)
+
+    def _now(self):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def start(self, name):
+        if self.enabled:
+            self.open.append([name, self._now(), 0, 0])
+
+    def add(self, samples=0, steps=0):
+        """
+        Counts samples and env steps in the innermost open phase
+        """
+        if self.enabled and self.open:
+            self.open[-1][2] += samples
+            self.open[-1][3] += steps
+
+    def stop(self, name, samples=0, steps=0):
+        if not self.enabled:
+            return
+        if not self.open or self.open[-1][0] != name:
+            raise ValueError(f"stop of phase {name} while {self.open[-1][0] if self.open else 'none'} is open")
+        path = '/'.join(phase[0] for phase in self.open)
+        _, start, open_samples, open_steps = self.open.pop()
+        seconds = self._now() - start
+        for records in (self.iteration, self.totals):
+            record = records[path]
+            record['seconds'] += seconds
+            record['calls'] += 1
+            record['samples'] += open_samples + samples
+            record['steps'] += open_steps + steps
+
+    @contextmanager
+    def phase(self, name, samples=0, steps=0):
+        self.start(name)
+        try:
+            yield self
+        finally:
+            self.stop(name, samples, steps)
+
+    def timed(self, name):
+        """
+        Decorator that records every call of the function as the phase name
+        """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.phase(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def log(self, writer, step):
+        """
+        Writes the phases recorded since the last log to writer (Time/<phase> in seconds, Throughput/<phase>
+        in samples/s or steps/s) and starts a new iteration. Phases timed before the first log belong to it.
+        """
+        if not self.enabled:
+            return
+        for path, record in self.iteration.items():
+            record = _with_rates(record)
+            writer.add_scalar(f"Time/{path}", record['seconds'], step)
+            if 'samples_per_s' in record:
+                writer.add_scalar(f"Throughput/{path}_samples_per_s", record['samples_per_s'], step)
+            if 'steps_per_s' in record:
+                writer.add_scalar(f"Throughput/{path}_steps_per_s", record['steps_per_s'], step)
+        self.iterations.append({path: _with_rates(record) for path, record in self.iteration.items()})
+        self.iteration = defaultdict(_new_record)
+
+    def last_iteration(self):
+        """
+        Phases of the last logged iteration, with their rates (empty when disabled)
+        """
+        return self.iterations[-1] if self.iterations else dict()
+
+    def summary(self):
+        return {
+            'total': {path: _with_rates(record) for path, record in self.totals.items()},
+            'iterations': self.iterations,
+        }
+
+    def save(self, path):
+        if self.enabled:
+            with open(path, 'w') as f:
+                json.dump(self.summary(), f, indent=2)
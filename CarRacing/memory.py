@@ -1,27 +1,31 @@
 import torch
-from torch.utils.data import Dataset
 
 
-class Memory(Dataset):
-    def __init__(self, states, actions, log_probs, rewards, advantages, values) -> None:
-        super().__init__()
+class RolloutBuffer:
+    """
+    Preallocated storage of one PPO rollout: filled in place step by step by collect_trajectory
+    and reused for every rollout, read in shuffled minibatches of indices.
+    Every tensor is (horizon, n_envs, ...), the transitions of all the envs are shuffled together.
+    """
 
-        self.states = states
-        self.actions = actions
-        self.log_probs = log_probs
-        self.rewards = rewards
-        self.advantages = advantages
-        self.values = values
+    def __init__(self, horizon, state_shape, action_dim, device, n_envs=1) -> None:
+        self.horizon = horizon
+        self.n_envs = n_envs
+        self.states = torch.zeros((horizon, n_envs, *state_shape), dtype=torch.float32, device=device)
+        self.actions = torch.zeros((horizon, n_envs, action_dim), dtype=torch.float32, device=device)
+        self.log_probs = torch.zeros((horizon, n_envs), dtype=torch.float32, device=device)
+        self.rewards = torch.zeros((horizon, n_envs), dtype=torch.float32, device=device)
+        self.dones = torch.zeros((horizon, n_envs), dtype=torch.float32, device=device)
+        self.values = torch.zeros((horizon, n_envs), dtype=torch.float32, device=device)
+        self.advantages = torch.zeros((horizon, n_envs), dtype=torch.float32, device=device)
 
     def __len__(self):
-        return len(self.states)
+        return self.horizon * self.n_envs
 
-    def __getitem__(self, idx):
-        return (
-            self.states[idx],
-            self.actions[idx],
-            self.log_probs[idx],
-            self.rewards[idx],
-            self.advantages[idx],
-            self.values[idx],
-        )
+    def minibatches(self, batch_size):
+        # same batches of DataLoader(shuffle=True), gathered with one index per tensor instead of item by item
+        tensors = [t.flatten(0, 1) for t in (self.states, self.actions, self.log_probs, self.rewards, self.advantages, self.values)]
+        idxs = torch.randperm(len(self), device=self.states.device)
+        for start in range(0, len(self), batch_size):
+            idx = idxs[start:start + batch_size]
+            yield tuple(t[idx] for t in tensors)
@@ -0,0 +1,28 @@
+import numpy as np
+import torch
+
+
+class EpisodeMetrics:
+    """
+    Per-step MSE between the black-box and the wrapper actions, summed over the episode.
+    The black-box actions stay on the host and the wrapper actions on their device until the end of the
+    episode, then the black-box ones are copied once and the error is reduced there (one host sync).
+    """
+
+    def __init__(self):
+        self.bb_actions = list()
+        self.actions = list()
+
+    def add_error(self, bb_action, action):
+        self.bb_actions.append(np.asarray(bb_action, dtype=np.float32).reshape(-1))
+        self.actions.append(action.detach().reshape(-1))
+
+    def episode_error(self):
+        # same as the sum over the steps of nn.MSELoss()(bb_action, action)
+        if not self.actions:
+            return 0.
+        actions = torch.stack(self.actions)
+        bb_actions = torch.from_numpy(np.stack(self.bb_actions)).to(actions.device, actions.dtype)
+        error = float(((bb_actions - actions)**2).mean(dim=1).sum())
+        self.bb_actions, self.actions = list(), list()
+        return error
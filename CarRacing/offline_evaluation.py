@@ -0,0 +1,48 @@
+import numpy as np
+import torch
+from torch.utils.data import TensorDataset, DataLoader
+
+from prototype_ops import wrapper_outputs
+
+
+# written by collect_data.py with HELD_OUT = True
+HELD_OUT_FILES = ('data/X_held_out.npy', 'data/a_held_out.npy', 'data/ep_held_out.npy')
+BATCH_SIZE = 4096
+
+
+def held_out_loader(batch_size=BATCH_SIZE):
+    """
+    Latents, black-box actions and episode of every step of the held-out trajectories, in order
+    """
+    x, a, ep = (np.load(f) for f in HELD_OUT_FILES)
+    dataset = TensorDataset(torch.tensor(x, dtype=torch.float32),
+                            torch.tensor(a, dtype=torch.float32),
+                            torch.tensor(ep, dtype=torch.long))
+    return DataLoader(dataset, batch_size=batch_size, shuffle=False)
+
+
+def offline_fidelity(model, loader, *model_args):
+    """
+    MSE between the wrapper and the black-box actions on the held-out trajectories, in large batches.
+    'mse' is summed over the steps of each episode and averaged over the episodes, as the MSE of the
+    simulation; 'mse_step' is the mean per step.
+    The states are the ones visited by the agent, not by the wrapper: the reward still needs the simulation.
+    """
+    device = next(model.parameters()).device
+    model.eval()
+    errors, episodes = list(), list()
+    with torch.inference_mode():
+        for x, a, ep in loader:
+            action = wrapper_outputs(model(x.to(device, non_blocking=True), *model_args))
+            errors.append(((a.to(device, non_blocking=True) - action)**2).mean(dim=1))
+            episodes.append(ep.to(device, non_blocking=True))
+    errors = torch.cat(errors)
+    _, episodes = torch.unique(torch.cat(episodes), return_inverse=True)
+    ep_errors = torch.zeros(int(episodes.max()) + 1, device=device).index_add_(0, episodes, errors)
+
+    report = dict()
+    report['mse'] = ep_errors.mean().item()
+    report['mse_step'] = errors.mean().item()
+    report['n_episodes'] = len(ep_errors)
+    report['n_steps'] = len(errors)
+    return report
@@ -5,11 +5,11 @@ import numpy as np
 import torch
 from torch import nn, optim
 from torch.distributions import Beta
-from torch.utils.data import DataLoader
 from os import path
 from time import sleep
 
-from memory import Memory
+from memory import RolloutBuffer
+from render_policy import RenderPolicy
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -17,7 +17,7 @@ device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 class PPO:
     def __init__(
         self,
-        env: gym.Env,
+        env: gym.Env,  # a CarRacing wrapper, or a gym.vector env of them (vector_simulation.make_training_envs)
         net: nn.Module,
         lr: float = 1e-4,
         batch_size: int = 128,
@@ -31,6 +31,7 @@ class PPO:
         entropy_coef: float = 0.01,
         save_dir: str = "ckpt",
         save_interval: int = 100,
+        render_policy: RenderPolicy = None,
     ) -> None:
         self.env = env
         self.net = net.to(device)
@@ -47,11 +48,23 @@ class PPO:
         self.entropy_coef = entropy_coef
         self.save_dir = save_dir
         self.save_interval = save_interval
+        # rollouts are not rendered unless asked: training usually runs headless
+        self.render_policy = render_policy if render_policy is not None else RenderPolicy.never()
 
         self.optim = optim.Adam(self.net.parameters(), lr=self.lr)
 
-        self.state = self._to_tensor(env.reset())
+        # with a vector env every rollout has horizon steps of each env, and the policy forward is batched over them
+        self.vectorized = isinstance(env, gym.vector.VectorEnv)
+        self.n_envs = env.num_envs if self.vectorized else 1
+        observation_space = env.single_observation_space if self.vectorized else env.observation_space
+        action_space = env.single_action_space if self.vectorized else env.action_space
+
+        self.state = self._to_batch(env.reset())
         self.alpha = 1.0
+        self.episode = 1
+        self.episode_step = 0
+
+        self.memory = RolloutBuffer(horizon, observation_space.shape, action_space.shape[0], device, self.n_envs)
 
     def train(self):
         for step in range(self.num_steps):
@@ -60,10 +73,6 @@ class PPO:
             with torch.no_grad():
                 memory = self.collect_trajectory(self.horizon)
 
-            memory_loader = DataLoader(
-                memory, batch_size=self.batch_size, shuffle=True,
-            )
-
             avg_loss = 0.0
 
             for epoch in range(self.epochs_per_step):
@@ -74,7 +83,7 @@ class PPO:
                     rewards,
                     advantages,
                     values,
-                ) in memory_loader:
+                ) in memory.minibatches(self.batch_size):
                     loss, _, _, _ = self.train_batch(
                         states, actions, log_probs, rewards, advantages, values
                     )
@@ -99,7 +108,7 @@ class PPO:
     ):
         self.optim.zero_grad()
 
-        values, alpha, beta = self.net(states)
+        values, alpha, beta, _ = self.net(states)
         values = values.squeeze(1)
 
         policy = Beta(alpha, beta)
@@ -132,56 +141,49 @@ class PPO:
 
         return loss.item(), policy_loss.item(), value_loss.item(), entropy_loss.item()
 
-    def collect_trajectory(self, num_steps: int, delay_ms: int = 0) -> Memory:
-        states, actions, rewards, log_probs, values, dones = [], [], [], [], [], []
+    def collect_trajectory(self, num_steps: int, delay_ms: int = 0) -> RolloutBuffer:
+        if num_steps != self.memory.horizon:
+            self.memory = RolloutBuffer(num_steps, self.memory.states.shape[2:], self.memory.actions.shape[2], device, self.n_envs)
+        memory = self.memory
+        # rewards and dones come from the env as numpy/python scalars: copied to the buffer once at the end
+        rewards = np.zeros((num_steps, self.n_envs), dtype=np.float32)
+        dones = np.zeros((num_steps, self.n_envs), dtype=np.float32)
 
         for t in range(num_steps):
-            # Run one step of the environment based on the current policy
-            value, alpha, beta = self.net(self.state)
-            value, alpha, beta = value.squeeze(0), alpha.squeeze(0), beta.squeeze(0)
+            # Run one step of the environments based on the current policy
+            value, alpha, beta, _ = self.net(self.state)
 
             policy = Beta(alpha, beta)
             action = policy.sample()
-            log_prob = policy.log_prob(action).sum()
+            log_prob = policy.log_prob(action).sum(dim=1)
 
-            next_state, reward, done, _, _ = self.env.step(action.cpu().numpy())
+            # Store the transition (the state first: it can be a view on the frames the env is about to overwrite)
+            memory.states[t] = self.state
 
-            if done:
-                next_state = self.env.reset()
+            next_state, reward, done = self._step(action.cpu().numpy())
 
-            next_state = self._to_tensor(next_state)
-
-            # Store the transition
-            states.append(self.state)
-            actions.append(action)
-            rewards.append(reward)
-            log_probs.append(log_prob)
-            values.append(value)
-            dones.append(done)
+            memory.actions[t] = action
+            memory.log_probs[t] = log_prob
+            memory.values[t] = value.squeeze(1)
+            rewards[t] = reward
+            dones[t] = done
 
             self.state = next_state
 
-            self.env.render()
-
             if delay_ms > 0:
                 sleep(delay_ms / 1000)
 
+        memory.rewards.copy_(torch.from_numpy(rewards))
+        memory.dones.copy_(torch.from_numpy(dones))
+
         # Get value of last state (used in GAE)
-        final_value, _, _ = self.net(self.state)
-        final_value = final_value.squeeze(0)
+        final_value, _, _, _ = self.net(self.state)
+        final_value = final_value.squeeze(1)
 
         # Compute generalized advantage estimates
-        advantages = self._compute_gae(rewards, values, dones, final_value)
+        memory.advantages.copy_(self._compute_gae(memory.rewards, memory.values, memory.dones, final_value))
 
-        # Convert to tensors
-        states = torch.cat(states)
-        actions = torch.stack(actions)
-        log_probs = torch.stack(log_probs)
-        advantages = torch.tensor(advantages, dtype=torch.float32, device=device)
-        rewards = torch.tensor(rewards, dtype=torch.float32, device=device)
-        values = torch.cat(values)
-
-        return Memory(states, actions, log_probs, rewards, advantages, values)
+        return memory
 
     def save(self, filepath: str):
         torch.save(self.net.state_dict(), filepath)
@@ -193,27 +195,54 @@ class PPO:
         self, state: np.ndarray
     ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         state = self._to_tensor(state)
-        value, alpha, beta = self.net(state)
+        value, alpha, beta, _ = self.net(state)
         return value, alpha, beta
 
     def _compute_gae(self, rewards, values, dones, last_value):
-        advantages = [0] * len(rewards)
+        # advantages[t] = delta[t] + (1 - dones[t]) * gamma * lambda * advantages[t + 1], backwards in time
+        # every tensor is (num_steps, n_envs): one (n_envs,) step of the recurrence per time step
+        not_dones = 1 - dones
+        next_values = torch.cat([values[1:], last_value.view(1, -1)])
+        deltas = rewards + not_dones * self.gamma * next_values - values
+        decays = not_dones * (self.gamma * self.gae_lambda)
+
+        advantages = torch.empty_like(deltas)
+        advantage = torch.zeros_like(deltas[0])
+        for t in reversed(range(len(deltas))):
+            advantage = deltas[t] + decays[t] * advantage
+            advantages[t] = advantage
+        return advantages
 
-        last_advantage = 0
+    def _step(self, actions):
+        """
+        One step of every env, the ones that are done are reset. Returns the next states as a batch
+        and the rewards and dones as arrays of n_envs
+        """
+        if self.vectorized:
+            # the vector env resets by itself the environments that are done
+            next_state, reward, done, _ = self.env.step(actions)
+            return self._to_batch(next_state), reward, done
 
-        for i in reversed(range(len(rewards))):
-            delta = rewards[i] + (1 - dones[i]) * self.gamma * last_value - values[i]
-            advantages[i] = (
-                delta + (1 - dones[i]) * self.gamma * self.gae_lambda * last_advantage
-            )
+        next_state, reward, done, _, _ = self.env.step(actions[0])
+        self.episode_step += 1
 
-            last_value = values[i]
-            last_advantage = advantages[i]
+        if self.render_policy(self.episode, self.episode_step):
+            self.env.render(mode=self.render_policy.mode)
 
-        return advantages
+        if done:
+            next_state = self.env.reset()
+            self.episode += 1
+            self.episode_step = 0
+
+        return self._to_batch(next_state), np.array([reward]), np.array([done])
+
+    def _to_batch(self, x):
+        # observations of a vector env already have the batch dimension
+        return torch.from_numpy(np.asarray(x, dtype=np.float32)).to(device) if self.vectorized else self._to_tensor(x)
 
     def _to_tensor(self, x):
-        return torch.tensor(x, dtype=torch.float32, device=device).unsqueeze(0)
+        # no copy on the CPU: the tensor shares the frame stack of the env, up to its next step
+        return torch.from_numpy(np.asarray(x, dtype=np.float32)).to(device).unsqueeze(0)
 
     def _set_step_params(self, step):
         # interpolate self.alpha between 1.0 and 0.0
@@ -0,0 +1,29 @@
+class RenderPolicy:
+    """
+    When an environment is rendered: never (headless training), every `every` steps, or only during
+    the episodes listed in `episodes` (e.g. the ones to record). Episodes and steps are counted from 1.
+    """
+
+    def __init__(self, every=0, episodes=None, mode='human'):
+        self.every = every
+        self.episodes = set(episodes) if episodes is not None else None
+        self.mode = mode
+
+    @classmethod
+    def never(cls):
+        return cls()
+
+    @classmethod
+    def every_n_steps(cls, n, mode='human'):
+        return cls(every=n, mode=mode)
+
+    @classmethod
+    def record(cls, episodes, mode='human'):
+        return cls(every=1, episodes=episodes, mode=mode)
+
+    def __call__(self, episode, step):
+        if self.every <= 0:
+            return False
+        if self.episodes is not None and episode not in self.episodes:
+            return False
+        return step % self.every == 0
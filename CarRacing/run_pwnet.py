@@ -16,6 +16,14 @@ from games.carracing import RacingNet, CarRacing
 from ppo import PPO
 from torch.distributions import Beta
 from tqdm import tqdm
+from quantization import quantization_report
+from prototype_ops import l2_similarity
+from vector_simulation import simulate
+from offline_evaluation import held_out_loader, offline_fidelity
+from early_stop import SequentialStop
+from instrumentation import PhaseTimer
+from results_store import ResultsStore
+from metrics import EpisodeMetrics
 
 
 NUM_ITERATIONS = 5
@@ -30,6 +38,18 @@ DEVICE = 'cpu'
 delay_ms = 0
 NUM_PROTOTYPES = 4
 SIMULATION_EPOCHS = 30
+QUANTIZATION_REPORT = False  # compare the trained wrapper with its int8 copy before the simulation
+VECTOR_SIMULATION = False  # play the simulation episodes together on worker processes, batching the agent and the wrapper forward
+OFFLINE_EVALUATION = False  # fidelity on the held-out trajectories recorded by collect_data.py with HELD_OUT = True
+EARLY_STOP = False  # stop the simulation once the reward mean is known well enough (early_stop.SequentialStop)
+TIMING = False  # per-phase wall time and throughput to the SummaryWriter and a JSON summary in results/ (instrumentation.PhaseTimer), synchronizes CUDA at each phase boundary
+RESULTS_STORE = True  # epoch and iteration metrics (and the phase timings) in the SQLite results/results.db, see results_store.aggregate
+
+if VECTOR_SIMULATION and EARLY_STOP:
+    # the sequential test needs the episodes in the order they are played, the vector simulation ends the short ones first
+    raise ValueError("EARLY_STOP only applies to the sequential simulation, set VECTOR_SIMULATION = False")
+
+timer = PhaseTimer(enabled=TIMING)
 
 
 class PWNet(nn.Module):
@@ -70,13 +90,10 @@ class PWNet(nn.Module):
         self.linear.weight.data.copy_(custom_weight_matrix.T)   
         
     def __proto_layer_l2(self, x, p):
-        output = list()
         b_size = x.shape[0]
-        p = p.view(1, PROTOTYPE_SIZE).tile(b_size, 1).to(DEVICE) 
-        c = x.view(b_size, PROTOTYPE_SIZE).to(DEVICE)      
-        l2s = ( (c - p)**2 ).sum(axis=1).to(DEVICE) 
+        c = x.view(b_size, PROTOTYPE_SIZE)
         # similarity function from Chen et al. 2019
-        act = torch.log( (l2s + 1. ) / (l2s + self.epsilon) ).to(DEVICE)  
+        act, _ = l2_similarity(c, p.view(1, PROTOTYPE_SIZE), self.epsilon)
         return act
     
     def __output_act_func(self, p_acts):    
@@ -116,6 +133,7 @@ class PWNet(nn.Module):
         return final_outputs # are all the possible values range
 
 
+@timer.timed('evaluate_loader')
 def evaluate_loader(model, loader, loss):
     model.eval()
     total_error = 0
@@ -189,6 +207,7 @@ with open('results/pwnet_results.txt', 'a') as f:
     
 #### Start Collecting Data To Form Final Mean and Standard Error Results
 
+store = ResultsStore('CarRacing', 'pwnet', dict(NUM_CLASSES=NUM_CLASSES, NUM_PROTOTYPES=NUM_PROTOTYPES, LATENT_SIZE=LATENT_SIZE, PROTOTYPE_SIZE=PROTOTYPE_SIZE, BATCH_SIZE=BATCH_SIZE, NUM_EPOCHS=NUM_EPOCHS), enabled=RESULTS_STORE)
 data_rewards = list()
 data_errors = list()
 
@@ -227,6 +246,7 @@ for iter in range(NUM_ITERATIONS): # 5
     # agent weights
     ppo.load("weights/agent_weights.pt")
 
+    timer.start('data_load')
     with open('data/X_train.pkl', 'rb') as f:
         X_train = pickle.load(f)
     with open('data/real_actions.pkl', 'rb') as f:
@@ -238,6 +258,7 @@ for iter in range(NUM_ITERATIONS): # 5
     tensor_y = torch.tensor(real_actions, dtype=torch.float32)
     train_dataset = TensorDataset(tensor_x, tensor_y)
     train_loader = DataLoader(train_dataset, shuffle=True, batch_size=BATCH_SIZE)
+    timer.stop('data_load', samples=len(train_dataset))
 
 #------------------------------PROTOTYPES MANUALLY DEFINED--------------------------------------------------------------------------------------------------
     p_idxs = np.array([10582, 20116, 4616, 2659]) 
@@ -265,9 +286,12 @@ for iter in range(NUM_ITERATIONS): # 5
         model.train()
         
         if train_error < best_error:
+            timer.start('checkpoint')
             torch.save(model.state_dict(), MODEL_DIR_ITER)
+            timer.stop('checkpoint')
             best_error = train_error
         
+        timer.start('training_pass')
         for instances, labels in train_loader:
             
             optimizer.zero_grad()
@@ -279,10 +303,12 @@ for iter in range(NUM_ITERATIONS): # 5
             loss.backward()
             optimizer.step()
             running_loss += loss.item()
+        timer.stop('training_pass', samples=len(train_dataset))
                     
         print("Epoch:", epoch, "Running Loss:", running_loss / len(train_loader), "Train error:", train_error)
         with open('results/pwnet_results.txt', 'a') as f:
             f.write(f"Epoch: {epoch}, Running Loss: {running_loss / len(train_loader)}, Train error: {train_error}\n")
+        store.log_epoch(iter, epoch, running_loss=running_loss / len(train_loader), train_error=train_error)
             
         writer.add_scalar("Running_loss", running_loss/len(train_loader), epoch)
         writer.add_scalar("Train_error", train_error, epoch)
@@ -298,53 +324,85 @@ for iter in range(NUM_ITERATIONS): # 5
     #print("Sanity Check MSE Eval:", evaluate_loader(model, train_loader, mse_loss))
     print("Checking for the error...", evaluate_loader(model, train_loader, mse_loss))
     
+    if OFFLINE_EVALUATION:
+        report = offline_fidelity(model, held_out_loader())
+        print("Held-out fidelity:", report)
+        with open('results/pwnet_results.txt', 'a') as f:
+            f.write(f"Held-out MSE: {report['mse']}, MSE per step: {report['mse_step']}\n")
+
+    if QUANTIZATION_REPORT:
+        report = quantization_report(model, train_loader)
+        print("Int8 wrapper:", report)
+        with open('results/pwnet_results.txt', 'a') as f:
+            f.write(f"Int8 MSE delta: {report['mse_delta']}, Step latency: {report['ms_float32']} ms -> {report['ms_int8']} ms\n")
+
     reward_arr = []
     all_errors = list()
 
-    for i in tqdm(range(SIMULATION_EPOCHS)): # 30
-        state = ppo._to_tensor(env.reset())
-        count = 0
-        rew = 0
-        rew_list = []
-        model.eval()
-
-        for t in range(10000):
-            # Get black box action
-            value, alpha, beta, latent_x = ppo.net(state)
-            value, alpha, beta = value.squeeze(0), alpha.squeeze(0), beta.squeeze(0)
-            policy = Beta(alpha, beta)
-            input_action = policy.mean.detach()
+    timer.start('simulation')
+    if VECTOR_SIMULATION:
+        reward_arr, all_errors, lengths = simulate(ppo.net, model, SIMULATION_EPOCHS)
+        timer.add(steps=sum(lengths))
+    else:
+        stop = SequentialStop(max_episodes=SIMULATION_EPOCHS)
+        for i in tqdm(range(SIMULATION_EPOCHS)): # 30
+            state = ppo._to_tensor(env.reset())
+            count = 0
+            metrics = EpisodeMetrics()
+            rew = 0
+            rew_list = []
+            model.eval()
+
+            for t in range(10000):
+                # Get black box action
+                value, alpha, beta, latent_x = ppo.net(state)
+                value, alpha, beta = value.squeeze(0), alpha.squeeze(0), beta.squeeze(0)
+                policy = Beta(alpha, beta)
+                input_action = policy.mean.detach()
             
-            bb_action = ppo.env.preprocess(input_action)
+                bb_action = ppo.env.preprocess(input_action)
 
-            action = model(latent_x.to(DEVICE))
+                action = model(latent_x.to(DEVICE))
 
-            all_errors.append(  mse_loss( torch.tensor(bb_action), action[0]).detach().item()  )
+                metrics.add_error(bb_action, action[0])
 
-            state, reward, done, _, _ = ppo.env.step(action[0].detach().numpy(), real_action=True)
-            state = ppo._to_tensor(state)
-            rew += reward
-            rew_list.append(reward)
-            count += 1
-            if done:
-                break
+                state, reward, done, _, _ = ppo.env.step(action[0].detach().numpy(), real_action=True)
+                timer.add(steps=1)
+                state = ppo._to_tensor(state)
+                rew += reward
+                rew_list.append(reward)
+                count += 1
+                if done:
+                    break
                 
-        reward_arr.append(rew)
-
-    data_rewards.append(  sum(reward_arr) / SIMULATION_EPOCHS  )
-    data_errors.append(  sum(all_errors) / SIMULATION_EPOCHS )
-    print("Reward: ", sum(reward_arr) / SIMULATION_EPOCHS)
-    print("MSE: ", sum(all_errors) / SIMULATION_EPOCHS )
+            reward_arr.append(rew)
+            all_errors.append(metrics.episode_error())
+            if EARLY_STOP and stop.update(rew):
+                break
+        if EARLY_STOP:
+            summary = stop.summary()
+            print("Early stop:", summary)
+            with open('results/pwnet_results.txt', 'a') as f:
+                f.write(f"Simulated episodes: {summary['episodes']}, saved: {summary['saved_episodes']} ({summary['reason']})\n")
+    timer.stop('simulation')
+    timer.log(writer, iter)
+
+    data_rewards.append(  sum(reward_arr) / len(reward_arr)  )
+    data_errors.append(  sum(all_errors) / len(all_errors) )
+    store.log_iteration(iter, timer.last_iteration(), reward=data_rewards[-1], mse=data_errors[-1])
+    print("Reward: ", sum(reward_arr) / len(reward_arr))
+    print("MSE: ", sum(all_errors) / len(all_errors) )
 
     # log the reward and MAE
-    writer.add_scalar("Reward", sum(reward_arr) / SIMULATION_EPOCHS, iter)
-    writer.add_scalar("MSE", sum(all_errors) / SIMULATION_EPOCHS, iter)
+    writer.add_scalar("Reward", sum(reward_arr) / len(reward_arr), iter)
+    writer.add_scalar("MSE", sum(all_errors) / len(all_errors), iter)
     
     with open('results/pwnet_results.txt', 'a') as f:
-        f.write(f"Reward: {sum(reward_arr) / SIMULATION_EPOCHS}, MSE: {sum(all_errors) / SIMULATION_EPOCHS}\n")
+        f.write(f"Reward: {sum(reward_arr) / len(reward_arr)}, MSE: {sum(all_errors) / len(all_errors)}\n")
         
 data_errors = np.array(data_errors)
 data_rewards = np.array(data_rewards)
+timer.save('results/pwnet_timing.json')
 
 print(" ")
 print("===== Data MAE:")
@@ -19,6 +19,14 @@ from torch.distributions import Beta
 from sklearn.neighbors import KNeighborsRegressor
 from random import sample
 from tqdm import tqdm
+from quantization import quantization_report
+from prototype_ops import l2_similarity
+from vector_simulation import simulate
+from offline_evaluation import held_out_loader, offline_fidelity
+from early_stop import SequentialStop
+from instrumentation import PhaseTimer
+from results_store import ResultsStore
+from metrics import EpisodeMetrics
 from time import sleep
 
 
@@ -34,6 +42,18 @@ DEVICE = 'cuda'
 delay_ms = 0
 NUM_PROTOTYPES = 4 # per cambiare questo dato dovrei modificare l'ultimo linear layer (pre-assigned) W'
 SIMULATION_EPOCHS = 30
+QUANTIZATION_REPORT = False  # compare the trained wrapper with its int8 copy before the simulation
+VECTOR_SIMULATION = False  # play the simulation episodes together on worker processes, batching the agent and the wrapper forward
+OFFLINE_EVALUATION = False  # fidelity on the held-out trajectories recorded by collect_data.py with HELD_OUT = True
+EARLY_STOP = False  # stop the simulation once the reward mean is known well enough (early_stop.SequentialStop)
+TIMING = False  # per-phase wall time and throughput to the SummaryWriter and a JSON summary in results/ (instrumentation.PhaseTimer), synchronizes CUDA at each phase boundary
+RESULTS_STORE = True  # epoch and iteration metrics (and the phase timings) in the SQLite results/results.db, see results_store.aggregate
+
+if VECTOR_SIMULATION and EARLY_STOP:
+    # the sequential test needs the episodes in the order they are played, the vector simulation ends the short ones first
+    raise ValueError("EARLY_STOP only applies to the sequential simulation, set VECTOR_SIMULATION = False")
+
+timer = PhaseTimer(enabled=TIMING)
 
 
 class PPNet(nn.Module):
@@ -61,13 +81,10 @@ class PPNet(nn.Module):
         self.linear.weight.data.copy_(custom_weight_matrix.T)   
         
     def __proto_layer_l2(self, x):
-        #output = list()
         b_size = x.shape[0]
-        p = self.prototypes.T.view(1, PROTOTYPE_SIZE, NUM_PROTOTYPES).tile(b_size, 1, 1).to(DEVICE) 
-        c = x.view(b_size, PROTOTYPE_SIZE, 1).tile(1, 1, NUM_PROTOTYPES).to(DEVICE)            
-        l2s = ( (c - p)**2 ).sum(axis=1).to(DEVICE) 
+        c = x.view(b_size, PROTOTYPE_SIZE)
         # similarity function from Chen et al. 2019
-        act = torch.log( (l2s + 1. ) / (l2s + self.epsilon) ).to(DEVICE)   
+        act, l2s = l2_similarity(c, self.prototypes, self.epsilon)
         return act, l2s
     
     def __output_act_func(self, p_acts):        
@@ -84,6 +101,7 @@ class PPNet(nn.Module):
         return final_outputs, x
 
 
+@timer.timed('evaluate_loader')
 def evaluate_loader(model, loader, loss):
     model.eval()
     total_error = 0
@@ -106,33 +124,23 @@ def load_config():
     return config
 
 
-def clust_loss(x, y, model, criterion):
+def clust_loss(x, y, model):
     """
     Forces each prototype to be close to training data
+    x is the batch already transformed into the new feature space by the forward
     """
     
     ps = model.prototypes  # take prototypes in new feature space
-    model = model.eval()
-    x = model.main(instances)  # transform into new feature space
-    b_size = x.shape[0]
-    for idx, p in enumerate(ps):
-        target = p.repeat(b_size, 1)
-        if idx == 0:
-            loss = criterion(x, target) 
-        else:
-            loss += criterion(x, target)
-    model = model.train()  
-    return loss
-
-
-def sep_loss(x, y, model, criterion):
+    # sum over the prototypes of the MSE between the batch and each prototype, in one broadcast
+    return ((x.unsqueeze(1) - ps.unsqueeze(0))**2).mean(dim=(0, 2)).sum()
+
+
+def sep_loss(x, y, model):
     """
     Force each prototype to be far from eachother
     """
     
     p = model.prototypes  # take prototypes in new feature space
-    model = model.eval()
-    x = model.main(x)  # transform into new feature space
     #pnorm distance
     loss = torch.cdist(p, p).sum() / ((NUM_PROTOTYPES**2 - NUM_PROTOTYPES) / 2)
     return -loss 
@@ -145,6 +153,7 @@ with open('results/pwnet_star_results.txt', 'a') as f:
     f.write(f"model_pwnet_star\n")
     f.write(f"NUM_PROTOTYPES: {NUM_PROTOTYPES}\n")
 
+store = ResultsStore('CarRacing', 'pwnet_star', dict(NUM_CLASSES=NUM_CLASSES, NUM_PROTOTYPES=NUM_PROTOTYPES, LATENT_SIZE=LATENT_SIZE, PROTOTYPE_SIZE=PROTOTYPE_SIZE, BATCH_SIZE=BATCH_SIZE, NUM_EPOCHS=NUM_EPOCHS), enabled=RESULTS_STORE)
 data_rewards = list()
 data_errors = list()
 
@@ -188,6 +197,7 @@ for iter in range(NUM_ITERATIONS):
     )
     ppo.load("weights/agent_weights.pt")
 
+    timer.start('data_load')
     with open('data/X_train.pkl', 'rb') as f:
         X_train = pickle.load(f)
     with open('data/real_actions.pkl', 'rb') as f:
@@ -199,6 +209,7 @@ for iter in range(NUM_ITERATIONS):
     tensor_y = torch.tensor(real_actions, dtype=torch.float32)
     train_dataset = TensorDataset(tensor_x.to(DEVICE), tensor_y.to(DEVICE))
     train_loader = DataLoader(train_dataset, shuffle=True, batch_size=BATCH_SIZE)
+    timer.stop('data_load', samples=len(train_dataset))
 
 
     #### Train
@@ -225,27 +236,32 @@ for iter in range(NUM_ITERATIONS):
         model.train()
         
         if train_error < best_error:
+            timer.start('checkpoint')
             torch.save(model.state_dict(), MODEL_DIR_ITER)
+            timer.stop('checkpoint')
             best_error = train_error
         
+        timer.start('training_pass')
         for instances, labels in train_loader:
             optimizer.zero_grad()
                     
             instances, labels = instances.to(DEVICE), labels.to(DEVICE)
-            logits, _ = model(instances)
+            logits, x = model(instances)
                     
             loss1 = mse_loss(logits, labels) * lambda1
-            loss2 = clust_loss(instances, labels, model, mse_loss) * lambda2
-            loss3 = sep_loss(instances, labels, model, mse_loss) * lambda3
+            loss2 = clust_loss(x, labels, model) * lambda2
+            loss3 = sep_loss(x, labels, model) * lambda3
             loss  = loss1 + loss2 + loss3
             running_loss += loss.item()
             
             loss.backward()
             optimizer.step()
+        timer.stop('training_pass', samples=len(train_dataset))
         
         print("Epoch:", epoch, "Running Loss:", running_loss / len(train_loader), "Train error:", train_error)
         with open('results/pwnet_star_results.txt', 'a') as f:
             f.write(f"Epoch: {epoch}, Running Loss: {running_loss / len(train_loader)}, Train error: {train_error}\n")
+        store.log_epoch(iter, epoch, running_loss=running_loss / len(train_loader), train_error=train_error)
         
         writer.add_scalar("Running_loss", running_loss/len(train_loader), epoch)
         writer.add_scalar("Train_error", train_error, epoch)
@@ -261,6 +277,7 @@ for iter in range(NUM_ITERATIONS):
     model.eval()
     model.load_state_dict(torch.load(MODEL_DIR_ITER))
     #print("Accuracy Before Projection:", evaluate_loader(model, train_loader, mse_loss))
+    timer.start('projection')
     trans_x = list()
     model.eval()
     with torch.no_grad():
@@ -293,7 +310,10 @@ for iter in range(NUM_ITERATIONS):
     trained_prototypes = model.prototypes.clone().detach()
     tensor_proj_prototypes = torch.tensor(nn_xs, dtype=torch.float32)
     model.prototypes = torch.nn.Parameter(tensor_proj_prototypes.to(DEVICE))
+    timer.stop('projection', samples=len(X_train))
+    timer.start('checkpoint')
     torch.save(model.state_dict(), MODEL_DIR_ITER)
+    timer.stop('checkpoint')
 
 
     states, actions, rewards, log_probs, values, dones, X_train = [], [], [], [], [], [], []
@@ -301,53 +321,84 @@ for iter in range(NUM_ITERATIONS):
 
     # Wapper model with learned weights
     model.eval()
-    reward_arr = []
-    all_errors = list()
-    for i in tqdm(range(SIMULATION_EPOCHS)):
-        state = ppo._to_tensor(env.reset())
-        count = 0
-        rew = 0
-        model.eval()
-
-        for t in range(10000):
-            # Get black box action
-            value, alpha, beta, latent_x = ppo.net(state)
-            value, alpha, beta = value.squeeze(0), alpha.squeeze(0), beta.squeeze(0)
-            policy = Beta(alpha, beta)
-            input_action = policy.mean.detach()
-            _, _, _, _, bb_action = ppo.env.step(input_action.cpu().numpy())
-
-            action = model(latent_x.to(DEVICE))
-            all_errors.append(  mse_loss(bb_action.to(DEVICE), action[0][0]).detach().item()  )
-            #all_errors.append(  mse_loss(bb_action.to(DEVICE), action[0]).detach().item()  )
+    if OFFLINE_EVALUATION:
+        report = offline_fidelity(model, held_out_loader())
+        print("Held-out fidelity:", report)
+        with open('results/pwnet_star_results.txt', 'a') as f:
+            f.write(f"Held-out MSE: {report['mse']}, MSE per step: {report['mse_step']}\n")
 
-            state, reward, done, _, _ = ppo.env.step(action[0][0].detach().cpu().numpy(), real_action=True)
-            #state, reward, done, _, _ = ppo.env.step(action[0].detach().cpu().numpy(), real_action=True)
+    if QUANTIZATION_REPORT:
+        report = quantization_report(model, train_loader)
+        print("Int8 wrapper:", report)
+        with open('results/pwnet_star_results.txt', 'a') as f:
+            f.write(f"Int8 MSE delta: {report['mse_delta']}, Step latency: {report['ms_float32']} ms -> {report['ms_int8']} ms\n")
 
-            state = ppo._to_tensor(state)
-            rew += reward
-            count += 1
+    reward_arr = []
+    all_errors = list()
+    timer.start('simulation')
+    if VECTOR_SIMULATION:
+        reward_arr, all_errors, lengths = simulate(ppo.net, model, SIMULATION_EPOCHS)
+        timer.add(steps=sum(lengths))
+    else:
+        stop = SequentialStop(max_episodes=SIMULATION_EPOCHS)
+        for i in tqdm(range(SIMULATION_EPOCHS)):
+            state = ppo._to_tensor(env.reset())
+            count = 0
+            metrics = EpisodeMetrics()
+            rew = 0
+            model.eval()
+
+            for t in range(10000):
+                # Get black box action
+                value, alpha, beta, latent_x = ppo.net(state)
+                value, alpha, beta = value.squeeze(0), alpha.squeeze(0), beta.squeeze(0)
+                policy = Beta(alpha, beta)
+                input_action = policy.mean.detach()
+                _, _, _, _, bb_action = ppo.env.step(input_action.cpu().numpy())
+
+                action = model(latent_x.to(DEVICE))
+                metrics.add_error(bb_action, action[0][0])
+
+                state, reward, done, _, _ = ppo.env.step(action[0][0].detach().cpu().numpy(), real_action=True)
+                timer.add(steps=1)
+                #state, reward, done, _, _ = ppo.env.step(action[0].detach().cpu().numpy(), real_action=True)
+
+                state = ppo._to_tensor(state)
+                rew += reward
+                count += 1
             
-            if done:
-                break
+                if done:
+                    break
 
-        reward_arr.append(rew)
-
-    data_rewards.append(  sum(reward_arr) / SIMULATION_EPOCHS  )
-    data_errors.append(  sum(all_errors) / SIMULATION_EPOCHS )
-    print("Reward: ", sum(reward_arr) / SIMULATION_EPOCHS)
-    print("MSE: ", sum(all_errors) / SIMULATION_EPOCHS )
+            reward_arr.append(rew)
+            all_errors.append(metrics.episode_error())
+            if EARLY_STOP and stop.update(rew):
+                break
+        if EARLY_STOP:
+            summary = stop.summary()
+            print("Early stop:", summary)
+            with open('results/pwnet_star_results.txt', 'a') as f:
+                f.write(f"Simulated episodes: {summary['episodes']}, saved: {summary['saved_episodes']} ({summary['reason']})\n")
+    timer.stop('simulation')
+    timer.log(writer, iter)
+
+    data_rewards.append(  sum(reward_arr) / len(reward_arr)  )
+    data_errors.append(  sum(all_errors) / len(all_errors) )
+    store.log_iteration(iter, timer.last_iteration(), reward=data_rewards[-1], mse=data_errors[-1])
+    print("Reward: ", sum(reward_arr) / len(reward_arr))
+    print("MSE: ", sum(all_errors) / len(all_errors) )
     
     # log the reward and MAE
-    writer.add_scalar("Reward", sum(reward_arr) / SIMULATION_EPOCHS, iter)
-    writer.add_scalar("MSE", sum(all_errors) / SIMULATION_EPOCHS, iter)
+    writer.add_scalar("Reward", sum(reward_arr) / len(reward_arr), iter)
+    writer.add_scalar("MSE", sum(all_errors) / len(all_errors), iter)
     
     with open('results/pwnet_star_results.txt', 'a') as f:
-        f.write(f"Reward: {sum(reward_arr) / SIMULATION_EPOCHS}, MSE: {sum(all_errors) / SIMULATION_EPOCHS}\n")
+        f.write(f"Reward: {sum(reward_arr) / len(reward_arr)}, MSE: {sum(all_errors) / len(all_errors)}\n")
         
 
 data_errors = np.array(data_errors)
 data_rewards = np.array(data_rewards)
+timer.save('results/pwnet_star_timing.json')
 
 
 print(" ")
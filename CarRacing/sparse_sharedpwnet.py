@@ -0,0 +1,74 @@
+import torch
+import torch.nn as nn
+from copy import deepcopy
+
+from prototype_ops import l2_similarity
+
+
+class SparseSharedPwNet(nn.Module):
+    """
+    Inference-only Shared-PW-Net built from a trained SharedPwNet, with hard prototype assignment.
+    At the end of training proto_presence is (almost) one-hot, so each slot uses a single prototype:
+    similarities are computed only for the prototypes used by some slot, then gathered and summed
+    per class through the class identity layer folded into a (n_used, NUM_CLASSES) matrix.
+    """
+
+    def __init__(self, model, gumbel_scalar, tau):
+        super(SparseSharedPwNet, self).__init__()
+        self.projection_network = deepcopy(model.projection_network).eval()
+        self.tanh = nn.Tanh()
+        self.relu = nn.ReLU()
+        self.epsilon = model.epsilon
+
+        with torch.no_grad():
+            n_classes, n_prototypes, n_slots = model.proto_presence.shape
+            # same probabilities of the forward (gumbel_softmax without the noise)
+            scale = gumbel_scalar / tau if gumbel_scalar != 0 else 1.
+            presence = torch.softmax(model.proto_presence * scale, dim=1)
+            confidence, assignment = presence.max(dim=1)  # (NUM_CLASSES, NUM_SLOTS_PER_CLASS)
+            used = torch.unique(assignment)
+
+            # row of each slot (flattened as in mixed_similarity.flatten) among the used prototypes
+            slot_rows = torch.searchsorted(used, assignment.flatten())
+            weight = model.class_identity_layer.weight  # (NUM_CLASSES, NUM_CLASSES * NUM_SLOTS_PER_CLASS)
+            class_weight = torch.zeros(len(used), weight.shape[0], device=weight.device)
+            class_weight.index_add_(0, slot_rows, weight.T)
+
+            hard_presence = torch.zeros_like(model.proto_presence)
+            hard_presence.scatter_(1, assignment.unsqueeze(1), 1.)
+
+            # prototypes are frozen after training: project them once
+            latent_prototypes = self.projection_network(model.prototypes[used])
+
+        self.register_buffer('latent_prototypes', latent_prototypes)
+        self.register_buffer('class_weight', class_weight)
+        self.register_buffer('used_prototypes', used)
+        self.register_buffer('assignment', assignment)
+        self.register_buffer('confidence', confidence)
+        self.register_buffer('proto_presence', hard_presence)
+        self.n_prototypes = n_prototypes
+
+    def output_activations(self, out):
+        out.T[0] = self.tanh(out.T[0]) # steering between -1 and +1
+        out.T[1] = self.relu(out.T[1]) # acc > 0
+        out.T[2] = self.relu(out.T[2]) # brake > 0
+        return out
+
+    def forward(self, x, gumbel_scalar=None, tau=None):
+        '''
+        Same signature and outputs of SharedPwNet.forward (gumbel_scalar and tau are not needed anymore),
+        similarity only has the columns of the used prototypes
+        '''
+        x = self.projection_network(x)
+        similarity, _ = l2_similarity(x, self.latent_prototypes, self.epsilon) # (batch, n_used)
+        out = self.output_activations(similarity @ self.class_weight)
+        return out, x, similarity, self.proto_presence
+
+    def pruning_report(self):
+        used = self.used_prototypes.tolist()
+        return {
+            'used_prototypes': used,
+            'pruned_prototypes': [p for p in range(self.n_prototypes) if p not in used],
+            'slot_assignment': self.assignment.tolist(), # [class][slot] -> prototype
+            'min_presence': self.confidence.min().item(), # close to 1 when the assignment is really one-hot
+        }
@@ -0,0 +1,150 @@
+import os
+
+import gym
+import numpy as np
+import torch
+from gym.spaces import Box
+from gym.vector import AsyncVectorEnv
+from gym.wrappers import TimeLimit
+
+from games.carracing import CarRacing
+from prototype_ops import wrapper_outputs
+
+
+NUM_ENVS = os.cpu_count()  # one environment per worker process
+PIPELINE = True  # step half of the envs while the policy runs on the other half
+MAX_STEPS = 10000  # same cap of the sequential simulation
+
+
+class RealActionCarRacing(gym.Wrapper):
+    """
+    CarRacing stepped directly with (steering, acc, brake), as the wrapper predicts them,
+    with the 4-tuple step expected by the vector env
+    """
+
+    def __init__(self, env):
+        super().__init__(env)
+        self.action_space = Box(low=np.array([-1., 0., 0.]), high=np.array([1., 1., 1.]), dtype=np.float32)
+
+    def step(self, action):
+        state, reward, done, info, _ = self.env.step(action, real_action=True)
+        return state, reward, done, info
+
+
+def make_env():
+    return TimeLimit(RealActionCarRacing(CarRacing(frame_skip=0, frame_stack=4)), max_episode_steps=MAX_STEPS)
+
+
+class AgentActionCarRacing(gym.Wrapper):
+    """
+    CarRacing stepped with the (steering, acc/brake) in [0, 1] sampled by the PPO policy,
+    with the 4-tuple step expected by the vector env
+    """
+
+    def step(self, action):
+        state, reward, done, info, _ = self.env.step(action)
+        return state, reward, done, info
+
+
+def make_training_env():
+    return AgentActionCarRacing(CarRacing(frame_skip=0, frame_stack=4))
+
+
+def make_training_envs(n_envs=NUM_ENVS):
+    """
+    Vector env of n_envs CarRacing for PPO: each env runs in its own process and writes its observations
+    in a shared memory buffer, so the batch of states is not pickled back at every step
+    """
+    return AsyncVectorEnv([make_training_env] * n_envs, shared_memory=True)
+
+
+class EnvGroup:
+    """
+    Environments stepped together in worker processes, with the running statistics of their episodes
+    """
+
+    def __init__(self, make_env, n_envs):
+        self.envs = AsyncVectorEnv([make_env] * n_envs)
+        self.state = self.envs.reset()
+        self.ep_reward = np.zeros(n_envs)
+        self.ep_metric = 0
+        self.ep_length = np.zeros(n_envs, dtype=int)
+        self.running = np.ones(n_envs, dtype=bool)
+        self.metric = None
+        self.pending = False
+
+    def step_async(self, policy_step):
+        action, self.metric = policy_step(self.state)
+        self.envs.step_async(action)
+        self.pending = True
+
+    def step_wait(self, episodes):
+        # the vector env resets by itself the environments that are done
+        self.state, reward, done, _ = self.envs.step_wait()
+        self.pending = False
+        self.ep_reward += reward
+        self.ep_metric = self.ep_metric + torch.as_tensor(self.metric)
+        self.ep_length += 1
+
+        for i in np.flatnonzero(done & self.running):
+            episodes['rewards'].append(float(self.ep_reward[i]))
+            episodes['metrics'].append(float(self.ep_metric[i]))  # host sync, once per episode
+            episodes['lengths'].append(int(self.ep_length[i]))
+            self.ep_reward[i], self.ep_metric[i], self.ep_length[i] = 0, 0, 0
+            if episodes['to_start'] > 0:
+                episodes['to_start'] -= 1
+            else:
+                self.running[i] = False
+
+
+def run_episodes(make_env, policy_step, n_episodes, n_envs=NUM_ENVS, pipeline=PIPELINE):
+    """
+    Plays n_episodes on n_envs copies of the environment stepped together in worker processes.
+    policy_step maps the batch of observations to the batch of actions and a per-env step metric,
+    which can stay on the device: it is summed there and read back only when an episode ends.
+    With pipeline the envs are split in two groups: while the workers step one group, the main process
+    runs policy_step on the observations of the other one, so neither side waits for the other.
+    Returns per-episode rewards, sums of the step metric and lengths, in the order the episodes end.
+    """
+    n_envs = min(n_envs, n_episodes)
+    sizes = [n_envs - n_envs // 2, n_envs // 2] if pipeline and n_envs > 1 else [n_envs]
+    groups = [EnvGroup(make_env, n) for n in sizes]
+    episodes = {'rewards': list(), 'metrics': list(), 'lengths': list(), 'to_start': n_episodes - n_envs}
+
+    with torch.no_grad():
+        for group in groups:
+            group.step_async(policy_step)
+        while any(group.pending for group in groups):
+            for group in groups:
+                if group.pending:
+                    group.step_wait(episodes)
+                    if group.running.any():
+                        group.step_async(policy_step)
+
+    for group in groups:
+        group.envs.close()
+    return episodes['rewards'], episodes['metrics'], episodes['lengths']
+
+
+def simulate(net, model, n_episodes, *model_args, n_envs=NUM_ENVS):
+    """
+    Simulation of the wrapper driving the car, with the RacingNet and the wrapper forward batched over all the envs.
+    Returns per-episode rewards, summed MSE between the black-box and the wrapper actions, and lengths.
+    """
+    net_device = next(net.parameters()).device
+    model_device = next(model.parameters()).device
+    model.eval()
+
+    def policy_step(state):
+        state = torch.as_tensor(state, dtype=torch.float32, device=net_device)
+        _, alpha, beta, latent_x = net(state)
+
+        # mean of the Beta policy, mapped to (steering, acc, brake) as in CarRacing.preprocess
+        input_action = (alpha / (alpha + beta)) * 2 - 1
+        bb_action = torch.stack([input_action[:, 0], input_action[:, 1].clamp(min=0), (-input_action[:, 1]).clamp(min=0)], dim=1)
+
+        action = wrapper_outputs(model(latent_x.to(model_device), *model_args))
+        error = ((bb_action.to(model_device) - action)**2).mean(dim=1)
+        return action.cpu().numpy(), error
+
+    return run_episodes(make_env, policy_step, n_episodes, n_envs)
@@ -12,6 +12,7 @@ if not os.path.exists('data/'):
     os.mkdir('data/')
 
 n_episodes = 30
+HELD_OUT = False  # record held-out trajectories for offline_evaluation.py instead of the training data
 name='LunarLander_TWO.pth'
 
 X_train = list()
@@ -27,6 +28,7 @@ render = False
 save_gif = False
 actions = list()
 states = list()
+episodes = list()
 
 for i_episode in range(1, n_episodes+1):
     state = env.reset()
@@ -34,19 +36,21 @@ for i_episode in range(1, n_episodes+1):
     for t in range(10000):
         
         #print(policy(state))
-        action, latent_x = policy(state)
+        action, latent_x = policy.act(state)
         
         actions.append(action)
 
         state, reward, done, _ = env.step(action)
         running_reward += reward
         
-        # to save prototypes
-        img_array = env.render(mode='rgb_array')
-        states.append(img_array)
+        # to save prototypes (the held-out set keeps no observations)
+        if not HELD_OUT:
+            img_array = env.render(mode='rgb_array')
+            states.append(img_array)
         
         X_train.append(latent_x.detach().tolist())
         a_train.append(action)
+        episodes.append(i_episode)
         #obs_train.append(state.tolist())
 
         if render:
@@ -67,10 +71,15 @@ X_train = np.array(X_train)
 a_train = np.array(a_train)
 #obs_train = np.array(obs_train)
 
-obs_train = np.array(states)
-np.save('data/X_train.npy', X_train)
-np.save('data/a_train.npy', a_train)
-np.save('data/obs_train.npy', obs_train)
+if HELD_OUT:
+    np.save('data/X_held_out.npy', X_train)
+    np.save('data/a_held_out.npy', a_train)
+    np.save('data/ep_held_out.npy', np.array(episodes))
+else:
+    obs_train = np.array(states)
+    np.save('data/X_train.npy', X_train)
+    np.save('data/a_train.npy', a_train)
+    np.save('data/obs_train.npy', obs_train)
 
 print("Num instances produced:", len(X_train))
 print(Counter(actions))
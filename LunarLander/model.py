@@ -1,3 +1,4 @@
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -28,28 +29,46 @@ class ActorCritic(nn.Module):
         self.logprobs.append(action_distribution.log_prob(action))
         self.state_values.append(state_value)
         
-        return action.item(), state
+        # a batch of states (one per episode played together) gives an array of actions
+        return (action.item() if action.dim() == 0 else action.numpy()), state
     
-    def calculateLoss(self, gamma=0.99):
-        
-        # calculating discounted rewards:
-        rewards = []
-        dis_reward = 0
-        for reward in self.rewards[::-1]:
-            dis_reward = reward + gamma * dis_reward
-            rewards.insert(0, dis_reward)
-                
-        # normalizing the rewards:
-        rewards = torch.tensor(rewards)
-        rewards = (rewards - rewards.mean()) / (rewards.std())
-        
-        loss = 0
-        for logprob, value, reward in zip(self.logprobs, self.state_values, rewards):
-            advantage = reward  - value.item()
-            action_loss = -logprob * advantage
-            value_loss = F.smooth_l1_loss(value, reward)
-            loss += (action_loss + value_loss)   
-        return loss
+    def act(self, state):
+        """
+        Inference only: samples the action of one state (8,) or of a batch of states (batch, 8), numpy or tensor,
+        and returns it with the latent state, without recording log probs and values for calculateLoss
+        """
+        with torch.no_grad():
+            state = torch.as_tensor(state, dtype=torch.float32, device=self.affine.weight.device)
+            latent = F.relu(self.affine(state))
+            action = Categorical(F.softmax(self.action_layer(latent), dim=-1)).sample()
+        return (action.item() if action.dim() == 0 else action), latent
+    
+    def calculateLoss(self, gamma=0.99, masks=None):
+        """
+        Loss of the recorded steps, as (steps, episodes) tensors: a single episode is a batch of one.
+        With episodes played together masks (one array per step) is 0 for the steps after the end of an
+        episode, and the loss is the mean of the losses of the episodes
+        """
+        rewards = torch.as_tensor(np.array(self.rewards), dtype=torch.float64).view(len(self.rewards), -1)
+        logprobs = torch.stack(self.logprobs).view(len(self.logprobs), -1)
+        values = torch.stack(self.state_values).view(len(self.state_values), -1)
+        masks = torch.ones_like(rewards) if masks is None else torch.as_tensor(np.array(masks), dtype=torch.float64).view_as(rewards)
+        
+        # calculating discounted rewards, sum over k >= t of gamma^(k - t) * reward[k]:
+        # reversed cumulative sum of gamma^k * reward[k], divided by gamma^t (float64 for the long episodes)
+        discounts = gamma ** torch.arange(len(rewards), dtype=torch.float64).view(-1, 1)
+        rewards = (rewards * masks * discounts).flip(0).cumsum(0).flip(0) / discounts
+        
+        # normalizing the rewards (over the steps of each episode):
+        n_steps = masks.sum(0)
+        mean = (rewards * masks).sum(0) / n_steps
+        std = (((rewards - mean) ** 2 * masks).sum(0) / (n_steps - 1)).sqrt()
+        rewards = ((rewards - mean) / std).float()
+        
+        advantages = rewards - values.detach()
+        action_loss = -logprobs * advantages
+        value_loss = F.smooth_l1_loss(values, rewards, reduction='none')
+        return ((action_loss + value_loss) * masks.float()).sum(0).mean()
     
     def clearMemory(self):
         del self.logprobs[:]
@@ -0,0 +1,50 @@
+import numpy as np
+import torch
+from torch.utils.data import TensorDataset, DataLoader
+
+from prototype_ops import wrapper_outputs
+
+
+# written by collect_data.py with HELD_OUT = True
+HELD_OUT_FILES = ('data/X_held_out.npy', 'data/a_held_out.npy', 'data/ep_held_out.npy')
+BATCH_SIZE = 4096
+
+
+def held_out_loader(batch_size=BATCH_SIZE):
+    """
+    Latents, black-box actions and episode of every step of the held-out trajectories, in order
+    """
+    x, a, ep = (np.load(f) for f in HELD_OUT_FILES)
+    dataset = TensorDataset(torch.tensor(x, dtype=torch.float32),
+                            torch.tensor(a, dtype=torch.long),
+                            torch.tensor(ep, dtype=torch.long))
+    return DataLoader(dataset, batch_size=batch_size, shuffle=False)
+
+
+def offline_fidelity(model, loader, *model_args):
+    """
+    Agreement between the wrapper and the black-box actions on the held-out trajectories, in large batches.
+    'accuracy' is the fraction of steps where the wrapper takes the black-box action, 'accuracy_episode'
+    the same fraction averaged over the episodes.
+    The states are the ones visited by the agent, not by the wrapper: the reward still needs the simulation.
+    """
+    device = next(model.parameters()).device
+    model.eval()
+    matches, episodes = list(), list()
+    with torch.inference_mode():
+        for x, a, ep in loader:
+            action = torch.argmax(wrapper_outputs(model(x.to(device, non_blocking=True), *model_args)), dim=1)
+            matches.append((action == a.to(device, non_blocking=True)).float())
+            episodes.append(ep.to(device, non_blocking=True))
+    matches = torch.cat(matches)
+    _, episodes = torch.unique(torch.cat(episodes), return_inverse=True)
+    n_episodes = int(episodes.max()) + 1
+    ep_matches = torch.zeros(n_episodes, device=device).index_add_(0, episodes, matches)
+    ep_steps = torch.bincount(episodes, minlength=n_episodes)
+
+    report = dict()
+    report['accuracy'] = matches.mean().item()
+    report['accuracy_episode'] = (ep_matches / ep_steps).mean().item()
+    report['n_episodes'] = n_episodes
+    report['n_steps'] = len(matches)
+    return report
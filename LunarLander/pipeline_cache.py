@@ -0,0 +1,144 @@
+import ast
+import hashlib
+import inspect
+import json
+import os
+import shutil
+
+import numpy as np
+
+
+CACHE_DIR = 'cache/'
+
+
+def _stage_of(node):
+    # stage of an `if cache.done('<stage>', key):` statement, None for the other statements
+    test = getattr(node, 'test', None)
+    if isinstance(node, ast.If) and isinstance(test, ast.Call) and getattr(test.func, 'attr', None) == 'done' \
+            and test.args and isinstance(test.args[0], ast.Constant):
+        return test.args[0].value
+    return None
+
+
+def _blocks(tree):
+    # every list of statements of the script: module body, loop and if bodies, else branches...
+    for node in ast.walk(tree):
+        for field in ('body', 'orelse', 'finalbody'):
+            block = getattr(node, field, None)
+            if isinstance(block, list) and block and isinstance(block[0], ast.stmt):
+                yield node, block
+
+
+class PipelineCache:
+    """
+    Content-addressed artifacts of the stages of a run (KMeans init, training of an iteration, simulation):
+    each stage is keyed by the hash of its inputs (dataset files, config, source of the code it runs and
+    the keys of its upstream stages) and its outputs are stored in cache/<stage>/<key>/.
+    A stage whose key is done is skipped and its outputs restored, so after a change only the stages that
+    depend on it are run again. With enabled=False nothing is ever done, every stage runs.
+    """
+
+    def __init__(self, root=CACHE_DIR, enabled=True):
+        self.root = root
+        self.enabled = enabled
+        self.digests = dict()  # path -> (size, mtime, sha256), the dataset and the agent are hashed once
+        self.scripts = dict()  # path -> (source, ast) of the scripts whose stages are hashed
+
+    def file_digest(self, path):
+        stat = os.stat(path)
+        cached = self.digests.get(path)
+        if cached is None or cached[:2] != (stat.st_size, stat.st_mtime):
+            sha = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(chunk)
+            cached = self.digests[path] = (stat.st_size, stat.st_mtime, sha.hexdigest())
+        return cached[2]
+
+    def key(self, stage, files=(), config=None, code=(), upstream=()):
+        """
+        Hash of the inputs of stage: content of files, config dict, source of the classes, functions and
+        modules in code (strings are taken as source, see stage_source), keys of the upstream stages
+        """
+        inputs = {
+            'stage': stage,
+            'files': {path: self.file_digest(path) for path in files},
+            'config': config or dict(),
+            'code': [obj if isinstance(obj, str) else inspect.getsource(obj) for obj in code],
+            'upstream': list(upstream),
+        }
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+    def module_source(self, obj):
+        """
+        Source of the whole module that defines obj, with its helpers and module-level constants
+        """
+        return inspect.getsource(inspect.getmodule(obj))
+
+    def stage_source(self, path, stage):
+        """
+        Source of the code of the script at path that runs stage: its `if cache.done(stage, ...)` statement and,
+        inside a loop, the statements of the loop body before it since the previous stage (model and optimizer
+        setup, data load...), so that editing them changes the key of the stage
+        """
+        if path not in self.scripts:
+            with open(path) as f:
+                source = f.read()
+            self.scripts[path] = (source, ast.parse(source, path))
+        source, tree = self.scripts[path]
+        for parent, block in _blocks(tree):
+            for i, node in enumerate(block):
+                if _stage_of(node) != stage:
+                    continue
+                first = i
+                while not isinstance(parent, ast.Module) and first > 0 and _stage_of(block[first - 1]) is None:
+                    first -= 1
+                return '\n'.join(ast.get_source_segment(source, statement) for statement in block[first:i + 1])
+        raise ValueError(f"no stage {stage} in {path}")
+
+    def path(self, stage, key, name=''):
+        return os.path.join(self.root, stage, key, name)
+
+    def done(self, stage, key):
+        return self.enabled and os.path.exists(self.path(stage, key, 'done'))
+
+    def save(self, stage, key, files=(), directories=(), **values):
+        """
+        Stores the outputs of stage: copies of files and directories, values (arrays as .npy, the others in
+        values.json).
+        The marker is written last, an interrupted stage is never taken as done.
+        """
+        if not self.enabled:
+            return
+        directory = self.path(stage, key)
+        os.makedirs(directory, exist_ok=True)
+        for path in files:
+            shutil.copyfile(path, os.path.join(directory, os.path.basename(path)))
+        for path in directories:
+            shutil.copytree(path, os.path.join(directory, os.path.basename(os.path.normpath(path))), dirs_exist_ok=True)
+        arrays = {name: value for name, value in values.items() if isinstance(value, np.ndarray)}
+        for name, value in arrays.items():
+            np.save(os.path.join(directory, f"{name}.npy"), value)
+        with open(os.path.join(directory, 'values.json'), 'w') as f:
+            json.dump({name: value for name, value in values.items() if name not in arrays}, f, default=float)
+        with open(os.path.join(directory, 'done'), 'w') as f:
+            f.write(key)
+
+    def load(self, stage, key, files=(), directories=()):
+        """
+        Outputs of a done stage: the stored files and directories are copied back to files and directories,
+        the values are returned
+        """
+        directory = self.path(stage, key)
+        for path in files:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            shutil.copyfile(os.path.join(directory, os.path.basename(path)), path)
+        for path in directories:
+            shutil.copytree(os.path.join(directory, os.path.basename(os.path.normpath(path))), path, dirs_exist_ok=True)
+        with open(os.path.join(directory, 'values.json')) as f:
+            values = json.load(f)
+        for name in os.listdir(directory):
+            if name.endswith('.npy'):
+                values[name[:-len('.npy')]] = np.load(os.path.join(directory, name))
+        return values
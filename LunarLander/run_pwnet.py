@@ -31,6 +31,13 @@ from sklearn.cluster import KMeans, DBSCAN, OPTICS
 
 from random import sample
 from tqdm import tqdm
+from quantization import quantization_report
+from prototype_ops import l2_similarity
+from vector_simulation import simulate
+from offline_evaluation import held_out_loader, offline_fidelity
+from early_stop import SequentialStop
+from instrumentation import PhaseTimer
+from results_store import ResultsStore
 from time import sleep
 
 from collections import deque, Counter
@@ -51,6 +58,18 @@ DEVICE = 'cpu'
 delay_ms = 0
 NUM_PROTOTYPES = 4
 NUM_SIMULATIONS = 30
+QUANTIZATION_REPORT = False  # compare the trained wrapper with its int8 copy before the simulation
+VECTOR_SIMULATION = False  # play the simulation episodes together on worker processes, batching the agent and the wrapper forward
+OFFLINE_EVALUATION = False  # fidelity on the held-out trajectories recorded by collect_data.py with HELD_OUT = True
+EARLY_STOP = False  # stop the simulation once the reward mean is known well enough (early_stop.SequentialStop)
+TIMING = False  # per-phase wall time and throughput to the SummaryWriter and a JSON summary in results/ (instrumentation.PhaseTimer), synchronizes CUDA at each phase boundary
+RESULTS_STORE = True  # epoch and iteration metrics (and the phase timings) in the SQLite results/results.db, see results_store.aggregate
+
+if VECTOR_SIMULATION and EARLY_STOP:
+    # the sequential test needs the episodes in the order they are played, the vector simulation ends the short ones first
+    raise ValueError("EARLY_STOP only applies to the sequential simulation, set VECTOR_SIMULATION = False")
+
+timer = PhaseTimer(enabled=TIMING)
 
 
 
@@ -89,12 +108,10 @@ class PWNet(nn.Module):
             + incorrect_class_connection * negative_one_weights_locations)
         
     def __proto_layer_l2(self, x, p):
-        output = list()
         b_size = x.shape[0]
-        p = p.view(1, PROTOTYPE_SIZE).tile(b_size, 1).to(DEVICE) 
-        c = x.view(b_size, PROTOTYPE_SIZE).to(DEVICE)      
-        l2s = ( (c - p)**2 ).sum(axis=1).to(DEVICE) 
-        act = torch.log( (l2s + 1. ) / (l2s + self.epsilon) ).to(DEVICE)  
+        c = x.view(b_size, PROTOTYPE_SIZE)
+        # similarity function from Chen et al. 2019
+        act, _ = l2_similarity(c, p.view(1, PROTOTYPE_SIZE), self.epsilon)
         return act
     
     def __output_act_func(self, p_acts):        
@@ -123,6 +140,7 @@ class PWNet(nn.Module):
         return final_outputs
 
 
+@timer.timed('evaluate_loader')
 def evaluate_loader(model, loader, cce_loss):
     model.eval()
     total_correct = 0
@@ -195,6 +213,7 @@ if not os.path.exists(MODEL_DIR):
     os.makedirs(MODEL_DIR)
     
 #### Start Collecting Data To Form Final Mean and Standard Error Results
+store = ResultsStore('LunarLander', 'pwnet', dict(NUM_CLASSES=NUM_CLASSES, NUM_PROTOTYPES=NUM_PROTOTYPES, LATENT_SIZE=LATENT_SIZE, PROTOTYPE_SIZE=PROTOTYPE_SIZE, BATCH_SIZE=BATCH_SIZE, NUM_EPOCHS=NUM_EPOCHS), enabled=RESULTS_STORE)
 data_rewards = list()
 data_accuracy = list()
 
@@ -211,12 +230,14 @@ for iter in range(NUM_ITERATIONS):
     env = gym.make('LunarLander-v2')
     policy = ActorCritic()
     policy.load_state_dict(torch.load('./preTrained/{}'.format(name)))
+    timer.start('data_load')
     X_train = np.load('data/X_train.npy')
     a_train = np.load('data/a_train.npy')
     tensor_x = torch.Tensor(X_train)
     tensor_y = torch.tensor(a_train, dtype=torch.long)
     train_dataset = TensorDataset(tensor_x, tensor_y)
     train_loader = DataLoader(train_dataset, shuffle=True, batch_size=BATCH_SIZE)
+    timer.stop('data_load', samples=len(train_dataset))
 
     human_concepts = {'nothing': [0.], 'left' : [1.], 'main': [2.], 'right' : [3.]}
     human_concepts_list = np.array([l for l in human_concepts.values()])
@@ -269,9 +290,12 @@ for iter in range(NUM_ITERATIONS):
         model.train()
         
         if current_acc > best_acc:
+            timer.start('checkpoint')
             torch.save(  model.state_dict(), MODEL_DIR_ITER)
+            timer.stop('checkpoint')
             best_acc = current_acc
         
+        timer.start('training_pass')
         for instances, labels in train_loader:
             
             optimizer.zero_grad()
@@ -286,10 +310,12 @@ for iter in range(NUM_ITERATIONS):
             optimizer.step()
             
             running_loss += loss.item()
+        timer.stop('training_pass', samples=len(train_dataset))
                     
         print("Epoch:", epoch, "Running Loss:", running_loss / len(train_loader), "Current Accuracy :", current_acc)
         with open('results/pwnet_results.txt', 'a') as f:
             f.write(f"Epoch: {epoch}, Running Loss: {running_loss / len(train_loader)}, Current Accuracy: {current_acc}\n")
+        store.log_epoch(iter, epoch, running_loss=running_loss / len(train_loader), accuracy=current_acc)
         
         writer.add_scalar("Running_loss", running_loss/len(train_loader), epoch)
         writer.add_scalar("Current_accuracy", current_acc, epoch)
@@ -307,40 +333,75 @@ for iter in range(NUM_ITERATIONS):
     print("Final Accuracy... :", evaluate_loader(model, train_loader, cce_loss))
 
 
+    if OFFLINE_EVALUATION:
+        report = offline_fidelity(model, held_out_loader())
+        print("Held-out fidelity:", report)
+        with open('results/pwnet_results.txt', 'a') as f:
+            f.write(f"Held-out Accuracy: {report['accuracy']}, Accuracy per episode: {report['accuracy_episode']}\n")
+
+    if QUANTIZATION_REPORT:
+        report = quantization_report(model, train_loader)
+        print("Int8 wrapper:", report)
+        with open('results/pwnet_results.txt', 'a') as f:
+            f.write(f"Int8 Accuracy delta: {report['acc_delta']}, Step latency: {report['ms_float32']} ms -> {report['ms_int8']} ms\n")
+
     all_acc = 0
     count = 0
     all_rewards = list()
-    for i_episode in range(NUM_SIMULATIONS):
-        state = env.reset()
-        running_reward = 0
+    first_episode = len(data_rewards)
+    timer.start('simulation')
+    if VECTOR_SIMULATION:
+        rewards, matches, lengths = simulate(policy, model, NUM_SIMULATIONS)
+        timer.add(steps=sum(lengths))
+        for running_reward in rewards:
+            data_rewards.append(running_reward)
+            print("Running Reward:", running_reward)
+        all_acc, count = sum(matches), sum(lengths)
+    else:
+        stop = SequentialStop(max_episodes=NUM_SIMULATIONS)
+        for i_episode in range(NUM_SIMULATIONS):
+            state = env.reset()
+            running_reward = 0
         
-        for t in range(10000):
-            bb_action, latent_x = policy(state)  # backbone latent x
-            action = torch.argmax(  model(latent_x.view(1, -1))[0]  ).item()  # wrapper prediction
-            state, reward, done, _ = env.step(action)
-            running_reward += reward
-            all_acc += bb_action == action
-            count += 1
-            if done:
+            for t in range(10000):
+                bb_action, latent_x = policy.act(state)  # backbone latent x
+                action = torch.argmax(  model(latent_x.view(1, -1))[0]  ).item()  # wrapper prediction
+                state, reward, done, _ = env.step(action)
+                timer.add(steps=1)
+                running_reward += reward
+                all_acc += bb_action == action
+                count += 1
+                if done:
+                    break
+
+            data_rewards.append(  running_reward  )
+            print("Running Reward:", running_reward)
+            if EARLY_STOP and stop.update(running_reward):
                 break
-
-        data_rewards.append(  running_reward  )
-        print("Running Reward:", running_reward)
+        if EARLY_STOP:
+            summary = stop.summary()
+            print("Early stop:", summary)
+            with open('results/pwnet_results.txt', 'a') as f:
+                f.write(f"Simulated episodes: {summary['episodes']}, saved: {summary['saved_episodes']} ({summary['reason']})\n")
+    timer.stop('simulation')
+    timer.log(writer, iter)
     
     data_accuracy.append(  all_acc / count  )    
+    store.log_iteration(iter, timer.last_iteration(), reward=sum(data_rewards[first_episode:]) / len(data_rewards[first_episode:]), accuracy=data_accuracy[-1])
     
     print("Reward:", sum(data_rewards) / len(data_rewards))
     print("Accuracy:", sum(data_accuracy) / len(data_accuracy))
     
     # log the reward and Acc
-    writer.add_scalar("Reward", sum(data_rewards) / NUM_SIMULATIONS, iter)
-    writer.add_scalar("Accuracy", sum(data_accuracy) / NUM_SIMULATIONS, iter)
+    writer.add_scalar("Reward", sum(data_rewards) / len(data_rewards), iter)
+    writer.add_scalar("Accuracy", sum(data_accuracy) / len(data_accuracy), iter)
 
     with open('results/pwnet_results.txt', 'a') as f:
-        f.write(f"Reward: {sum(data_rewards) / NUM_SIMULATIONS}, Accuracy: {sum(data_accuracy) / NUM_SIMULATIONS}\n")
+        f.write(f"Reward: {sum(data_rewards) / len(data_rewards)}, Accuracy: {sum(data_accuracy) / len(data_accuracy)}\n")
         
 data_accuracy = np.array(data_accuracy)
 data_rewards = np.array(data_rewards)
+timer.save('results/pwnet_timing.json')
 
 print(" ")
 print("===== Data Accuracy:")
@@ -31,9 +31,16 @@ from sklearn.cluster import KMeans, DBSCAN, OPTICS
 
 from random import sample
 from tqdm import tqdm
+from quantization import quantization_report
+from prototype_ops import l2_similarity
+from vector_simulation import simulate
+from offline_evaluation import held_out_loader, offline_fidelity
+from early_stop import SequentialStop
+from instrumentation import PhaseTimer
+from results_store import ResultsStore
 from time import sleep
 
-from collections import deque, Counter
+from collections import deque
 from model import ActorCritic
 from PIL import Image
 
@@ -49,6 +56,18 @@ DEVICE = 'cpu'
 delay_ms = 0
 NUM_PROTOTYPES = 4
 NUM_SIMULATIONS = 30
+QUANTIZATION_REPORT = False  # compare the trained wrapper with its int8 copy before the simulation
+VECTOR_SIMULATION = False  # play the simulation episodes together on worker processes, batching the agent and the wrapper forward
+OFFLINE_EVALUATION = False  # fidelity on the held-out trajectories recorded by collect_data.py with HELD_OUT = True
+EARLY_STOP = False  # stop the simulation once the reward mean is known well enough (early_stop.SequentialStop)
+TIMING = False  # per-phase wall time and throughput to the SummaryWriter and a JSON summary in results/ (instrumentation.PhaseTimer), synchronizes CUDA at each phase boundary
+RESULTS_STORE = True  # epoch and iteration metrics (and the phase timings) in the SQLite results/results.db, see results_store.aggregate
+
+if VECTOR_SIMULATION and EARLY_STOP:
+    # the sequential test needs the episodes in the order they are played, the vector simulation ends the short ones first
+    raise ValueError("EARLY_STOP only applies to the sequential simulation, set VECTOR_SIMULATION = False")
+
+timer = PhaseTimer(enabled=TIMING)
 
 
 
@@ -87,12 +106,10 @@ class PPNet(nn.Module):
             + incorrect_class_connection * negative_one_weights_locations)
         
     def __proto_layer_l2(self, x):
-        output = list()
         b_size = x.shape[0]
-        p = self.prototypes.T.view(1, PROTOTYPE_SIZE, NUM_PROTOTYPES).tile(b_size, 1, 1).to(DEVICE) 
-        c = x.view(b_size, PROTOTYPE_SIZE, 1).tile(1, 1, NUM_PROTOTYPES).to(DEVICE)            
-        l2s = ( (c - p)**2 ).sum(axis=1).to(DEVICE) 
-        act = torch.log( (l2s + 1. ) / (l2s + self.epsilon) ).to(DEVICE)   
+        c = x.view(b_size, PROTOTYPE_SIZE)
+        # similarity function from Chen et al. 2019
+        act, l2s = l2_similarity(c, self.prototypes, self.epsilon)
         return act, l2s
     
     def __output_act_func(self, p_acts):        
@@ -115,6 +132,7 @@ class PPNet(nn.Module):
         return final_outputs, x
 
 
+@timer.timed('evaluate_loader')
 def evaluate_loader(model, loader, cce_loss):
     model.eval()
     total_correct = 0
@@ -133,49 +151,40 @@ def evaluate_loader(model, loader, cce_loss):
     return (total_correct / total) * 100
 
 
-def clust_loss(x, y, model, criterion):
+def clust_loss(x, y, model):
     """
     Forces each datapoint of a certain class to get closer to its prototype
+    x is the batch already transformed into the new feature space by the forward
     """
     
     p = model.prototypes  # take prototypes in new feature space
-    model = model.eval()
-    x = model.main(x)  # transform into new feature space
-    for idx, i in enumerate(Counter(y.cpu().numpy()).keys()):
-        x_sub = x[y==i]
-        target = p[i].repeat(len(x_sub), 1) 
-        if idx == 0:
-            loss = criterion(x_sub, target) 
-        else:
-            loss += criterion(x_sub, target)  
-    model = model.train()
-    return loss
-
-
-def sep_loss(x, y, model, criterion):
+    counts = torch.bincount(y, minlength=NUM_CLASSES)
+    present = counts > 0
+
+    # MSE of each datapoint to the prototype of its class, averaged per class and summed over the classes in the batch
+    dist = ((x - p[y])**2).mean(dim=1)
+    class_dist = torch.zeros(NUM_CLASSES, device=x.device).index_add_(0, y, dist)
+    return (class_dist[present] / counts[present]).sum()
+
+
+def sep_loss(x, y, model):
     """
     Take the distance of each training instance to each prototype NOT of its own class
     Sums them up and returns a negative distance to minimize
     """
     
-    p = model.prototypes  # take prototypes in new feature space
-    model = model.eval()
-    x = model.main(x)  # transform into new feature space
-    loss = criterion(x, x)
-    # Iterate each prototype
-    for idx1, i in enumerate(Counter(y.cpu().numpy()).keys()):
-        # select all training data aligned with that prototype
-        x_sub = x[y==i]
-        # Iterate all other prototypes
-        for idx2, j in enumerate(Counter(y.cpu().numpy()).keys()):
-            if i == j:
-                continue
-            # Select other prototype
-            target = p[j].repeat(len(x_sub), 1) 
-            # Take distance loss of training data to other prototypes
-            loss += criterion(x_sub, target)
-    model = model.train()
-    return -loss / len(Counter(y.cpu().numpy()).keys())**2
+    p = model.prototypes[:NUM_CLASSES]  # take prototypes in new feature space
+    counts = torch.bincount(y, minlength=NUM_CLASSES)
+    present = counts > 0
+
+    # MSE of each datapoint to each prototype, averaged over the datapoints of each class: [class of x, prototype]
+    dist = ((x.unsqueeze(1) - p.unsqueeze(0))**2).mean(dim=2)
+    class_dist = torch.zeros(NUM_CLASSES, NUM_CLASSES, device=x.device).index_add_(0, y, dist)
+    class_dist = class_dist / counts.clamp(min=1).unsqueeze(1)
+
+    # only pairs of different classes that are both in the batch
+    other_class = present.unsqueeze(1) & present.unsqueeze(0) & ~torch.eye(NUM_CLASSES, dtype=torch.bool, device=x.device)
+    return -class_dist[other_class].sum() / present.sum()**2
 
 if not os.path.exists('results/'):
     os.makedirs('results/')
@@ -186,6 +195,7 @@ with open('results/pwnet_star_results.txt', 'a') as f:
     f.write(f"NUM_PROTOTYPES: {NUM_PROTOTYPES}\n")
 
 #### Start Collecting Data To Form Final Mean and Standard Error Results
+store = ResultsStore('LunarLander', 'pwnet_star', dict(NUM_CLASSES=NUM_CLASSES, NUM_PROTOTYPES=NUM_PROTOTYPES, LATENT_SIZE=LATENT_SIZE, PROTOTYPE_SIZE=PROTOTYPE_SIZE, BATCH_SIZE=BATCH_SIZE, NUM_EPOCHS=NUM_EPOCHS), enabled=RESULTS_STORE)
 data_rewards = list()
 data_accuracy = list()
 
@@ -210,6 +220,7 @@ for iter in range(NUM_ITERATIONS):
     env = gym.make('LunarLander-v2')
     policy = ActorCritic()
     policy.load_state_dict(torch.load('./preTrained/{}'.format(name)))
+    timer.start('data_load')
     X_train = np.load('data/X_train.npy')
     a_train = np.load('data/a_train.npy')
     obs_train = np.load('data/obs_train.npy')
@@ -218,6 +229,7 @@ for iter in range(NUM_ITERATIONS):
     tensor_y = torch.tensor(a_train, dtype=torch.long)
     train_dataset = TensorDataset(tensor_x, tensor_y)
     train_loader = DataLoader(train_dataset, shuffle=True, batch_size=BATCH_SIZE)
+    timer.stop('data_load', samples=len(train_dataset))
 
 
     #### Train Wrapper
@@ -245,28 +257,33 @@ for iter in range(NUM_ITERATIONS):
         model.train()
 
         if current_acc > best_acc:
+            timer.start('checkpoint')
             torch.save(model.state_dict(), MODEL_DIR_ITER)
+            timer.stop('checkpoint')
             best_acc = current_acc
 
+        timer.start('training_pass')
         for instances, labels in train_loader:
 
             optimizer.zero_grad()
 
             instances, labels = instances.to(DEVICE), labels.to(DEVICE)
-            logits, _ = model(instances)
+            logits, x = model(instances)
 
             loss1 = cce_loss(logits, labels) * lambda1
-            loss2 = clust_loss(instances, labels, model, mse_loss) * lambda2
-            loss3 = sep_loss(instances, labels, model, mse_loss) * lambda3
+            loss2 = clust_loss(x, labels, model) * lambda2
+            loss3 = sep_loss(x, labels, model) * lambda3
             loss  = loss1 + loss2 + loss3
 
             loss.backward()
             optimizer.step()
             running_loss += loss.item()
+        timer.stop('training_pass', samples=len(train_dataset))
 
         print("Epoch:", epoch, "Running Loss:", running_loss / len(train_loader), "Current Accuracy:", current_acc)
         with open('results/pwnet_star_results.txt', 'a') as f:
             f.write(f"Epoch: {epoch}, Running Loss: {running_loss / len(train_loader)}, Current Accuracy: {current_acc}\n")
+        store.log_epoch(iter, epoch, running_loss=running_loss / len(train_loader), accuracy=current_acc)
         
         writer.add_scalar("Running_loss", running_loss/len(train_loader), epoch)
         writer.add_scalar("Current_accuracy", current_acc, epoch)
@@ -277,6 +294,7 @@ for iter in range(NUM_ITERATIONS):
     #### Project
     model = PPNet().eval()
     model.load_state_dict(torch.load(MODEL_DIR_ITER))
+    timer.start('projection')
     trans_x = list()
     model.eval()
     with torch.no_grad():    
@@ -307,30 +325,67 @@ for iter in range(NUM_ITERATIONS):
     real_trans_x = nn_xs
     real_trans_x = torch.tensor( real_trans_x, dtype=torch.float32 )
     model.prototypes = torch.nn.Parameter(torch.tensor(real_trans_x, dtype=torch.float32))
+    timer.stop('projection', samples=len(X_train))
+    timer.start('checkpoint')
     torch.save(model.state_dict(), MODEL_DIR_ITER)
+    timer.stop('checkpoint')
 
     
     model.to(DEVICE)
+    if OFFLINE_EVALUATION:
+        report = offline_fidelity(model, held_out_loader())
+        print("Held-out fidelity:", report)
+        with open('results/pwnet_star_results.txt', 'a') as f:
+            f.write(f"Held-out Accuracy: {report['accuracy']}, Accuracy per episode: {report['accuracy_episode']}\n")
+
+    if QUANTIZATION_REPORT:
+        report = quantization_report(model, train_loader)
+        print("Int8 wrapper:", report)
+        with open('results/pwnet_star_results.txt', 'a') as f:
+            f.write(f"Int8 Accuracy delta: {report['acc_delta']}, Step latency: {report['ms_float32']} ms -> {report['ms_int8']} ms\n")
+
     all_acc = 0
     count = 0
     all_rewards = list()
-    for i_episode in range(NUM_SIMULATIONS):
-        state = env.reset()
-        running_reward = 0
-        for t in range(10000):
-            bb_action, latent_x = policy(state)  # backbone latent x
-            action = torch.argmax(  model(latent_x.view(1, -1))[0]  ).item()  # wrapper prediction
-            state, reward, done, _ = env.step(action)
-            running_reward += reward
-            all_acc += bb_action == action
-            count += 1
-            if done:
+    first_episode = len(data_rewards)
+    timer.start('simulation')
+    if VECTOR_SIMULATION:
+        rewards, matches, lengths = simulate(policy, model, NUM_SIMULATIONS)
+        timer.add(steps=sum(lengths))
+        for running_reward in rewards:
+            data_rewards.append(running_reward)
+            print("Running Reward:", running_reward)
+        all_acc, count = sum(matches), sum(lengths)
+    else:
+        stop = SequentialStop(max_episodes=NUM_SIMULATIONS)
+        for i_episode in range(NUM_SIMULATIONS):
+            state = env.reset()
+            running_reward = 0
+            for t in range(10000):
+                bb_action, latent_x = policy.act(state)  # backbone latent x
+                action = torch.argmax(  model(latent_x.view(1, -1))[0]  ).item()  # wrapper prediction
+                state, reward, done, _ = env.step(action)
+                timer.add(steps=1)
+                running_reward += reward
+                all_acc += bb_action == action
+                count += 1
+                if done:
+                    break
+
+            data_rewards.append(running_reward)
+            print("Running Reward:", running_reward)
+            if EARLY_STOP and stop.update(running_reward):
                 break
-
-        data_rewards.append(running_reward)
-        print("Running Reward:", running_reward)
+        if EARLY_STOP:
+            summary = stop.summary()
+            print("Early stop:", summary)
+            with open('results/pwnet_star_results.txt', 'a') as f:
+                f.write(f"Simulated episodes: {summary['episodes']}, saved: {summary['saved_episodes']} ({summary['reason']})\n")
+    timer.stop('simulation')
+    timer.log(writer, iter)
         
     data_accuracy.append(  all_acc / count  )
+    store.log_iteration(iter, timer.last_iteration(), reward=sum(data_rewards[first_episode:]) / len(data_rewards[first_episode:]), accuracy=data_accuracy[-1])
 
     print("Reward:", data_rewards)
     print("Accuracy:", data_accuracy)
@@ -345,6 +400,7 @@ for iter in range(NUM_ITERATIONS):
 
 data_accuracy = np.array(data_accuracy)
 data_rewards = np.array(data_rewards)
+timer.save('results/pwnet_star_timing.json')
 
 print(" ")
 print("===== Data Accuracy:")
@@ -33,6 +33,15 @@ from sklearn.cluster import KMeans, DBSCAN, OPTICS
 
 from random import sample
 from tqdm import tqdm
+from quantization import quantization_report
+from sparse_sharedpwnet import SparseSharedPwNet
+from prototype_ops import l2_similarity
+from vector_simulation import simulate
+from offline_evaluation import held_out_loader, offline_fidelity
+from early_stop import SequentialStop
+from instrumentation import PhaseTimer
+from results_store import ResultsStore
+from pipeline_cache import PipelineCache
 from time import sleep
 from model import ActorCritic
 import datetime
@@ -62,6 +71,21 @@ BATCH_SIZE = 32
 DEVICE = 'cuda'
 delay_ms = 0
 NUM_SIMULATIONS = 30
+QUANTIZATION_REPORT = False  # compare the trained wrapper with its int8 copy before the simulation
+SPARSE_INFERENCE = False  # simulate with the hard-assignment model, computing only the used prototypes
+VECTOR_SIMULATION = False  # play the simulation episodes together on worker processes, batching the agent and the wrapper forward
+OFFLINE_EVALUATION = False  # fidelity on the held-out trajectories recorded by collect_data.py with HELD_OUT = True
+EARLY_STOP = False  # stop the simulation once the reward mean is known well enough (early_stop.SequentialStop)
+TIMING = False  # per-phase wall time and throughput to the SummaryWriter and a JSON summary in results/ (instrumentation.PhaseTimer), synchronizes CUDA at each phase boundary
+RESULTS_STORE = True  # epoch and iteration metrics (and the phase timings) in the SQLite results/results.db, see results_store.aggregate
+PIPELINE_CACHE = False  # skip the init, train and simulation stages whose inputs are unchanged, restoring their outputs from cache/ (pipeline_cache.PipelineCache)
+
+if VECTOR_SIMULATION and EARLY_STOP:
+    # the sequential test needs the episodes in the order they are played, the vector simulation ends the short ones first
+    raise ValueError("EARLY_STOP only applies to the sequential simulation, set VECTOR_SIMULATION = False")
+
+timer = PhaseTimer(enabled=TIMING)
+cache = PipelineCache(enabled=PIPELINE_CACHE)
 
 clst_weight = 0.008 # before: 0.08
 sep_weight = -0.0008 # before: 0.008
@@ -77,18 +101,26 @@ X_train = np.load('data/X_train.npy')
 a_train = np.load('data/a_train.npy')
 # actions space= [0,1,2,3]
 
-action_states = {}
-for action_id in range(NUM_CLASSES):
-    action_states[action_id] = []
+DATASET_FILES = ['data/X_train.npy', 'data/a_train.npy']  # inputs of the cached init and train stages
+init_key = cache.key('init', files=DATASET_FILES, config=dict(NUM_CLASSES=NUM_CLASSES, NUM_SLOTS_PER_CLASS=NUM_SLOTS_PER_CLASS))
+if cache.done('init', init_key):
+    prototypes = list(cache.load('init', init_key)['centres'])
+else:
+    action_states = {}
+    for action_id in range(NUM_CLASSES):
+        action_states[action_id] = []
     
-    for state, action in zip(X_train, a_train):
-        if action == action_id:
-            action_states[action_id].append(state)
+        for state, action in zip(X_train, a_train):
+            if action == action_id:
+                action_states[action_id].append(state)
 
-prototypes = []
+    timer.start('init_kmeans')
+    prototypes = []
 
-for action_id in range(NUM_CLASSES):
-	prototypes.append(KMeans(NUM_SLOTS_PER_CLASS, n_init="auto").fit(action_states[action_id]).cluster_centers_)   # prototypes = [[p11,p12,p13],[p21,p22,p23],[p31,p32,p33],]
+    for action_id in range(NUM_CLASSES):
+        prototypes.append(KMeans(NUM_SLOTS_PER_CLASS, n_init="auto").fit(action_states[action_id]).cluster_centers_)   # prototypes = [[p11,p12,p13],[p21,p22,p23],[p31,p32,p33],]
+    timer.stop('init_kmeans')
+    cache.save('init', init_key, centres=np.array(prototypes))
 
 ordered_prototypes = []
 
@@ -141,12 +173,9 @@ class SharedPwNet(nn.Module):
             transf_proto.append(self.projection_network(self.prototypes[i].view(1, -1)))
         latent_protos = torch.cat(transf_proto, dim=0) 
         
-        p = latent_protos.T.view(1, PROTOTYPE_SIZE, NUM_PROTOTYPES).tile(b_size, 1, 1).to(DEVICE) 
-        c = x.view(b_size, PROTOTYPE_SIZE, 1).tile(1, 1, NUM_PROTOTYPES).to(DEVICE)    
-                
-        l2s = ( (c - p)**2 ).sum(axis=1).to(DEVICE) 
+        c = x.view(b_size, PROTOTYPE_SIZE)
         # similarity function from Chen et al. 2019: to score the distance between state c and prototype p
-        similarity = torch.log( (l2s + 1. ) / (l2s + self.epsilon) ).to(DEVICE)  
+        similarity, _ = l2_similarity(c, latent_protos, self.epsilon)
         return similarity # (batch, NUM_PROTOTYPES)
     
     def output_activations(self, out):
@@ -172,6 +201,7 @@ class SharedPwNet(nn.Module):
         return out2, x, similarity, proto_presence
     
     
+@timer.timed('evaluate_loader')
 def evaluate_loader(model, gumbel_scalar, loader, cce_loss, tau):
     model.eval()
     total_correct = 0
@@ -229,6 +259,7 @@ with open(results_file, 'a') as f:
     f.write(f"NUM_PROTOTYPES: {NUM_PROTOTYPES}\n")
     f.write(f"NUM_SLOTS: {NUM_SLOTS_PER_CLASS}\n")
         
+store = ResultsStore('LunarLander', 'sharedpwnet', dict(NUM_CLASSES=NUM_CLASSES, NUM_PROTOTYPES=NUM_PROTOTYPES, NUM_SLOTS_PER_CLASS=NUM_SLOTS_PER_CLASS, new_proto_init=args.new_proto_init, LATENT_SIZE=LATENT_SIZE, PROTOTYPE_SIZE=PROTOTYPE_SIZE, BATCH_SIZE=BATCH_SIZE, NUM_EPOCHS=NUM_EPOCHS), enabled=RESULTS_STORE)
 data_rewards = list()
 data_accuracy = list()
 
@@ -256,6 +287,7 @@ for iter in range(NUM_ITERATIONS):
     env = gym.make('LunarLander-v2')
     policy = ActorCritic()
     policy.load_state_dict(torch.load('./preTrained/{}'.format(name)))
+    timer.start('data_load')
     X_train = np.load('data/X_train.npy')
     a_train = np.load('data/a_train.npy')
     obs_train = np.load('data/obs_train.npy')
@@ -264,6 +296,7 @@ for iter in range(NUM_ITERATIONS):
     tensor_y = torch.tensor(a_train, dtype=torch.long)
     train_dataset = TensorDataset(tensor_x, tensor_y)
     train_loader = DataLoader(train_dataset, shuffle=True, batch_size=BATCH_SIZE)
+    timer.stop('data_load', samples=len(train_dataset))
 
         
     #### Train
@@ -287,130 +320,143 @@ for iter in range(NUM_ITERATIONS):
 
     '''
     running_loss = running_loss_mse = running_loss_clst = running_loss_sep = running_loss_l1 =  running_loss_ortho = 0.
-    for epoch in range(NUM_EPOCHS):
+    train_key = cache.key('train', files=DATASET_FILES, config=dict(NUM_EPOCHS=NUM_EPOCHS, BATCH_SIZE=BATCH_SIZE, NUM_PROTOTYPES=NUM_PROTOTYPES, PROTOTYPE_SIZE=PROTOTYPE_SIZE, clst_weight=clst_weight, sep_weight=sep_weight, l1_weight=l1_weight, start_val=start_val, end_val=end_val, epoch_interval=epoch_interval, new_proto_init=args.new_proto_init, iteration=iter), code=[SharedPwNet, dist_loss, lambda1, evaluate_loader, cache.module_source(l2_similarity), cache.stage_source(__file__, 'train')], upstream=[init_key])
+    if cache.done('train', train_key):
+        schedule = cache.load('train', train_key, files=[MODEL_DIR_ITER], directories=[prototype_path])
+        gumbel_scalar, tau = schedule['gumbel_scalar'], schedule['tau']
+    else:
+        for epoch in range(NUM_EPOCHS):
 
-        model.eval()
-        gumbel_scalar = lambda1(epoch)
+            model.eval()
+            gumbel_scalar = lambda1(epoch)
         
-        if epoch == 0:
-            tau = 1
-        elif (epoch + 1) % 8 == 0 and tau > 0.3:
-            tau = 0.8 * tau   
+            if epoch == 0:
+                tau = 1
+            elif (epoch + 1) % 8 == 0 and tau > 0.3:
+                tau = 0.8 * tau   
         
-        current_acc = evaluate_loader(model, gumbel_scalar, train_loader, cce_loss, tau)
-        model.train()
+            current_acc = evaluate_loader(model, gumbel_scalar, train_loader, cce_loss, tau)
+            model.train()
 
-        if current_acc > best_acc and epoch > NUM_EPOCHS-20:
-            torch.save(model.state_dict(), MODEL_DIR_ITER) # saves model parameters
-            best_acc = current_acc
+            if current_acc > best_acc and epoch > NUM_EPOCHS-20:
+                timer.start('checkpoint')
+                torch.save(model.state_dict(), MODEL_DIR_ITER) # saves model parameters
+                timer.stop('checkpoint')
+                best_acc = current_acc
         
-        # prototype projection every 2 epochs
-        if epoch >= 10 and epoch % 2 == 0 and epoch < NUM_EPOCHS-20:
-            #print("Projecting prototypes...")
-            transformed_x = list()
-            model.eval()
-            with torch.no_grad():
-                for i in range(len(X_train)):
-                    img = X_train[i]
-                    img_tensor = torch.tensor(img, dtype=torch.float32).view(1, -1) # (1, 256)
-                    _, x, _, _ = model(img_tensor.to(DEVICE), gumbel_scalar, tau)
-                    # x è lo stato s dopo la projection network
-                    transformed_x.append(x[0].tolist())
-            transformed_x = np.array(transformed_x)
+            # prototype projection every 2 epochs
+            if epoch >= 10 and epoch % 2 == 0 and epoch < NUM_EPOCHS-20:
+                #print("Projecting prototypes...")
+                timer.start('projection')
+                transformed_x = list()
+                model.eval()
+                with torch.no_grad():
+                    for i in range(len(X_train)):
+                        img = X_train[i]
+                        img_tensor = torch.tensor(img, dtype=torch.float32).view(1, -1) # (1, 256)
+                        _, x, _, _ = model(img_tensor.to(DEVICE), gumbel_scalar, tau)
+                        # x è lo stato s dopo la projection network
+                        transformed_x.append(x[0].tolist())
+                transformed_x = np.array(transformed_x)
             
-            list_projected_prototype = list()
-            for i in range(NUM_PROTOTYPES):
-                trained_p = model.projection_network(model.prototypes)
-                trained_prototype_clone = trained_p.clone().detach()[i].view(1,-1)
-                trained_prototype = trained_prototype_clone.cpu()
-                knn = KNeighborsRegressor(algorithm='brute')
-                knn.fit(transformed_x, list(range(len(transformed_x)))) # lista da 0 a len(transformed_x) - n of training data
-                dist, transf_idx = knn.kneighbors(X=trained_prototype, n_neighbors=1, return_distance=True)
-                projected_prototype = X_train[transf_idx.item()]# transformed_x[transf_idx.item()]
-                list_projected_prototype.append(projected_prototype.tolist())
+                list_projected_prototype = list()
+                for i in range(NUM_PROTOTYPES):
+                    trained_p = model.projection_network(model.prototypes)
+                    trained_prototype_clone = trained_p.clone().detach()[i].view(1,-1)
+                    trained_prototype = trained_prototype_clone.cpu()
+                    knn = KNeighborsRegressor(algorithm='brute')
+                    knn.fit(transformed_x, list(range(len(transformed_x)))) # lista da 0 a len(transformed_x) - n of training data
+                    dist, transf_idx = knn.kneighbors(X=trained_prototype, n_neighbors=1, return_distance=True)
+                    projected_prototype = X_train[transf_idx.item()]# transformed_x[transf_idx.item()]
+                    list_projected_prototype.append(projected_prototype.tolist())
                 
-                if epoch == NUM_EPOCHS-20-2: 
-                    print("I'm saving prototypes' images in prototypes/ directory...")
-                    prototype_image = obs_train[transf_idx.item()]
-                    prototype_image = Image.fromarray(prototype_image, 'RGB')
-                    p_path = prototype_path+f'p{i+1}.png'
-                    prototype_image.save(p_path)
+                    if epoch == NUM_EPOCHS-20-2: 
+                        print("I'm saving prototypes' images in prototypes/ directory...")
+                        prototype_image = obs_train[transf_idx.item()]
+                        prototype_image = Image.fromarray(prototype_image, 'RGB')
+                        p_path = prototype_path+f'p{i+1}.png'
+                        prototype_image.save(p_path)
                                             
-            trained_prototypes = model.prototypes.clone().detach()
-            tensor_projected_prototype = torch.tensor(list_projected_prototype, dtype=torch.float32) # (num_prot, 50)
-            #model.prototypes = torch.nn.Parameter(tensor_projected_prototype.to(DEVICE))
-            with torch.no_grad():
-                model.prototypes.copy_(tensor_projected_prototype.to(DEVICE))
-            model.train()
+                trained_prototypes = model.prototypes.clone().detach()
+                tensor_projected_prototype = torch.tensor(list_projected_prototype, dtype=torch.float32) # (num_prot, 50)
+                #model.prototypes = torch.nn.Parameter(tensor_projected_prototype.to(DEVICE))
+                with torch.no_grad():
+                    model.prototypes.copy_(tensor_projected_prototype.to(DEVICE))
+                timer.stop('projection', samples=len(X_train))
+                model.train()
             
-        # freezed prototypes and projection network, training only proto_presence (prototype assignment) + class_identity_layer (last layer)
-        if epoch >= NUM_EPOCHS-20:
-            for name, param in model.named_parameters():
-                if "prototypes" in name: 
-                    param.requires_grad = False 
-                elif "projection_network" in name:
-                    param.requires_grad = False 
+            # freezed prototypes and projection network, training only proto_presence (prototype assignment) + class_identity_layer (last layer)
+            if epoch >= NUM_EPOCHS-20:
+                for name, param in model.named_parameters():
+                    if "prototypes" in name: 
+                        param.requires_grad = False 
+                    elif "projection_network" in name:
+                        param.requires_grad = False 
                         
-        for instances, labels in train_loader:
-            optimizer.zero_grad()
+            timer.start('training_pass')
+            for instances, labels in train_loader:
+                optimizer.zero_grad()
                     
-            instances, labels = instances.to(DEVICE), labels.to(DEVICE)
-            logits, _, similarity, proto_presence = model(instances, gumbel_scalar, tau)
+                instances, labels = instances.to(DEVICE), labels.to(DEVICE)
+                logits, _, similarity, proto_presence = model(instances, gumbel_scalar, tau)
             
-            loss1 = cce_loss(logits, labels) 
-            # orthogonal loss --> for slots orthogonality: in this way successive slots of a class are assigned to different prototypes
-            orthogonal_loss = torch.Tensor([0]).to(DEVICE)
-
-            for c in range(model.proto_presence.shape[0]): # NUM_CLASSES
-                list_p = list(range(1, model.proto_presence.shape[1]+1))
-                for (i,j) in list(combinations(list_p, 2)):
-                    s1 = model.proto_presence[c][i-1].view(1,-1)
-                    s2 = model.proto_presence[c][j-1].view(1,-1)
-                    sim = cosine_similarity(s1, s2, dim=1).sum()
-                    orthogonal_loss += sim
-            orthogonal_loss = orthogonal_loss / (NUM_SLOTS_PER_CLASS * NUM_CLASSES) - 1
+                loss1 = cce_loss(logits, labels) 
+                # orthogonal loss --> for slots orthogonality: in this way successive slots of a class are assigned to different prototypes
+                orthogonal_loss = torch.Tensor([0]).to(DEVICE)
+
+                for c in range(model.proto_presence.shape[0]): # NUM_CLASSES
+                    list_p = list(range(1, model.proto_presence.shape[1]+1))
+                    for (i,j) in list(combinations(list_p, 2)):
+                        s1 = model.proto_presence[c][i-1].view(1,-1)
+                        s2 = model.proto_presence[c][j-1].view(1,-1)
+                        sim = cosine_similarity(s1, s2, dim=1).sum()
+                        orthogonal_loss += sim
+                orthogonal_loss = orthogonal_loss / (NUM_SLOTS_PER_CLASS * NUM_CLASSES) - 1
             
-            #print("labels: ", labels) # [batch size, int] tensor([2, 4, 5, 4, 0, 5, 4, 4, 3, 3, 3, 0, 0, 2, 5, 5, 5, 1, 1, 1, 0, 1, 4, 0,
-            #0, 3, 4, 4, 4, 4, 3, 4, 4, 0, 2, 1, 0, 3, 3, 0], device='cuda:0')
-            labels_p = labels.cpu().numpy().tolist()
-            #label = [0/1/2/3/4/5]
+                #print("labels: ", labels) # [batch size, int] tensor([2, 4, 5, 4, 0, 5, 4, 4, 3, 3, 3, 0, 0, 2, 5, 5, 5, 1, 1, 1, 0, 1, 4, 0,
+                #0, 3, 4, 4, 4, 4, 3, 4, 4, 0, 2, 1, 0, 3, 3, 0], device='cuda:0')
+                labels_p = labels.cpu().numpy().tolist()
+                #label = [0/1/2/3/4/5]
             
-            proto_presence = proto_presence[labels_p] # (?) labels_pp deve essere un vettore (batch size, classe) classe = 0,1,2
-            inverted_proto_presence = 1 - proto_presence
-            labels.to(DEVICE)
+                proto_presence = proto_presence[labels_p] # (?) labels_pp deve essere un vettore (batch size, classe) classe = 0,1,2
+                inverted_proto_presence = 1 - proto_presence
+                labels.to(DEVICE)
             
-            clst_loss_val = dist_loss(model, similarity, proto_presence, NUM_SLOTS_PER_CLASS)  
-            sep_loss_val = dist_loss(model, similarity, inverted_proto_presence, NUM_PROTOTYPES - NUM_SLOTS_PER_CLASS) 
+                clst_loss_val = dist_loss(model, similarity, proto_presence, NUM_SLOTS_PER_CLASS)  
+                sep_loss_val = dist_loss(model, similarity, inverted_proto_presence, NUM_PROTOTYPES - NUM_SLOTS_PER_CLASS) 
             
-            prototypes_of_correct_class = proto_presence.sum(dim=-1).detach()
-            prototypes_of_wrong_class = 1 - prototypes_of_correct_class
-            avg_separation_cost = torch.sum(similarity * prototypes_of_wrong_class, dim=1) / torch.sum(prototypes_of_wrong_class,dim=1)
-            avg_separation_cost = torch.mean(avg_separation_cost)
+                prototypes_of_correct_class = proto_presence.sum(dim=-1).detach()
+                prototypes_of_wrong_class = 1 - prototypes_of_correct_class
+                avg_separation_cost = torch.sum(similarity * prototypes_of_wrong_class, dim=1) / torch.sum(prototypes_of_wrong_class,dim=1)
+                avg_separation_cost = torch.mean(avg_separation_cost)
             
-            l1_mask = 1 - torch.t(model.prototype_class_identity).cuda()
-            l1 = (model.class_identity_layer.weight * l1_mask).norm(p=1)
-            loss = loss1 + clst_loss_val * clst_weight + sep_loss_val * sep_weight + l1 * l1_weight + orthogonal_loss 
+                l1_mask = 1 - torch.t(model.prototype_class_identity).cuda()
+                l1 = (model.class_identity_layer.weight * l1_mask).norm(p=1)
+                loss = loss1 + clst_loss_val * clst_weight + sep_loss_val * sep_weight + l1 * l1_weight + orthogonal_loss 
 
             
-            running_loss_mse += loss1.item()
-            running_loss_clst += clst_loss_val.item() * clst_weight
-            running_loss_sep += sep_loss_val.item() * sep_weight
-            running_loss_l1 += l1.item() * l1_weight
-            running_loss_ortho += orthogonal_loss.item() 
-            running_loss += loss.item()
-
-            loss.backward()
-            optimizer.step()
+                running_loss_mse += loss1.item()
+                running_loss_clst += clst_loss_val.item() * clst_weight
+                running_loss_sep += sep_loss_val.item() * sep_weight
+                running_loss_l1 += l1.item() * l1_weight
+                running_loss_ortho += orthogonal_loss.item() 
+                running_loss += loss.item()
+
+                loss.backward()
+                optimizer.step()
+            timer.stop('training_pass', samples=len(train_dataset))
     
-        print("Epoch:", epoch, "Running Loss:", running_loss / len(train_loader), "Current Accuracy:", current_acc)
-        with open(results_file, 'a') as f:
-            f.write(f"Epoch: {epoch}, Running Loss: {running_loss / len(train_loader)}, Current Accuracy: {current_acc}\n")
-
-        writer.add_scalar("Running_loss: ", running_loss/len(train_loader), epoch)
-        writer.add_scalar("Current_accuracy: ", current_acc, epoch)
-        running_loss = running_loss_mse = running_loss_clst = running_loss_sep = running_loss_l1 =  running_loss_ortho = 0.
+            print("Epoch:", epoch, "Running Loss:", running_loss / len(train_loader), "Current Accuracy:", current_acc)
+            with open(results_file, 'a') as f:
+                f.write(f"Epoch: {epoch}, Running Loss: {running_loss / len(train_loader)}, Current Accuracy: {current_acc}\n")
+            store.log_epoch(iter, epoch, running_loss=running_loss / len(train_loader), accuracy=current_acc)
+
+            writer.add_scalar("Running_loss: ", running_loss/len(train_loader), epoch)
+            writer.add_scalar("Current_accuracy: ", current_acc, epoch)
+            running_loss = running_loss_mse = running_loss_clst = running_loss_sep = running_loss_l1 =  running_loss_ortho = 0.
             
-        scheduler.step()
+            scheduler.step()
+        cache.save('train', train_key, files=[MODEL_DIR_ITER], directories=[prototype_path], gumbel_scalar=gumbel_scalar, tau=tau)
     
     #states, actions, rewards, log_probs, values, dones, X_train = [], [], [], [], [], [], []
 
@@ -420,28 +466,77 @@ for iter in range(NUM_ITERATIONS):
     model.to(DEVICE)
     print("Final Accuracy... :", evaluate_loader(model, gumbel_scalar, train_loader, cce_loss, tau))
 
+    if OFFLINE_EVALUATION:
+        report = offline_fidelity(model, held_out_loader(), gumbel_scalar, tau)
+        print("Held-out fidelity:", report)
+        with open(results_file, 'a') as f:
+            f.write(f"Held-out Accuracy: {report['accuracy']}, Accuracy per episode: {report['accuracy_episode']}\n")
+
+    if QUANTIZATION_REPORT:
+        report = quantization_report(model, train_loader, gumbel_scalar, tau)
+        print("Int8 wrapper:", report)
+        with open(results_file, 'a') as f:
+            f.write(f"Int8 Accuracy delta: {report['acc_delta']}, Step latency: {report['ms_float32']} ms -> {report['ms_int8']} ms\n")
+
+    if SPARSE_INFERENCE:
+        model = SparseSharedPwNet(model, gumbel_scalar, tau).to(DEVICE)
+        report = model.pruning_report()
+        print("Sparse wrapper:", report)
+        print("Final accuracy (sparse)... :", evaluate_loader(model, gumbel_scalar, train_loader, cce_loss, tau))
+        with open(results_file, 'a') as f:
+            f.write(f"Used prototypes: {report['used_prototypes']}, Pruned prototypes: {report['pruned_prototypes']}, Min presence: {report['min_presence']}\n")
+
     all_acc = 0
     count = 0
     all_rewards = list()
-    for i_episode in range(NUM_SIMULATIONS):
-        state = env.reset()
-        running_reward = 0
-        for t in range(10000):
-            bb_action, latent_x = policy(state)  # backbone latent x
-            action = torch.argmax(  model(latent_x.view(1, -1).to(DEVICE), gumbel_scalar, tau)[0]  ).item()  # wrapper prediction
-            state, reward, done, _ = env.step(action)
-            running_reward += reward
-            all_acc += bb_action == action
-            count += 1
-            if done:
-                break
+    first_episode = len(data_rewards)
+    simulation_key = cache.key('simulation', files=['./preTrained/LunarLander_TWO.pth'], config=dict(simulations=NUM_SIMULATIONS, VECTOR_SIMULATION=VECTOR_SIMULATION, EARLY_STOP=EARLY_STOP, SPARSE_INFERENCE=SPARSE_INFERENCE), code=[cache.stage_source(__file__, 'simulation'), cache.module_source(simulate), cache.module_source(SequentialStop), cache.module_source(SparseSharedPwNet), cache.module_source(ActorCritic)], upstream=[train_key])
+    if cache.done('simulation', simulation_key):
+        simulation = cache.load('simulation', simulation_key)
+        data_rewards.extend(simulation['rewards'])
+        all_acc, count = simulation['all_acc'], simulation['count']
+    else:
+        timer.start('simulation')
+        if VECTOR_SIMULATION:
+            rewards, matches, lengths = simulate(policy, model, NUM_SIMULATIONS, gumbel_scalar, tau)
+            timer.add(steps=sum(lengths))
+            for running_reward in rewards:
+                data_rewards.append(running_reward)
+                print("Running Reward:", running_reward)
+            all_acc, count = sum(matches), sum(lengths)
+        else:
+            stop = SequentialStop(max_episodes=NUM_SIMULATIONS)
+            for i_episode in range(NUM_SIMULATIONS):
+                state = env.reset()
+                running_reward = 0
+                for t in range(10000):
+                    bb_action, latent_x = policy.act(state)  # backbone latent x
+                    action = torch.argmax(  model(latent_x.view(1, -1).to(DEVICE), gumbel_scalar, tau)[0]  ).item()  # wrapper prediction
+                    state, reward, done, _ = env.step(action)
+                    timer.add(steps=1)
+                    running_reward += reward
+                    all_acc += bb_action == action
+                    count += 1
+                    if done:
+                        break
 
             
 
-        data_rewards.append(running_reward)
-        print("Running Reward:", running_reward)
+                data_rewards.append(running_reward)
+                print("Running Reward:", running_reward)
+                if EARLY_STOP and stop.update(running_reward):
+                    break
+            if EARLY_STOP:
+                summary = stop.summary()
+                print("Early stop:", summary)
+                with open(results_file, 'a') as f:
+                    f.write(f"Simulated episodes: {summary['episodes']}, saved: {summary['saved_episodes']} ({summary['reason']})\n")
+        timer.stop('simulation')
+        cache.save('simulation', simulation_key, rewards=data_rewards[first_episode:], all_acc=all_acc, count=count)
+    timer.log(writer, iter)
         
     data_accuracy.append(all_acc / count)
+    store.log_iteration(iter, timer.last_iteration(), reward=sum(data_rewards[first_episode:]) / len(data_rewards[first_episode:]), accuracy=data_accuracy[-1])
     print("Reward: ",  sum(data_rewards) / len(data_rewards)) # Average Reward
     print("Accuracy: ", sum(data_accuracy) / len(data_accuracy))
     # log the reward and Acc
@@ -453,6 +548,7 @@ for iter in range(NUM_ITERATIONS):
 
 data_accuracy = np.array(data_accuracy)
 data_rewards = np.array(data_rewards)
+timer.save(results_file.replace('_results', '_timing').replace('.txt', '.json'))
 
 
 print(" ")
@@ -16,7 +16,7 @@ def test(n_episodes=5, name='LunarLander_TWO.pth'):
         state = env.reset()
         running_reward = 0
         for t in range(10000):
-            action = policy(state)
+            action, _ = policy.act(state)
             state, reward, done, _ = env.step(action)
             running_reward += reward
             if render:
@@ -1,5 +1,6 @@
 from test import test
 from model import ActorCritic
+import numpy as np
 import torch
 import torch.optim as optim
 import gym
@@ -16,32 +17,42 @@ def train():
     lr = 0.02
     betas = (0.9, 0.999)
     random_seed = 543
+    batch_episodes = 1  # episodes played together, with one batched forward per step and one update per batch
     
     torch.manual_seed(random_seed)
     
-    env = gym.make('LunarLander-v2')
-    env.seed(random_seed)
+    envs = [gym.make('LunarLander-v2') for _ in range(batch_episodes)]
+    for i, env in enumerate(envs):
+        env.seed(random_seed + i)
     
     policy = ActorCritic()
     optimizer = optim.Adam(policy.parameters(), lr=lr, betas=betas)
     print(lr,betas)
     
     running_reward = 0
-    for i_episode in range(0, 10000):
-        state = env.reset()
+    logged_episodes = 0  # episodes in running_reward, logged every 20
+    for i_episode in range(0, 10000, batch_episodes):
+        states = np.stack([env.reset() for env in envs])
+        running = np.ones(batch_episodes, dtype=bool)
+        masks = []
         for t in range(10000):
-            action = policy(state)
-            state, reward, done, _ = env.step(action)
-            policy.rewards.append(reward)
-            running_reward += reward
+            actions, _ = policy(states)
+            rewards = np.zeros(batch_episodes)
+            masks.append(running.astype(np.float32))
+            # the envs of the episodes already done stay still, their steps are masked in the loss
+            for i in np.flatnonzero(running):
+                states[i], rewards[i], done, _ = envs[i].step(int(actions[i]))
+                running[i] = not done
+            policy.rewards.append(rewards)
+            running_reward += rewards.sum()
             if render and i_episode > 1000:
-                env.render()
-            if done:
+                envs[0].render()
+            if not running.any():
                 break
                     
         # Updating the policy :
         optimizer.zero_grad()
-        loss = policy.calculateLoss(gamma)
+        loss = policy.calculateLoss(gamma, masks)
         loss.backward()
         optimizer.step()        
         policy.clearMemory()
@@ -56,10 +67,12 @@ def train():
             test(name='LunarLander_{}_{}_{}.pth'.format(lr, betas[0], betas[1]))
             break
         
-        if i_episode % 20 == 0:
-            running_reward = running_reward/20
+        logged_episodes += batch_episodes
+        if logged_episodes >= 20:
+            running_reward = running_reward/logged_episodes
             print('Episode {}\tlength: {}\treward: {}'.format(i_episode, t, running_reward))
             running_reward = 0
+            logged_episodes = 0
             
 if __name__ == '__main__':
     train()
@@ -0,0 +1,104 @@
+import os
+
+import gym
+import numpy as np
+import torch
+from gym.vector import AsyncVectorEnv
+from gym.wrappers import TimeLimit
+
+from prototype_ops import wrapper_outputs
+
+
+NUM_ENVS = os.cpu_count()  # one environment per worker process
+PIPELINE = True  # step half of the envs while the policy runs on the other half
+MAX_STEPS = 10000  # same cap of the sequential simulation
+
+
+def make_env():
+    return TimeLimit(gym.make('LunarLander-v2'), max_episode_steps=MAX_STEPS)
+
+
+class EnvGroup:
+    """
+    Environments stepped together in worker processes, with the running statistics of their episodes
+    """
+
+    def __init__(self, make_env, n_envs):
+        self.envs = AsyncVectorEnv([make_env] * n_envs)
+        self.state = self.envs.reset()
+        self.ep_reward = np.zeros(n_envs)
+        self.ep_metric = 0
+        self.ep_length = np.zeros(n_envs, dtype=int)
+        self.running = np.ones(n_envs, dtype=bool)
+        self.metric = None
+        self.pending = False
+
+    def step_async(self, policy_step):
+        action, self.metric = policy_step(self.state)
+        self.envs.step_async(action)
+        self.pending = True
+
+    def step_wait(self, episodes):
+        # the vector env resets by itself the environments that are done
+        self.state, reward, done, _ = self.envs.step_wait()
+        self.pending = False
+        self.ep_reward += reward
+        self.ep_metric = self.ep_metric + torch.as_tensor(self.metric)
+        self.ep_length += 1
+
+        for i in np.flatnonzero(done & self.running):
+            episodes['rewards'].append(float(self.ep_reward[i]))
+            episodes['metrics'].append(float(self.ep_metric[i]))  # host sync, once per episode
+            episodes['lengths'].append(int(self.ep_length[i]))
+            self.ep_reward[i], self.ep_metric[i], self.ep_length[i] = 0, 0, 0
+            if episodes['to_start'] > 0:
+                episodes['to_start'] -= 1
+            else:
+                self.running[i] = False
+
+
+def run_episodes(make_env, policy_step, n_episodes, n_envs=NUM_ENVS, pipeline=PIPELINE):
+    """
+    Plays n_episodes on n_envs copies of the environment stepped together in worker processes.
+    policy_step maps the batch of observations to the batch of actions and a per-env step metric,
+    which can stay on the device: it is summed there and read back only when an episode ends.
+    With pipeline the envs are split in two groups: while the workers step one group, the main process
+    runs policy_step on the observations of the other one, so neither side waits for the other.
+    Returns per-episode rewards, sums of the step metric and lengths, in the order the episodes end.
+    """
+    n_envs = min(n_envs, n_episodes)
+    sizes = [n_envs - n_envs // 2, n_envs // 2] if pipeline and n_envs > 1 else [n_envs]
+    groups = [EnvGroup(make_env, n) for n in sizes]
+    episodes = {'rewards': list(), 'metrics': list(), 'lengths': list(), 'to_start': n_episodes - n_envs}
+
+    with torch.no_grad():
+        for group in groups:
+            group.step_async(policy_step)
+        while any(group.pending for group in groups):
+            for group in groups:
+                if group.pending:
+                    group.step_wait(episodes)
+                    if group.running.any():
+                        group.step_async(policy_step)
+
+    for group in groups:
+        group.envs.close()
+    return episodes['rewards'], episodes['metrics'], episodes['lengths']
+
+
+def simulate(policy, model, n_episodes, *model_args, n_envs=NUM_ENVS):
+    """
+    Simulation of the wrapper landing, with the ActorCritic and the wrapper forward batched over all the envs.
+    Returns per-episode rewards, number of steps where the wrapper took the black-box action, and lengths.
+    """
+    model_device = next(model.parameters()).device
+    model.eval()
+
+    def policy_step(state):
+        bb_action, latent_x = policy.act(state)
+
+        action = torch.argmax(wrapper_outputs(model(latent_x.to(model_device), *model_args)), dim=1)
+        match = bb_action.to(model_device) == action
+        return action.cpu().numpy(), match
+
+    return run_episodes(make_env, policy_step, n_episodes, n_envs)
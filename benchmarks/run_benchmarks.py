@@ -0,0 +1,246 @@
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import TensorDataset, DataLoader
+
+from stub_env import StubEnv
+from wrappers import WRAPPERS, build_wrapper
+
+
+ENVS = ['CarRacing', 'LunarLander', 'BipedalWalker', 'AtariPong']
+DISCRETE = {'LunarLander', 'AtariPong'}  # action classes (cross entropy), the others regress the actions (MSE)
+PPNET_LAMBDAS = {'CarRacing': (0.08, 0.008), 'LunarLander': (0.8, 0.08), 'BipedalWalker': (0.08, 0.008), 'AtariPong': (0.8, 0.08)}  # clust and sep weights of run_pwnet_star.py
+NUM_SAMPLES = 4096  # synthetic latents per dataset
+NUM_REPEATS = 20
+NUM_WARMUP = 3
+NUM_SIM_STEPS = 500
+AGENT_FEATURES = 1024  # observation values read by the stub agent
+SEED = 0
+BASELINE_FILE = 'baseline.json'
+TOLERANCE = 0.2  # slowdown w.r.t. the baseline reported as a regression
+
+
+def synthetic_dataset(env, namespace, n_samples=NUM_SAMPLES, seed=SEED):
+    """
+    Latents with the LATENT_SIZE of the scripts of env (non-negative, as after the ReLU of the agents)
+    and black-box actions: NUM_CLASSES classes or NUM_CLASSES continuous action values
+    """
+    rng = np.random.default_rng(seed)
+    x = np.abs(rng.standard_normal((n_samples, namespace['LATENT_SIZE']), dtype=np.float32))
+    if env in DISCRETE:
+        y = torch.from_numpy(rng.integers(namespace['NUM_CLASSES'], size=n_samples))
+    else:
+        y = torch.from_numpy(rng.uniform(-1., 1., size=(n_samples, namespace['NUM_CLASSES'])).astype(np.float32))
+    return TensorDataset(torch.from_numpy(x), y)
+
+
+class StubAgent:
+    """
+    Deterministic black box in place of the pretrained agent: a fixed random ReLU layer from
+    AGENT_FEATURES values of the observation to a latent of LATENT_SIZE
+    """
+
+    def __init__(self, observation_shape, latent_size, device, seed=SEED):
+        rng = np.random.default_rng(seed)
+        n_values = int(np.prod(observation_shape))
+        self.index = rng.choice(n_values, min(AGENT_FEATURES, n_values), replace=False)
+        self.layer = nn.Linear(len(self.index), latent_size).to(device)
+        self.device = device
+
+    def act(self, observation):
+        features = np.asarray(observation, dtype=np.float32).reshape(-1)[self.index]
+        with torch.no_grad():
+            return torch.relu(self.layer(torch.from_numpy(features).to(self.device).unsqueeze(0)))
+
+
+def model_args(wrapper, namespace):
+    # SharedPwNet forward takes the gumbel scalar and tau: the ones of the end of the gumbel schedule
+    if wrapper == 'SharedPwNet':
+        return (namespace['lambda1'](namespace['epoch_interval']), 1.)
+    return ()
+
+
+def training_loss(env, wrapper, namespace, model, result, labels):
+    """
+    Loss of the training loop of the script of wrapper, without the terms of the human prototypes of PWNet
+    and the slot orthogonality of SharedPwNet
+    """
+    outputs = namespace['wrapper_outputs'](result)
+    loss = nn.functional.cross_entropy(outputs, labels) if env in DISCRETE else nn.functional.mse_loss(outputs, labels)
+    if wrapper == 'PPNet':
+        lambda2, lambda3 = PPNET_LAMBDAS[env]
+        x = result[1]
+        loss = loss + namespace['clust_loss'](x, labels, model) * lambda2 + namespace['sep_loss'](x, labels, model) * lambda3
+    elif wrapper == 'SharedPwNet':
+        _, _, similarity, proto_presence = result
+        n_slots, n_prototypes = namespace['NUM_SLOTS_PER_CLASS'], namespace['NUM_PROTOTYPES']
+        if env in DISCRETE:
+            proto_presence = proto_presence[labels]
+            clst = namespace['dist_loss'](model, similarity, proto_presence, n_slots)
+            sep = namespace['dist_loss'](model, similarity, 1 - proto_presence, n_prototypes - n_slots)
+            loss = loss + clst * namespace['clst_weight'] + sep * namespace['sep_weight']
+        l1_mask = 1 - torch.t(model.prototype_class_identity).to(outputs.device)
+        loss = loss + (model.class_identity_layer.weight * l1_mask).norm(p=1) * namespace['l1_weight']
+    return loss
+
+
+def _sync(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def measure(fn, device, n_repeats=NUM_REPEATS, n_warmup=NUM_WARMUP):
+    """
+    Median wall time of fn in ms
+    """
+    for _ in range(n_warmup):
+        fn()
+    times = list()
+    for _ in range(n_repeats):
+        _sync(device)
+        start = time.perf_counter()
+        fn()
+        _sync(device)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def latent_prototypes(wrapper, model):
+    # prototypes in the space of the projected latents
+    if wrapper == 'SharedPwNet':
+        return model.projection_network(model.prototypes)
+    return model.prototypes
+
+
+def transform(wrapper, model):
+    return model.projection_network if wrapper == 'SharedPwNet' else model.main
+
+
+def benchmark(env, wrapper, device, n_samples=NUM_SAMPLES, n_sim_steps=NUM_SIM_STEPS):
+    """
+    Times of the phases of a run_*.py for wrapper on the synthetic latents of env, in ms:
+    forward and backward of a batch, projection of the prototypes, a full epoch, a simulation step
+    """
+    torch.manual_seed(SEED)
+    model, namespace = build_wrapper(env, wrapper, device)
+    args = model_args(wrapper, namespace)
+    dataset = synthetic_dataset(env, namespace, n_samples)
+    x, y = (t[:namespace['BATCH_SIZE']].to(device) for t in dataset.tensors)
+    results = dict()
+
+    model.eval()
+    with torch.no_grad():
+        results['forward_ms'] = measure(lambda: model(x, *args), device)
+
+    model.train()
+    def backward():
+        model.zero_grad(set_to_none=True)
+        training_loss(env, wrapper, namespace, model, model(x, *args), y).backward()
+    results['backward_ms'] = measure(backward, device)
+
+    if wrapper != 'PWNet':  # PWNet has no projection, its prototypes are the transformed human concepts
+        latents = dataset.tensors[0].to(device)
+        model.eval()
+        def projection():
+            # transform of every training latent and the nearest one to each prototype, as the kNN of the scripts
+            with torch.no_grad():
+                trans_x = transform(wrapper, model)(latents)
+                return torch.cdist(latent_prototypes(wrapper, model), trans_x).argmin(dim=1)
+        results['projection_ms'] = measure(projection, device)
+
+    loader = DataLoader(dataset, shuffle=True, batch_size=namespace['BATCH_SIZE'])
+    optimizer = torch.optim.Adam(model.parameters(), lr=0.01, weight_decay=1e-8)
+    model.train()
+    def epoch():
+        for instances, labels in loader:
+            optimizer.zero_grad()
+            instances, labels = instances.to(device), labels.to(device)
+            loss = training_loss(env, wrapper, namespace, model, model(instances, *args), labels)
+            loss.backward()
+            optimizer.step()
+    results['epoch_ms'] = measure(epoch, device, n_repeats=3, n_warmup=1)
+    results['samples_per_s'] = n_samples / results['epoch_ms'] * 1000
+
+    results['sim_step_ms'] = simulation_step(env, model, args, namespace, device, n_sim_steps)
+    results['steps_per_s'] = 1000 / results['sim_step_ms']
+    return results
+
+
+def simulation_step(env_name, model, args, namespace, device, n_steps=NUM_SIM_STEPS):
+    """
+    Mean time in ms of a step of the simulation loop of the scripts on the stub env:
+    agent latent, wrapper forward of one state, action, env step
+    """
+    env = StubEnv(env_name, seed=SEED)
+    agent = StubAgent(env.observation_space.shape, namespace['LATENT_SIZE'], device)
+    model.eval()
+    state = env.reset()
+    _sync(device)
+    start = time.perf_counter()
+    with torch.no_grad():
+        for _ in range(n_steps):
+            outputs = namespace['wrapper_outputs'](model(agent.act(state), *args))
+            if env_name in DISCRETE:
+                action = torch.argmax(outputs[0]).item()
+            else:
+                action = outputs[0].cpu().numpy()
+            state, _, done, _ = env.step(action)
+            if done:
+                state = env.reset()
+    _sync(device)
+    return (time.perf_counter() - start) / n_steps * 1000
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """
+    Timings slower than the baseline by more than tolerance, as (key, metric, baseline, current)
+    """
+    regressions = list()
+    for key, metrics in results.items():
+        for metric, value in metrics.items():
+            reference = baseline.get(key, dict()).get(metric)
+            if metric.endswith('_ms') and reference is not None and value > reference * (1 + tolerance):
+                regressions.append((key, metric, reference, value))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Wrapper benchmarks on synthetic latents and stub environments")
+    parser.add_argument("--envs", nargs='+', default=ENVS, choices=ENVS)
+    parser.add_argument("--wrappers", nargs='+', default=list(WRAPPERS), choices=list(WRAPPERS))
+    parser.add_argument("--device", default='cpu')
+    parser.add_argument("--samples", type=int, default=NUM_SAMPLES)
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--save-baseline", action='store_true', help="store these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    results = dict()
+    for env in args.envs:
+        for wrapper in args.wrappers:
+            key = f"{env}/{wrapper}"
+            results[key] = benchmark(env, wrapper, args.device, args.samples)
+            print(key, ", ".join(f"{metric}: {value:.3f}" for metric, value in results[key].items()))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'machine': platform.platform(), 'torch': torch.__version__, 'device': args.device,
+                       'samples': args.samples, 'results': results}, f, indent=2)
+        print("Baseline saved in", args.baseline)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline['results'], args.tolerance)
+        for key, metric, reference, value in regressions:
+            print(f"REGRESSION {key} {metric}: {reference:.3f} -> {value:.3f} ms ({value / reference:.2f}x)")
+        if regressions:
+            sys.exit(1)
+        print(f"No regression w.r.t. {args.baseline} (tolerance {args.tolerance:.0%})")
@@ -0,0 +1,69 @@
+import numpy as np
+
+
+class Discrete:
+    def __init__(self, n):
+        self.n = n
+        self.shape = ()
+
+    def sample(self, rng):
+        return int(rng.integers(self.n))
+
+
+class Box:
+    def __init__(self, low, high, shape, dtype=np.float32):
+        self.low = low
+        self.high = high
+        self.shape = shape
+        self.dtype = dtype
+
+    def sample(self, rng):
+        if np.issubdtype(self.dtype, np.integer):
+            return rng.integers(self.low, self.high + 1, size=self.shape, dtype=self.dtype)
+        return rng.uniform(self.low, self.high, size=self.shape).astype(self.dtype)
+
+
+# raw observation and action spaces of the gym environments of each directory
+SPACES = {
+    'CarRacing': (Box(0, 255, (96, 96, 3), np.uint8), Box(-1., 1., (3,))),
+    'LunarLander': (Box(-np.inf, np.inf, (8,)), Discrete(4)),
+    'BipedalWalker': (Box(-np.inf, np.inf, (24,)), Box(-1., 1., (4,))),
+    'AtariPong': (Box(0, 255, (210, 160, 3), np.uint8), Discrete(6)),
+}
+
+
+class StubEnv:
+    """
+    Deterministic stand-in for the gym environment of env_name, with the same observation and action spaces
+    (gym 0.21 API: reset() -> obs, step(action) -> obs, reward, done, info).
+    Observations are drawn once from a seeded pool and cycled, so a step costs almost nothing and two runs
+    with the same seed see the same episodes: what is timed is the agent and the wrapper around the env.
+    """
+
+    def __init__(self, env_name, episode_length=1000, pool_size=64, seed=0):
+        self.observation_space, self.action_space = SPACES[env_name]
+        self.episode_length = episode_length
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+        pool_space = self.observation_space
+        if pool_space.dtype == np.float32:  # unbounded spaces: observations in [-1, 1]
+            pool_space = Box(-1., 1., pool_space.shape)
+        self.pool = np.stack([pool_space.sample(rng) for _ in range(pool_size)])
+        self.rewards = rng.uniform(-1., 1., size=pool_size).astype(np.float32)
+        self.t = 0
+        self.position = 0
+
+    def reset(self):
+        self.t = 0
+        self.position = 0
+        return self.pool[0]
+
+    def step(self, action):
+        self.t += 1
+        # the next observation depends on the action, deterministically
+        self.position = (self.position + 1 + int(np.sum(action) > 0)) % len(self.pool)
+        done = self.t >= self.episode_length
+        return self.pool[self.position], float(self.rewards[self.position]), done, {}
+
+    def close(self):
+        pass
@@ -0,0 +1,109 @@
+import ast
+import importlib.util
+import os
+from types import SimpleNamespace
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# script of each wrapper and the name of its class
+WRAPPERS = {
+    'PWNet': ('run_pwnet.py', 'PWNet'),
+    'PPNet': ('run_pwnet_star.py', 'PPNet'),
+    'SharedPwNet': ('run_sharedpwnet.py', 'SharedPwNet'),
+}
+
+# the definitions of the scripts only need these: gym, sklearn, the data and the agents are never imported
+ALLOWED_IMPORTS = {'torch', 'numpy', 'math', 'random', 'itertools', 'functools', 'collections', 'copy', 'time', 'json'}
+SKIPPED_IMPORTS = ('torch.utils.tensorboard',)  # under torch but needs the tensorboard package, see _SummaryWriter
+LOCAL_MODULES = {'prototype_ops'}
+
+
+def _local_module(env_dir, name):
+    # the env directories share module names: each one is loaded under its own name
+    path = os.path.join(env_dir, name + '.py')
+    spec = importlib.util.spec_from_file_location(f"{os.path.basename(env_dir)}_{name}", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class _SummaryWriter:
+    # stands in for the SummaryWriter of the scripts, the benchmarks log nothing
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+def _is_constant(node):
+    # literals and arithmetic of names, e.g. NUM_CLASSES = 4, alpha2 = (end_val / start_val) ** 2 / epoch_interval,
+    # NUM_PROTOTYPES = args.n_proto: no call, so nothing is loaded or run
+    allowed = (ast.Constant, ast.Name, ast.Load, ast.BinOp, ast.UnaryOp, ast.operator, ast.unaryop,
+               ast.Tuple, ast.List, ast.Attribute)
+    return all(isinstance(child, allowed) for child in ast.walk(node))
+
+
+def _is_timer(decorator):
+    # @timer.timed(...) of the instrumented functions
+    func = getattr(decorator, 'func', decorator)
+    return isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) and func.value.id == 'timer'
+
+
+def _script_args(tree):
+    # defaults of the parser.add_argument of the script (run_sharedpwnet.py takes n_proto and n_slots)
+    args = dict()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call) and getattr(node.func, 'attr', None) == 'add_argument':
+            name = node.args[0].value.lstrip('-')
+            default = [k.value for k in node.keywords if k.arg == 'default']
+            args[name] = ast.literal_eval(default[0]) if default else None
+    return SimpleNamespace(**args)
+
+
+def load_script(env, script, device='cpu'):
+    """
+    Namespace with the constants, classes and functions of a run_*.py of env, without running it:
+    module-level statements other than imports, constant assignments and definitions are skipped.
+    """
+    env_dir = os.path.join(ROOT, env)
+    path = os.path.join(env_dir, script)
+    with open(path) as f:
+        tree = ast.parse(f.read(), path)
+
+    namespace = {'__name__': f"{env}_{script[:-3]}", 'args': _script_args(tree), 'SummaryWriter': _SummaryWriter}
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            module = node.module if isinstance(node, ast.ImportFrom) else node.names[0].name
+            if module in LOCAL_MODULES:
+                local = _local_module(env_dir, module)
+                namespace.update({alias.asname or alias.name: getattr(local, alias.name) for alias in node.names})
+                continue
+            if module.split('.')[0] not in ALLOWED_IMPORTS or module.startswith(SKIPPED_IMPORTS):
+                continue
+        elif isinstance(node, ast.Assign):
+            if not (all(isinstance(t, ast.Name) for t in node.targets) and _is_constant(node.value)):
+                continue
+        elif isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            node.decorator_list = [d for d in node.decorator_list if not _is_timer(d)]
+        else:
+            continue
+        code = compile(ast.Module(body=[node], type_ignores=[]), path, 'exec')
+        try:
+            exec(code, namespace)
+        except (NameError, AttributeError):
+            pass  # depends on something that was skipped
+
+    namespace['DEVICE'] = device
+    namespace['wrapper_outputs'] = _local_module(env_dir, 'prototype_ops').wrapper_outputs
+    return namespace
+
+
+def build_wrapper(env, wrapper, device='cpu'):
+    """
+    Freshly initialized wrapper of env, as the script builds it, and the namespace of its script
+    """
+    script, class_name = WRAPPERS[wrapper]
+    namespace = load_script(env, script, device)
+    return namespace[class_name]().to(device), namespace